@@ -352,6 +352,10 @@ def doRuns(cfg, dataInterface, subjInterface, webInterface):
         # save the activations value info into a vector that can be saved later
         all_avg_activations[this_TR] = avg_niftiData
 
+    if useInitWatch is False:
+        # close the stream and its file watch now that the run is done
+        dataInterface.closeScannerStream(streamId)
+
     # create the full path filename of where we want to save the activation values vector.
     #   we're going to save things as .txt and .mat files
     output_textFilename = '/tmp/cloud_directory/tmp/avg_activations.txt'
@@ -10,6 +10,7 @@ from copy import deepcopy
 from datetime import datetime
 from operator import eq as opeq
 from typing import Any, Callable
+import io
 import json
 import os
 
@@ -639,3 +640,100 @@ class BidsIncremental:
                 readme.write(self.readme)
 
     """ END BIDS-I ARCHIVE EMULTATION API """
+
+    """
+    BEGIN BIDS-I STREAM WIRE FORMAT API
+
+    Within one stream the NIfTI header (including the affine), dataset
+    description, readme, events and most of the image metadata stay the same
+    from one incremental to the next. The stream base holds these values, which
+    both ends of a stream cache, and each incremental is then sent as a delta
+    containing the voxel data and only the values that differ from the base.
+
+    """
+    def _splitNiftiBytes(self):
+        niftiBytes = self.image.to_bytes()
+        # The in-memory header's offset isn't updated when writing, so read the
+        # offset from the header as it was written
+        writtenHeader = self.image.header_class.from_fileobj(io.BytesIO(niftiBytes))
+        dataOffset = int(writtenHeader.get_data_offset())
+        header = niftiBytes[:dataOffset]
+        voxels = np.frombuffer(niftiBytes, dtype=np.uint8, offset=dataOffset)
+        return header, voxels
+
+    def getStreamBase(self) -> dict:
+        """
+        Returns the values of this incremental that are expected to remain the
+        same for the other incrementals of the stream.
+        """
+        header, _ = self._splitNiftiBytes()
+        return {
+            'version': self.version,
+            'niftiImageClass': self.image.__class__,
+            'header': header,
+            'imgMetadata': deepcopy(self._imgMetadata),
+            'datasetDescription': deepcopy(self.datasetDescription),
+            'readme': self.readme,
+            'events': self.events.copy(),
+        }
+
+    def getStreamDelta(self, base: dict) -> dict:
+        """
+        Returns the voxel data and the values that differ from the stream base.
+        Use BidsIncremental.fromStreamDelta() with the same base to recreate
+        the incremental.
+        """
+        def valuesEqual(val1, val2) -> bool:
+            try:
+                return bool(val1 == val2)
+            except ValueError:
+                # numpy arrays are ambiguous in a boolean context
+                return np.array_equal(val1, val2)
+
+        header, voxels = self._splitNiftiBytes()
+        baseMetadata = base['imgMetadata']
+        delta = {
+            'voxels': voxels,
+            'changedMetadata': {key: value for key, value in self._imgMetadata.items()
+                                if key not in baseMetadata or
+                                not valuesEqual(baseMetadata[key], value)},
+            'removedMetadata': [key for key in baseMetadata
+                                if key not in self._imgMetadata],
+        }
+        if header != base['header'] or self.image.__class__ != base['niftiImageClass']:
+            delta['header'] = header
+            delta['niftiImageClass'] = self.image.__class__
+        if self.datasetDescription != base['datasetDescription']:
+            delta['datasetDescription'] = self.datasetDescription
+        if self.readme != base['readme']:
+            delta['readme'] = self.readme
+        if not pd.DataFrame.equals(self.events, base['events']):
+            delta['events'] = self.events
+        return delta
+
+    @classmethod
+    def fromStreamDelta(cls, delta: dict, base: dict) -> 'BidsIncremental':
+        """
+        Recreate an incremental from a delta made by getStreamDelta() and the
+        stream base it was made against.
+        """
+        header = delta.get('header', base['header'])
+        niftiImageClass = delta.get('niftiImageClass', base['niftiImageClass'])
+        imgMetadata = deepcopy(base['imgMetadata'])
+        imgMetadata.update(delta['changedMetadata'])
+        for key in delta['removedMetadata']:
+            imgMetadata.pop(key, None)
+
+        incremental = cls.__new__(cls)
+        incremental.__dict__.update({
+            'version': base['version'],
+            'image': niftiImageClass.from_bytes(b''.join([header, delta['voxels']])),
+            '_imgMetadata': imgMetadata,
+            'datasetDescription': deepcopy(delta.get('datasetDescription',
+                                                     base['datasetDescription'])),
+            'readme': delta.get('readme', base['readme']),
+            'events': delta.get('events', base['events']).copy(),
+        })
+        return incremental
+
+    """ END BIDS-I STREAM WIRE FORMAT API """
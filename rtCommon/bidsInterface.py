@@ -11,14 +11,18 @@ one instance of dataInterface, as part of the projectServer with dataRemote=Fals
 """
 import os
 import time
+import uuid
 from rtCommon.remoteable import RemoteableExtensible
+from rtCommon.resultCache import CacheStatic
 from rtCommon.bidsArchive import BidsArchive
 from rtCommon.bidsIncremental import BidsIncremental
 from rtCommon.bidsCommon import getDicomMetadata
 from rtCommon.imageHandling import convertDicomImgToNifti
 from rtCommon.dataInterface import DataInterface
+from rtCommon.streamSubscription import subscriptionPollSeconds, defaultMaxBuffered
 from rtCommon.openNeuro import OpenNeuroCache
-from rtCommon.errors import RequestError, MissingMetadataError
+from rtCommon.errors import RequestError, MissingMetadataError, StateError, SubscriptionMissError
+from rtCommon.structDict import StructDict
 from rtCommon.utils import demoDelay
 
 class BidsInterface(RemoteableExtensible):
@@ -33,7 +37,14 @@ class BidsInterface(RemoteableExtensible):
     If dataRemote=False, then the methods below will be invoked locally and the RemoteExtensible
     parent class is inoperable (i.e. does nothing).
     """
-    def __init__(self, dataRemote=False, allowedDirs=[], scannerClockSkew=0):
+    # Results that can be cached when forwarding to a remote, see enableResultCache()
+    cacheableMethods = {'getNumVolumes': CacheStatic}
+    cacheInvalidations = {'closeStream': ['getNumVolumes']}
+    # Incrementals are pushed to a remote BidsInterface by subscribeStream()
+    subscriptionMethods = {'subscribeStream': ('bidsStreamGenerator', 'getIncremental')}
+    streamCloseMethods = {'closeStream'}
+
+    def __init__(self, dataRemote=False, allowedDirs=[], scannerClockSkew=0, usePolling=False):
         """
         Args:
             dataRemote (bool): Set to true for a passthrough instance that will forward requests.
@@ -42,9 +53,16 @@ class BidsInterface(RemoteableExtensible):
                                 directories that Dicom files are allowed to be read from.
             scannerClockSkew (float): number of seconds the scanner's clock is ahead of the
                 data server clock
+            usePolling (bool): Only applicable for DicomToBidsStreams. Whether to watch
+                for Dicom files by polling the directories (see PollingRouter)
         """
         super().__init__(isRemote=dataRemote)
+        # map from streamId to the cached stream base (see BidsIncremental.getStreamBase)
+        #   and the key identifying that base, StructDict({'key', 'base'})
+        self.streamBases = {}
         if dataRemote is True:
+            # getIncremental runs locally to rebuild incrementals from the stream deltas
+            self.addLocalAttributes(['getIncremental', 'streamBases', '_incrementalFromDelta'])
             return
         # local version initialization here
         # TODO - make multithread streams possible
@@ -55,6 +73,7 @@ class BidsInterface(RemoteableExtensible):
         # Store the allowed directories to be used by the DicomToBidsStream class
         self.allowedDirs = allowedDirs
         self.scannerClockSkew = scannerClockSkew
+        self.usePolling = usePolling
         self.openNeuroCache = OpenNeuroCache(cachePath="/tmp/openneuro")
 
 
@@ -79,10 +98,11 @@ class BidsInterface(RemoteableExtensible):
         """
         # TODO - allow multiple simultaneous streams to be instantiated
         streamId = 1
-        dicomBidsStream = DicomToBidsStream(self.allowedDirs)
+        dicomBidsStream = DicomToBidsStream(self.allowedDirs, usePolling=self.usePolling)
         dicomBidsStream.initStream(dicomDir, dicomFilePattern, dicomMinSize,
                                    anonymize=anonymize, **entities)
         self.streamMap[streamId] = dicomBidsStream
+        self.streamBases.pop(streamId, None)
         return streamId
 
     def initBidsStream(self, archivePath, **entities) -> int:
@@ -100,6 +120,7 @@ class BidsInterface(RemoteableExtensible):
         streamId = 1
         bidsStream = BidsStream(archivePath, **entities)
         self.streamMap[streamId] = bidsStream
+        self.streamBases.pop(streamId, None)
         return streamId
 
     def initOpenNeuroStream(self, dsAccessionNumber, **entities) -> int:
@@ -121,9 +142,11 @@ class BidsInterface(RemoteableExtensible):
         streamId = 1
         bidsStream = BidsStream(archivePath, **entities)
         self.streamMap[streamId] = bidsStream
+        self.streamBases.pop(streamId, None)
         return streamId
 
-    def getIncremental(self, streamId, volIdx=-1, timeout=5, demoStep=0) -> BidsIncremental:
+    def getIncremental(self, streamId, volIdx=-1, timeout=5, demoStep=0,
+                       rpc_timeout=None) -> BidsIncremental:
         """
         Get a BIDS Incremental from a stream
 
@@ -134,13 +157,121 @@ class BidsInterface(RemoteableExtensible):
             timeout: Max number of seconds to wait for incremental when
                      running real-time
             demoStep: Simulate x second TR delay
+            rpc_timeout: Timeout for the request to a remote instance, unused when local
         Returns:
             A BidsIncremental containing the image volume
         """
+        if self.isRemote is True:
+            subscription = self.subscriptions.get(('getIncremental', streamId))
+            if subscription is not None:
+                try:
+                    delta = self.getSubscribedResult(subscription, 'getIncremental',
+                                                     (streamId, volIdx, timeout, demoStep), {})
+                    return self._incrementalFromDelta(streamId, delta)
+                except SubscriptionMissError:
+                    # not pushed by the remote, request it below
+                    if not subscription.isActive():
+                        self.subscriptions.pop(('getIncremental', streamId), None)
+            # Request only the changes relative to our cached stream base
+            streamBase = self.streamBases.get(streamId)
+            streamKey = streamBase.key if streamBase is not None else None
+            kwargs = {}
+            if rpc_timeout is not None:
+                kwargs['rpc_timeout'] = rpc_timeout
+            delta = self.remoteCall('getIncrementalDelta', streamId, streamKey,
+                                    volIdx, timeout, demoStep, **kwargs)
+            if delta is None:
+                return None
+            return self._incrementalFromDelta(streamId, delta)
         stream = self.streamMap[streamId]
         bidsIncremental = stream.getIncremental(volIdx, timeout=timeout, demoStep=demoStep)
         return bidsIncremental
 
+    def getIncrementalDelta(self, streamId, streamKey=None, volIdx=-1, timeout=5, demoStep=0) -> dict:
+        """
+        Get a BIDS Incremental from a stream encoded as a delta against the stream base.
+        Used by a remote BidsInterface's getIncremental(), which caches the stream base
+        so that only the voxel data and changed metadata are sent for each volume.
+
+        Args:
+            streamId: The stream handle returned by the initXXStream call
+            streamKey: Key of the stream base the caller has cached, None if none.
+                If it doesn't match the current stream base, the base is included.
+            volIdx, timeout, demoStep: see getIncremental()
+        Returns:
+            A StructDict with the delta (see BidsIncremental.getStreamDelta) and 'streamKey',
+            plus 'base' if the caller needs the stream base, or None if no incremental
+        """
+        bidsIncremental = self.getIncremental(streamId, volIdx, timeout=timeout, demoStep=demoStep)
+        if bidsIncremental is None:
+            return None
+        return self._streamDelta(streamId, bidsIncremental, streamKey)
+
+    def subscribeStream(self, streamId, startIndex=0, maxBuffered=defaultMaxBuffered) -> None:
+        """
+        Have the remote service push each BIDS incremental of a stream to the projectServer
+        as soon as it is available, rather than waiting for each getIncremental() request.
+        The projectServer buffers them so getIncremental() returns immediately once its
+        volume has arrived. Only has an effect when the BidsInterface is remote.
+
+        Args:
+            streamId: The stream handle returned by the initXXStream call
+            startIndex: Index of the first volume to push
+            maxBuffered: Max number of received volumes the projectServer keeps
+        """
+        return None
+
+    def bidsStreamGenerator(self, streamId, startIndex=0):
+        """
+        Yields (volIdx, delta) for each volume of a stream as it becomes available, where
+        delta is as returned by getIncrementalDelta() and the first one includes the stream
+        base. Yields None while waiting for a volume. Ends at the end of the run or when
+        the stream is closed. Run at the remote service for subscribeStream().
+        """
+        stream = self.streamMap[streamId]
+        try:
+            numVolumes = stream.getNumVolumes()
+        except Exception:
+            # unknown for real-time streams
+            numVolumes = None
+        volIdx = startIndex
+        streamKey = None
+        while numVolumes is None or volIdx < numVolumes:
+            if streamId not in self.streamMap:
+                # the stream was closed
+                return
+            bidsIncremental = stream.pollIncremental(volIdx, timeout=subscriptionPollSeconds)
+            if bidsIncremental is None:
+                yield None
+                continue
+            delta = self._streamDelta(streamId, bidsIncremental, streamKey)
+            streamKey = delta['streamKey']
+            yield (volIdx, delta)
+            volIdx += 1
+
+    def _streamDelta(self, streamId, bidsIncremental, streamKey):
+        streamBase = self.streamBases.get(streamId)
+        if streamBase is None:
+            streamBase = StructDict({'key': uuid.uuid4().hex,
+                                     'base': bidsIncremental.getStreamBase()})
+            self.streamBases[streamId] = streamBase
+        # Return a StructDict so the remote service pickles it (the voxels are a numpy array)
+        delta = StructDict(bidsIncremental.getStreamDelta(streamBase.base))
+        delta['streamKey'] = streamBase.key
+        if streamKey != streamBase.key:
+            delta['base'] = streamBase.base
+        return delta
+
+    def _incrementalFromDelta(self, streamId, delta) -> BidsIncremental:
+        # Rebuild an incremental from a delta returned by the remote
+        streamBase = self.streamBases.get(streamId)
+        if 'base' in delta:
+            streamBase = StructDict({'key': delta['streamKey'], 'base': delta['base']})
+            self.streamBases[streamId] = streamBase
+        elif streamBase is None or streamBase.key != delta['streamKey']:
+            raise StateError(f'getIncremental: stream {streamId} base missing for delta')
+        return BidsIncremental.fromStreamDelta(delta, streamBase.base)
+
     def getNumVolumes(self, streamId) -> int:
         """
         Return the number of image volumes contained in the stream. This is only
@@ -156,7 +287,10 @@ class BidsInterface(RemoteableExtensible):
 
     def closeStream(self, streamId):
         # remove the stream from the map
-        self.streamMap.pop(streamId, None)
+        stream = self.streamMap.pop(streamId, None)
+        self.streamBases.pop(streamId, None)
+        if stream is not None:
+            stream.closeStream()
 
     def getClockSkew(self, callerClockTime: float, roundTripTime: float) -> float:
         """
@@ -195,8 +329,9 @@ class DicomToBidsStream():
     script process data directly as BIDS as it arrives from the scanner.
     """
 
-    def __init__(self, allowedDirs=[]):
+    def __init__(self, allowedDirs=[], usePolling=False):
         self.allowedDirs = allowedDirs
+        self.usePolling = usePolling
 
     def initStream(self, dicomDir, dicomFilePattern, dicomMinSize,
                    anonymize=True, **entities):
@@ -231,13 +366,18 @@ class DicomToBidsStream():
         # TODO - restrict allowed directories, check that dicomDir is in allowed dir
         self.dataInterface = DataInterface(dataRemote=False,
                                            allowedDirs=self.allowedDirs,
-                                           allowedFileTypes=['.dcm'])
+                                           allowedFileTypes=['.dcm'],
+                                           usePolling=self.usePolling)
         self.dicomStreamId = self.dataInterface.initScannerStream(dicomDir,
                                                                   dicomFilePattern,
                                                                   dicomMinSize,
                                                                   anonymize=anonymize)
         self.nextVol = 0
 
+    def closeStream(self):
+        """Close the scanner stream and its file watch"""
+        self.dataInterface.closeScannerStream(self.dicomStreamId)
+
     def getNumVolumes(self) -> int:
         """
         Return the number of brain volumes in the run, unknowable by this
@@ -269,15 +409,25 @@ class DicomToBidsStream():
             pass
         # wait for the dicom and create a bidsIncremental
         dcmImg = self.dataInterface.getImageData(self.dicomStreamId, self.nextVol, timeout=timeout)
-        dicomMetadata = getDicomMetadata(dcmImg)
-        dicomMetadata.update(self.entities)
-        niftiImage = convertDicomImgToNifti(dcmImg)
-        incremental = BidsIncremental(niftiImage, dicomMetadata)
+        incremental = self._makeIncremental(dcmImg)
         self.nextVol += 1
         if demoStep is not None and demoStep > 0:
             demoDelay(demoStep)
         return incremental
 
+    def pollIncremental(self, volIdx, timeout=5) -> BidsIncremental:
+        """Returns the BIDS incremental of volume volIdx, or None if not available within the timeout"""
+        dcmImg = self.dataInterface.pollImageData(self.dicomStreamId, volIdx, timeout=timeout)
+        if dcmImg is None:
+            return None
+        return self._makeIncremental(dcmImg)
+
+    def _makeIncremental(self, dcmImg) -> BidsIncremental:
+        dicomMetadata = getDicomMetadata(dcmImg)
+        dicomMetadata.update(self.entities)
+        niftiImage = convertDicomImgToNifti(dcmImg)
+        return BidsIncremental(niftiImage, dicomMetadata)
+
 
 class BidsStream:
     """
@@ -296,6 +446,10 @@ class BidsStream:
         self.numVolumes = self.bidsRun.numIncrementals()
         self.nextVol = 0
 
+    def closeStream(self):
+        """Nothing to release, the archive is read when the stream is opened"""
+        pass
+
     def getNumVolumes(self) -> int:
         """Return the number of brain volumes in the run"""
         return self.numVolumes
@@ -328,3 +482,9 @@ class BidsStream:
             return incremental
         else:
             return None
+
+    def pollIncremental(self, volIdx, timeout=5) -> BidsIncremental:
+        """Returns the BIDS incremental of volume volIdx, or None past the end of the run"""
+        if volIdx < self.numVolumes:
+            return self.bidsRun.getIncremental(volIdx)
+        return None
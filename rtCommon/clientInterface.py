@@ -15,14 +15,31 @@ Client Service Interfaces provided (i.e. for the classification script client):
     dataInterface - to read and write files from the remote server
     subjectInterface - to send subject feedback and receive responses
     webInterface - to set browser messages, update plots, send/receive configs
+
+Each interface also provides callAsync(methodName, *args, **kwargs) which starts the call
+and returns a concurrent.futures.Future, so that several requests can be in flight at once,
+and batch() to send several small calls together, e.g.
+    with clientInterface.dataInterface.batch():
+        ...
+For asyncio scripts, asyncDataInterface, asyncSubjInterface, asyncBidsInterface and
+asyncExampleInterface provide the same methods as coroutines, e.g.
+    data = await clientInterface.asyncDataInterface.getFile(filename)
 """
+import asyncio
+import functools
+import threading
 import rpyc
+from concurrent.futures import ThreadPoolExecutor
 from rtCommon.dataInterface import DataInterface
 from rtCommon.subjectInterface import SubjectInterface
 from rtCommon.webDisplayInterface import WebDisplayInterface
 from rtCommon.bidsInterface import BidsInterface
 from rtCommon.exampleInterface import ExampleInterface
+from rtCommon.remoteable import RpcBatch
 from rtCommon.errors import RequestError
+from rtCommon import rpcTracing
+from rtCommon.rpcTracing import rpcTraceStats
+from rtCommon.sharedMemoryTransport import canUseSharedMemory, importSharedResult
 
 
 class ClientInterface:
@@ -31,31 +48,43 @@ class ClientInterface:
     project server. It provides both a DataInterface for reading or writing files, and a
     SubjectInterface for sending/receiving feedback and response to the subject in the MRI scanner.
     """
-    def __init__(self, rpyc_timeout=120, yesToPrompts=False):
+    def __init__(self, rpyc_timeout=120, yesToPrompts=False, maxAsyncCalls=4, useSharedMemory=True):
         """
         Establishes an RPC connection to a localhost projectServer on a predefined port.
         The projectServer must be running on the same computer as the script using this interface.
+
+        Args:
+            rpyc_timeout: default timeout in seconds for calls to the projectServer
+            yesToPrompts: use local interfaces without prompting if no projectServer is running
+            maxAsyncCalls: max number of callAsync() requests in flight at once
+            useSharedMemory: receive large results from the projectServer through shared
+                memory (see sharedMemoryTransport) rather than through the rpyc socket
         """
         self.rpcConn = None
+        self.rpyc_timeout = rpyc_timeout
+        self.maxAsyncCalls = maxAsyncCalls
+        self.sharedMemory = useSharedMemory and canUseSharedMemory()
+        # The projectServer serves the requests of one connection in order, so each
+        #   thread making async calls uses its own connection.
+        self.asyncExecutor = None
+        self.asyncConns = []
+        self.asyncConnLocal = threading.local()
+        self.asyncLock = threading.Lock()
         try:
-            safe_attrs = rpyc.core.protocol.DEFAULT_CONFIG.get('safe_attrs')
-            safe_attrs.add('__format__')
-            rpcConn = rpyc.connect('localhost', 12345,
-                                   config={
-                                            "allow_public_attrs": True,
-                                            "safe_attrs": safe_attrs,
-                                            "allow_pickle" : True,
-                                            "sync_request_timeout": rpyc_timeout,
-                                            # "allow_getattr": True,
-                                            # "allow_setattr": True,
-                                            # "allow_delattr": True,
-                                            # "allow_all_attrs": True,
-                                           })
+            rpcConn = self._connect()
             # Need to provide an override class of DataInstance to return data from getImage
-            self.dataInterface = WrapRpycObject(rpcConn.root.DataInterface)
-            self.subjInterface = WrapRpycObject(rpcConn.root.SubjectInterface)
-            self.bidsInterface = WrapRpycObject(rpcConn.root.BidsInterface)
-            self.exampleInterface = WrapRpycObject(rpcConn.root.ExampleInterface)
+            self.dataInterface = WrapRpycObject(rpcConn.root.DataInterface,
+                functools.partial(self._callAsync, 'DataInterface'),
+                self.sharedMemory)
+            self.subjInterface = WrapRpycObject(rpcConn.root.SubjectInterface,
+                functools.partial(self._callAsync, 'SubjectInterface'),
+                self.sharedMemory)
+            self.bidsInterface = WrapRpycObject(rpcConn.root.BidsInterface,
+                functools.partial(self._callAsync, 'BidsInterface'),
+                self.sharedMemory)
+            self.exampleInterface = WrapRpycObject(rpcConn.root.ExampleInterface,
+                functools.partial(self._callAsync, 'ExampleInterface'),
+                self.sharedMemory)
             # WebDisplay is always run within the projectServer (i.e. not a remote service)
             self.webInterface = rpcConn.root.WebDisplayInterface
             self.rpcConn = rpcConn
@@ -78,6 +107,58 @@ class ClientInterface:
                 self.webInterface = WebDisplayInterface(ioLoopInst=None)
             else:
                 raise err
+        self.asyncDataInterface = AsyncioInterface(self.dataInterface)
+        self.asyncSubjInterface = AsyncioInterface(self.subjInterface)
+        self.asyncBidsInterface = AsyncioInterface(self.bidsInterface)
+        self.asyncExampleInterface = AsyncioInterface(self.exampleInterface)
+
+    def _connect(self):
+        """Open an rpyc connection to the projectServer"""
+        safe_attrs = rpyc.core.protocol.DEFAULT_CONFIG.get('safe_attrs')
+        safe_attrs.add('__format__')
+        return rpyc.connect('localhost', 12345,
+                            config={
+                                    "allow_public_attrs": True,
+                                    "safe_attrs": safe_attrs,
+                                    "allow_pickle" : True,
+                                    "sync_request_timeout": self.rpyc_timeout,
+                                    # "allow_getattr": True,
+                                    # "allow_setattr": True,
+                                    # "allow_delattr": True,
+                                    # "allow_all_attrs": True,
+                                   })
+
+    def _callAsync(self, interfaceName, attribute, *args, **kwargs):
+        """Start a call on one of the projectServer interfaces, returns a Future for the result"""
+        with self.asyncLock:
+            if self.asyncExecutor is None:
+                self.asyncExecutor = ThreadPoolExecutor(max_workers=self.maxAsyncCalls,
+                                                        thread_name_prefix='clientAsync')
+        return self.asyncExecutor.submit(self._runAsyncCall, interfaceName, attribute, args, kwargs)
+
+    def _runAsyncCall(self, interfaceName, attribute, args, kwargs):
+        conn = getattr(self.asyncConnLocal, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self._connect()
+            self.asyncConnLocal.conn = conn
+            with self.asyncLock:
+                self.asyncConns.append(conn)
+        rpycObject = getattr(conn.root, interfaceName)
+        return callRpycMethod(rpycObject, attribute, args, kwargs,
+                              sharedMemory=self.sharedMemory)
+
+    def close(self):
+        """Close the connections to the projectServer"""
+        if self.asyncExecutor is not None:
+            self.asyncExecutor.shutdown(wait=True)
+            self.asyncExecutor = None
+        with self.asyncLock:
+            for conn in self.asyncConns:
+                conn.close()
+            self.asyncConns = []
+        if self.rpcConn is not None:
+            self.rpcConn.close()
+            self.rpcConn = None
 
     def isDataRemote(self):
         """
@@ -104,40 +185,150 @@ class ClientInterface:
             return False
         return True
 
+    def setRpcTracing(self, enable=True):
+        """
+        Turn on or off the projectServer's latency tracing of the calls it forwards to
+        the remote services (see getRpcLatencyStats). Tracing is off by default.
+        """
+        if self.rpcConn is None:
+            rpcTracing.traceRpcCalls = bool(enable)
+            return
+        self.rpcConn.root.setRpcTracing(enable)
+
+    def getRpcLatencyStats(self, method=None):
+        """
+        Returns the latency stats of the calls the projectServer forwarded to the
+        remote services, a dict from method name to a dict of span name
+        (e.g. 'wait', 'remote.execute', 'total') to the span's latency summary.
+        Args:
+            method: only return the stats of this method, e.g. 'DataInterface.getFile'
+        """
+        if self.rpcConn is None:
+            return rpcTraceStats.getStats(method)
+        return rpyc.classic.obtain(self.rpcConn.root.getRpcLatencyStats(method))
+
+
+def callRpycMethod(rpycObject, name, args, kwargs, sharedMemory=False, isRemote=None):
+    """
+    Call a method of an rpyc object and return the result
+    Args:
+        rpycObject: netref of the projectServer interface
+        name: the method name
+        sharedMemory: whether large results can be received through shared memory
+        isRemote: whether the interface forwards calls to a remote service,
+            None to ask the projectServer when it is needed
+    """
+    timeout = None
+    if 'rpc_timeout' in kwargs:
+        if isRemote is None:
+            isRemote = rpycObject.isRunningRemote()
+        if isRemote is True:
+            # The rpycObject is itself remote from the projectServer via wsRPC
+            # Keep the rpc_timeout kwarg so wsRPC can also adjust its timeout
+            timeout = kwargs.get('rpc_timeout')
+        else:
+            # The rpycObject is local to the projectServer so remove the timeout param
+            timeout = kwargs.pop('rpc_timeout')
+    # Call the method and serialize its result in one request to the projectServer,
+    #   kwargs are sent as items so they are passed by value rather than as a netref
+    conn = object.__getattribute__(rpycObject, '____conn__')
+    func = conn.root.callAndExport
+    callArgs = (rpycObject, name, args, tuple(kwargs.items()), sharedMemory)
+    if timeout is not None:
+        timed_call = rpyc.timed(func, timeout)
+        result = timed_call(*callArgs).value
+    else:
+        result = func(*callArgs)
+    return importSharedResult(result)
+
 
 class WrapRpycObject(object):
     """
     Rpyc commands return a rpyc.core.netref object to as a reference to the remote object.
-    This class wraps all calls to the remote in order to dereference the rpyc.core.netref
-    and return the actual object using rpyc.classic.obtain(ref)
+    This class wraps all calls to the remote in order to return the actual result object
+    rather than a rpyc.core.netref. The wrapper function of each method is created on
+    first use and cached, as is whether the interface forwards calls to a remote service.
     """
-    def __init__(self, rpycObject):
+    def __init__(self, rpycObject, asyncCaller=None, sharedMemory=False):
+        """
+        Args:
+            rpycObject: netref of the projectServer interface
+            asyncCaller: function(attribute, *args, **kwargs) that starts a call and returns a Future
+            sharedMemory: whether large results can be received through shared memory
+        """
         self.rpycObject = rpycObject
+        self.asyncCaller = asyncCaller
+        self.sharedMemory = sharedMemory
+        # map from method name to its wrapper function
+        self.methodCache = {}
+        # whether the interface forwards calls to a remote service, None until needed
+        self.cachedIsRemote = None
+        # the batch (if any) collecting this thread's calls
+        self.batchState = threading.local()
 
     def __getattribute__(self, name):
         rpycObject = object.__getattribute__(self, 'rpycObject')
+        if name == 'callAsync':
+            asyncCaller = object.__getattribute__(self, 'asyncCaller')
+            if asyncCaller is not None:
+                return asyncCaller
+        elif name == 'batch':
+            # Collect the batched calls here so they are sent to the projectServer
+            #   in one rpyc call (and from there to the remote in one request)
+            runBatch = object.__getattribute__(self, '_getMethod')('runBatch')
+            batchState = object.__getattribute__(self, 'batchState')
+            return lambda: RpcBatch(runBatch, batchState)
+        batch = getattr(object.__getattribute__(self, 'batchState'), 'batch', None)
+        if batch is not None:
+            # Calls within a batch are collected without contacting the projectServer
+            def batchCall(*args, **kwargs):
+                return batch.add(name, args, kwargs)
+            return batchCall
+        method = object.__getattribute__(self, 'methodCache').get(name)
+        if method is not None:
+            return method
         attr = getattr(rpycObject, name)
         if hasattr(attr, '__call__'):
-            def newfunc(*args, **kwargs):
-                if 'rpc_timeout' in kwargs:
-                    if rpycObject.isRunningRemote() is True:
-                        # The rpycObject is itself remote from the projectServer via wsRPC
-                        # Keep the rpc_timeout kwarg so wsRPC can also adjust its timeout
-                        timeout = kwargs.get('rpc_timeout')
-                    else:
-                        # The rpycObject is local to the projectServer so remove the timeout param
-                        timeout = kwargs.pop('rpc_timeout')
-                    timed_call = rpyc.timed(attr, timeout)
-                    timed_res = timed_call(*args, **kwargs)
-                    ref = timed_res.value
-                else:
-                    ref = attr(*args, **kwargs)
-                result = rpyc.classic.obtain(ref)
-                return result
-            return newfunc
+            return object.__getattribute__(self, '_getMethod')(name)
         else:
             return attr
 
+    def _getMethod(self, name):
+        """Returns the cached wrapper function for a method, creating it on first use"""
+        methodCache = object.__getattribute__(self, 'methodCache')
+        method = methodCache.get(name)
+        if method is not None:
+            return method
+        rpycObject = object.__getattribute__(self, 'rpycObject')
+        sharedMemory = object.__getattribute__(self, 'sharedMemory')
+        wrapper = self
+
+        def method(*args, **kwargs):
+            isRemote = object.__getattribute__(wrapper, 'cachedIsRemote')
+            if isRemote is None and 'rpc_timeout' in kwargs:
+                isRemote = rpycObject.isRunningRemote()
+                object.__setattr__(wrapper, 'cachedIsRemote', isRemote)
+            return callRpycMethod(rpycObject, name, args, kwargs, sharedMemory=sharedMemory,
+                                  isRemote=isRemote)
+        methodCache[name] = method
+        return method
+
+
+class AsyncioInterface(object):
+    """
+    Provides the methods of an interface as coroutines for use with asyncio.
+    Each call is started with the interface's callAsync() and awaited, e.g.
+        data = await AsyncioInterface(dataInterface).getFile(filename)
+    """
+    def __init__(self, interface):
+        self.interface = interface
+
+    def __getattr__(self, name):
+        async def asyncCall(*args, **kwargs):
+            future = self.interface.callAsync(name, *args, **kwargs)
+            return await asyncio.wrap_future(future)
+        return asyncCall
+
 
     # TODO - make a more efficient getFile and putFile
     # def getFile():
@@ -0,0 +1,185 @@
+"""
+Compression codecs used when sending data over the websocket RPC channels.
+
+Codecs are kept in a registry by name. The remote service and the projectServer
+negotiate at connect time which codecs both sides can decode, and the sender uses
+a CompressionPolicy to pick the codec for each result. The codec used is reported
+in the message header so the receiver knows how to decompress the data.
+"""
+import time
+import lzma
+import zlib
+import threading
+from rtCommon.structDict import StructDict
+from rtCommon.errors import RequestError
+
+# HTTP header a remote service sets at connect time listing the codecs it supports
+codecsHeader = 'X-RTCloud-Codecs'
+# Codec used when compression is requested without naming a codec
+defaultCodec = 'zlib'
+# Codecs that receivers which predate codec negotiation can decode (all use zlib.decompress)
+legacyCodecs = ['none', 'zlib', 'zlib1', 'zlib9']
+
+# map from codec name to (compressFunc, decompressFunc)
+compressionCodecs = {}
+
+
+def registerCompressionCodec(name, compressFunc, decompressFunc):
+    """Add a codec to the registry. Both functions take and return bytes-like objects."""
+    compressionCodecs[name] = (compressFunc, decompressFunc)
+
+
+registerCompressionCodec('none', lambda data: data, lambda data: data)
+registerCompressionCodec('zlib', zlib.compress, zlib.decompress)
+registerCompressionCodec('zlib1', lambda data: zlib.compress(data, 1), zlib.decompress)
+registerCompressionCodec('zlib9', lambda data: zlib.compress(data, 9), zlib.decompress)
+registerCompressionCodec('lzma', lambda data: lzma.compress(data, preset=1), lzma.decompress)
+
+# Faster codecs are used only if their packages are installed
+try:
+    import lz4.frame  # type: ignore
+    registerCompressionCodec('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard  # type: ignore
+    registerCompressionCodec('zstd',
+                             lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                             lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+
+def availableCodecs():
+    """Returns the names of the codecs available in this process"""
+    return list(compressionCodecs.keys())
+
+
+def negotiateCodecs(advertisedCodecs):
+    """
+    Returns the codecs both sides support given a comma separated list of codec
+    names advertised by the other side, or None if nothing was advertised.
+    """
+    if advertisedCodecs is None or advertisedCodecs == '':
+        return None
+    names = [name.strip() for name in advertisedCodecs.split(',')]
+    return [name for name in names if name in compressionCodecs]
+
+
+def compressData(codec, data):
+    """Compress data with the named codec"""
+    funcs = compressionCodecs.get(codec)
+    if funcs is None:
+        raise RequestError(f'compressData: unknown codec {codec}')
+    return funcs[0](data)
+
+
+def decompressData(codec, data):
+    """Decompress data that was compressed with the named codec"""
+    funcs = compressionCodecs.get(codec)
+    if funcs is None:
+        raise RequestError(f'decompressData: unknown codec {codec}')
+    return funcs[1](data)
+
+
+class CompressionPolicy:
+    """
+    Chooses which codec to send data with. Each codec is periodically tried on a
+    sample of the data being sent to measure its compression ratio and encode and
+    decode speeds. The codec with the lowest estimated total time
+    (encode + transmit + decode) at the estimated link bandwidth is selected.
+    """
+    def __init__(self, minCompressSize=1024*1024, sampleSize=256*1024,
+                 probeInterval=50, linkBandwidth=12.5*2**20):
+        """
+        Args:
+            minCompressSize (int): data smaller than this is sent uncompressed
+            sampleSize (int): number of bytes of the data used to measure the codecs
+            probeInterval (int): re-measure the codecs every probeInterval selections
+            linkBandwidth (float): initial estimate of the link bandwidth in bytes/sec,
+                updated as transfers are recorded with recordTransfer()
+        """
+        self.minCompressSize = minCompressSize
+        self.sampleSize = sampleSize
+        self.probeInterval = probeInterval
+        self.linkBandwidth = linkBandwidth
+        # map from codec name to StructDict of ratio, encodeRate, decodeRate
+        self.codecStats = {}
+        self.numSelections = 0
+        self.statsLock = threading.Lock()
+        # weight given to new measurements in the moving averages
+        self.alpha = 0.3
+
+    def recordTransfer(self, numBytes, seconds):
+        """Update the link bandwidth estimate from a completed send"""
+        if numBytes < 64*1024 or seconds <= 0:
+            # too small to give a meaningful measurement
+            return
+        with self.statsLock:
+            self.linkBandwidth += self.alpha * (numBytes / seconds - self.linkBandwidth)
+
+    def _measureCodecs(self, data, codecs):
+        sample = memoryview(data)[:self.sampleSize]
+        sampleSize = len(sample)
+        for codec in codecs:
+            startTime = time.perf_counter()
+            compressed = compressData(codec, sample)
+            encodeTime = time.perf_counter() - startTime
+            decompressData(codec, compressed)
+            decodeTime = time.perf_counter() - startTime - encodeTime
+            measured = StructDict({
+                'ratio': len(compressed) / sampleSize,
+                'encodeRate': sampleSize / max(encodeTime, 1e-6),
+                'decodeRate': sampleSize / max(decodeTime, 1e-6),
+            })
+            with self.statsLock:
+                stats = self.codecStats.get(codec)
+                if stats is None:
+                    self.codecStats[codec] = measured
+                else:
+                    for key in ('ratio', 'encodeRate', 'decodeRate'):
+                        stats[key] += self.alpha * (measured[key] - stats[key])
+
+    def estimateSendTime(self, codec, dataSize):
+        """Estimated seconds to encode, transmit and decode dataSize bytes with codec"""
+        if codec == 'none':
+            return dataSize / self.linkBandwidth
+        stats = self.codecStats[codec]
+        return (dataSize / stats.encodeRate +
+                dataSize * stats.ratio / self.linkBandwidth +
+                dataSize / stats.decodeRate)
+
+    def selectCodec(self, data, allowedCodecs=None):
+        """
+        Choose the codec to send data with.
+        Args:
+            data (bytes): the data to be sent
+            allowedCodecs (list): codecs the receiver can decode, defaults to legacyCodecs
+        Returns:
+            Name of the codec to use, 'none' for no compression
+        """
+        if allowedCodecs is None:
+            allowedCodecs = legacyCodecs
+        if len(data) < self.minCompressSize:
+            return 'none'
+        candidates = [codec for codec in allowedCodecs
+                      if codec in compressionCodecs and codec != 'none']
+        if len(candidates) == 0:
+            return 'none'
+        self.numSelections += 1
+        unmeasured = [codec for codec in candidates if codec not in self.codecStats]
+        if self.numSelections % self.probeInterval == 0:
+            self._measureCodecs(data, candidates)
+        elif len(unmeasured) > 0:
+            self._measureCodecs(data, unmeasured)
+        dataSize = len(data)
+        bestCodec = 'none'
+        bestTime = self.estimateSendTime('none', dataSize)
+        with self.statsLock:
+            for codec in candidates:
+                estTime = self.estimateSendTime(codec, dataSize)
+                if estTime < bestTime:
+                    bestCodec = codec
+                    bestTime = estTime
+        return bestCodec
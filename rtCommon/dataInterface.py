@@ -13,6 +13,8 @@ import os
 import re
 import time
 import glob
+import json
+import hashlib
 import threading
 import logging
 from pathlib import Path
@@ -20,11 +22,32 @@ from typing import List, Union
 import pydicom
 import rtCommon.utils as utils
 from rtCommon.remoteable import RemoteableExtensible
+from rtCommon.resultCache import CacheStatic, CacheFileStat
+from rtCommon.deltaSync import computeSignature, computeDelta, applyDelta
 from rtCommon.fileWatcher import FileWatcher
+from rtCommon.streamSubscription import subscriptionPollSeconds, defaultMaxBuffered
+from rtCommon.imageReadAhead import ImageReadAhead, defaultReadAheadSize
+from rtCommon.requestWorkerPool import getServiceQueueMetrics
+from rtCommon.rpcTracing import LatencyHistogram
+from rtCommon.fileArchive import FileArchiveWriter, iterFileArchive
+from rtCommon.fileArchive import MemberData, MemberTooLarge, MemberSkipped
 from rtCommon.errors import StateError, RequestError, InvocationError, ValidationError
 from rtCommon.structDict import StructDict
 from rtCommon.imageHandling import readDicomFromBuffer, anonymizeDicom
 
+# Files at least this size are streamed a chunk at a time by the upload and download helpers
+streamMinFileSize = 64 * 2**20
+# Chunk size of streamed transfers, below the multipart size so each chunk is one message
+streamChunkSize = 8 * 2**20
+# Streamed data is written to a partial file which is renamed to the file when complete
+partialFileSuffix = '.rtpartial'
+# A streamGetFile() in progress keeps its resume token in this file beside the partial file
+resumeTokenSuffix = '.rtresume'
+# Max size of the archives of many files sent with one getFiles() or putFiles() call
+bulkArchiveSize = 4 * streamChunkSize
+# Max number of scanner streams kept open, opening another closes the oldest one
+maxScannerStreams = 8
+
 
 class DataInterface(RemoteableExtensible):
     """
@@ -38,8 +61,22 @@ class DataInterface(RemoteableExtensible):
     If dataRemote=False, then the methods below will be invoked locally and the RemoteExtensible
     parent class is inoperable (i.e. does nothing).
     """
+    # Results that can be cached when forwarding to a remote, see enableResultCache()
+    cacheableMethods = {'getFile': CacheFileStat,
+                        'getAllowedFileTypes': CacheStatic,
+                        'listDirs': CacheStatic}
+    cacheInvalidations = {'putFile': ['getFile', 'listDirs'],
+                          'putFileDelta': ['getFile', 'listDirs'],
+                          'putFileChunk': ['listDirs'],
+                          'commitPartialFile': ['getFile', 'listDirs'],
+                          'putFiles': ['getFile', 'listDirs']}
+    # Images are pushed to a remote DataInterface by subscribeScannerStream()
+    subscriptionMethods = {'subscribeScannerStream': ('scannerStreamGenerator', 'getImageData')}
+    streamCloseMethods = {'closeScannerStream'}
+
     def __init__(self, dataRemote :bool=False, allowedDirs :List[str]=None, 
-                 allowedFileTypes :List[str]=None, scannerClockSkew :float=0):
+                 allowedFileTypes :List[str]=None, scannerClockSkew :float=0,
+                 usePolling :bool=False):
         """
         Args:
             dataRemote (bool): whether data will be served from the local instance or requests forwarded
@@ -51,6 +88,8 @@ class DataInterface(RemoteableExtensible):
                 one on the list.
             scannerClockSkew (float): number of seconds the scanner's clock is ahead of the
                 data server clock
+            usePolling (bool): watch for scanner files by polling the directories, such as
+                for NFS/SMB shares where file events aren't delivered (see PollingRouter)
         """
         super().__init__(isRemote=dataRemote)
         if dataRemote is True:
@@ -58,7 +97,8 @@ class DataInterface(RemoteableExtensible):
         self.initWatchSet = False
         self.watchDir = None
         self.currentStreamId = 0
-        self.streamInfo = None
+        # map from streamId to the StructDict info of each scanner stream
+        self.streams = {}
         self.allowedDirs = allowedDirs
         self.scannerClockSkew = scannerClockSkew
         # Remove trailing slash from dir names
@@ -73,7 +113,7 @@ class DataInterface(RemoteableExtensible):
                         allowedFileTypes[i] = '.' + allowedFileTypes[i]
         self.fileWatchLock = threading.Lock()
         # instantiate local FileWatcher
-        self.fileWatcher = FileWatcher()
+        self.fileWatcher = FileWatcher(usePolling=usePolling)
 
     def __del__(self):
         if hasattr(self, "fileWatcher"):
@@ -82,11 +122,14 @@ class DataInterface(RemoteableExtensible):
                 self.fileWatcher = None
 
     def initScannerStream(self, imgDir: str, filePattern: str, minFileSize: int,
-                          anonymize: bool=True, demoStep: int=0) -> int:
+                          anonymize: bool=True, demoStep: int=0, readAhead: bool=False,
+                          readAheadSize: int=defaultReadAheadSize) -> int:
         """
         Initialize a data stream context with image directory and filepattern.
         Once the stream is initialized call getImageData() to retrieve image data.
-        NOTE: currently only one stream at a time is supported.
+        Several streams can be open at once, such as one per echo of a multi-echo scan,
+        each stream has its own file watch. Call closeScannerStream() when done with a stream,
+        at most maxScannerStreams are kept open and opening another closes the oldest one.
 
         Args:
             imgDir: the directory where the images are or will be written from the MRI scanner.
@@ -95,6 +138,9 @@ class DataInterface(RemoteableExtensible):
                 getImageData(imgIndex=6) would look for dicom file 'scan01_006.dcm'.
             minFileSize: Minimum size of the file to return (continue waiting if below this size)
             anonymize: Whether to remove participant specific fields from the Dicom header
+            readAhead: Whether to read, validate and anonymize each image in a background
+                thread as soon as it is written, so getImageData() returns it from memory
+            readAheadSize: Max number of read-ahead images to keep
 
         Returns:
             streamId: An identifier used when calling getImageData()
@@ -105,20 +151,46 @@ class DataInterface(RemoteableExtensible):
         # check that filePattern has {TR} in it
         if not re.match(r'.*{TR.*', filePattern):
             raise InvocationError(r"initScannerStream filePattern must have a {TR} pattern")
-        self.currentStreamId = self.currentStreamId + 1
-        self.streamInfo = StructDict({
-            'streamId': self.currentStreamId,
-            'type': 'scanner',
-            'imgDir': imgDir,
-            'filePattern': filePattern,
-            'minFileSize': minFileSize,
-            'anonymize': anonymize,
-            'demoStep': demoStep,
-            'imgIndex': 0,
-        })
         _, file_ext = os.path.splitext(filePattern)
-        self.initWatch(imgDir, '*' + file_ext, minFileSize, demoStep)
-        return self.currentStreamId
+        watchId = self.fileWatcher.addWatch(imgDir, '*' + file_ext, minFileSize, demoStep)
+        with self.fileWatchLock:
+            self.currentStreamId = self.currentStreamId + 1
+            streamId = self.currentStreamId
+            self.streams[streamId] = StructDict({
+                'streamId': streamId,
+                'type': 'scanner',
+                'imgDir': imgDir,
+                'filePattern': filePattern,
+                'minFileSize': minFileSize,
+                'anonymize': anonymize,
+                'demoStep': demoStep,
+                'imgIndex': 0,
+                'watchId': watchId,
+                'repetitionTime': None,
+                'readAhead': None,
+                # seconds from the file watcher seeing each image written to returning it
+                'arrivalLatency': LatencyHistogram(),
+            })
+            streamInfo = self.streams[streamId]
+            # streams are kept in the order opened
+            staleStreamIds = list(self.streams.keys())[:-maxScannerStreams]
+        for staleStreamId in staleStreamIds:
+            logging.info(f'initScannerStream: closing stream {staleStreamId}, '
+                         f'more than {maxScannerStreams} streams are open')
+            self.closeScannerStream(staleStreamId)
+        if readAhead is True:
+            streamInfo.readAhead = ImageReadAhead(
+                lambda imageIndex, timeout: self._readStreamImage(streamInfo, imageIndex, timeout),
+                maxCached=readAheadSize)
+        return streamId
+
+    def closeScannerStream(self, streamId: int) -> None:
+        """Close a stream opened with initScannerStream() and remove its file watch"""
+        streamInfo = self.streams.pop(streamId, None)
+        if streamInfo is not None:
+            if streamInfo.readAhead is not None:
+                streamInfo.readAhead.stop()
+            self.fileWatcher.removeWatch(streamInfo.watchId)
 
 
     def getImageData(self, streamId: int, imageIndex: int=None, timeout: int=5) -> pydicom.dataset.FileDataset:
@@ -135,17 +207,67 @@ class DataInterface(RemoteableExtensible):
             The bytes array representing the image data
             returns pydicom.dataset.FileDataset
         """
-        if self.currentStreamId == 0 or self.currentStreamId != streamId or self.streamInfo.streamId != streamId:
-            raise ValidationError(f"StreamID mismatch {self.currentStreamId} : {streamId}")
+        dicomImg = self.pollImageData(streamId, imageIndex, timeout)
+        if dicomImg is None:
+            streamInfo = self.streams[streamId]
+            if imageIndex is None:
+                imageIndex = streamInfo.imgIndex
+            filename = streamInfo.filePattern.format(TR=imageIndex)
+            raise RequestError(f"getImageData: Dicom file {streamInfo.imgDir}/{filename} not found or corrupted")
+        return dicomImg
+
+    def pollImageData(self, streamId: int, imageIndex: int=None, timeout: int=5) -> pydicom.dataset.FileDataset:
+        """
+        Same as getImageData() but returns None if the image isn't available within the timeout.
+        """
+        streamInfo = self.streams.get(streamId)
+        if streamInfo is None:
+            raise ValidationError(f"StreamID {streamId} not open, open streams {list(self.streams.keys())}")
 
         if imageIndex is None:
-            imageIndex = self.streamInfo.imgIndex
-        filename = self.streamInfo.filePattern.format(TR=imageIndex)
+            imageIndex = streamInfo.imgIndex
 
         if timeout <= 0:
             # Don't allow infinite timeout
             raise RequestError("getImageData: timeout parameter must be > 0 secs")
 
+        endTime = time.time() + timeout
+        dicomImg = None
+        if streamInfo.readAhead is not None:
+            dicomImg = streamInfo.readAhead.get(imageIndex, timeout)
+        if dicomImg is None and time.time() < endTime:
+            # not read ahead, e.g. an earlier image no longer in the cache
+            dicomImg = self._readStreamImage(streamInfo, imageIndex, endTime - time.time())
+        if dicomImg is not None:
+            streamInfo.imgIndex = imageIndex + 1
+            self._recordArrivalLatency(streamInfo, imageIndex)
+        return dicomImg
+
+    def getStreamLatencyStats(self, streamId: int) -> dict:
+        """
+        Returns a summary (see LatencyHistogram.summary) of the seconds from the file watcher
+        seeing each image of a stream written to the image being returned by getImageData()
+        or pushed to a subscription.
+        """
+        streamInfo = self.streams.get(streamId)
+        if streamInfo is None:
+            raise ValidationError(f"StreamID {streamId} not open, open streams {list(self.streams.keys())}")
+        return streamInfo.arrivalLatency.summary()
+
+    def _recordArrivalLatency(self, streamInfo, imageIndex: int) -> None:
+        filename = streamInfo.filePattern.format(TR=imageIndex)
+        try:
+            arrival = self.fileWatcher.getFileArrival(filename, streamInfo.watchId)
+        except StateError:
+            # the stream was closed
+            return
+        if arrival is not None:
+            # images found by the existence check (e.g. already there) have no arrival
+            streamInfo.arrivalLatency.add(time.time() - arrival[0])
+
+    def _readStreamImage(self, streamInfo, imageIndex: int, timeout: float) -> pydicom.dataset.FileDataset:
+        """Wait for, read and anonymize an image of a stream, returns None on timeout"""
+        filename = streamInfo.filePattern.format(TR=imageIndex)
         loop_timeout = 5  # 5 seconds per loop
         endTime = time.time() + timeout
         while time.time() < endTime:
@@ -153,13 +275,14 @@ class DataInterface(RemoteableExtensible):
             if time_remaining < loop_timeout:
                 loop_timeout = time_remaining
             try:
-                data = self.watchFile(filename, loop_timeout)
+                data = self._watchStreamFile(streamInfo, filename, loop_timeout)
                 dicomImg = readDicomFromBuffer(data)
                 # Convert pixel data to a numpy.ndarray internally.
                 # Note: the conversion cause error in pickle encoding
                 # dicomImg.convert_pixel_data()
-                self.streamInfo.imgIndex = imageIndex + 1
-                if self.streamInfo.anonymize is True:
+                if streamInfo.repetitionTime is None:
+                    self._setStreamRepetitionTime(streamInfo, dicomImg)
+                if streamInfo.anonymize is True:
                     dicomImg = anonymizeDicom(dicomImg)
                 return dicomImg
             except TimeoutError as err:
@@ -175,7 +298,45 @@ class DataInterface(RemoteableExtensible):
                 errMsg = f"getImageData Error, filename {filename} err: {err}"
                 logging.error(errMsg)
                 raise RequestError(errMsg)
-        raise RequestError(f"getImageData: Dicom file {self.streamInfo.imgDir}/{filename} not found or corrupted")
+        return None
+
+    def subscribeScannerStream(self, streamId: int, startIndex: int=0,
+                               maxBuffered: int=defaultMaxBuffered) -> None:
+        """
+        Have the remote service push each image of a stream to the projectServer as soon as
+        it is written, rather than waiting for each getImageData() request. The projectServer
+        buffers the images so getImageData() returns immediately once its image has arrived.
+        Only has an effect when the DataInterface is remote.
+
+        Args:
+            streamId: Id of a stream opened with initScannerStream()
+            startIndex: Index of the first image to push
+            maxBuffered: Max number of received images the projectServer keeps
+        """
+        return None
+
+    def scannerStreamGenerator(self, streamId: int, startIndex: int=0):
+        """
+        Yields (imageIndex, dicomImg) for each image of a stream as it is written, starting
+        at startIndex. Yields None when no image arrives within subscriptionPollSeconds.
+        Ends when the stream is closed. Run at the remote service for subscribeScannerStream().
+        The stream's own position (used by getImageData() without an imageIndex) is unchanged.
+        """
+        if streamId not in self.streams:
+            raise ValidationError(f"StreamID {streamId} not open, open streams {list(self.streams.keys())}")
+        imageIndex = startIndex
+        while True:
+            streamInfo = self.streams.get(streamId)
+            if streamInfo is None:
+                # the stream was closed
+                return
+            dicomImg = self._readStreamImage(streamInfo, imageIndex, subscriptionPollSeconds)
+            if dicomImg is None:
+                yield None
+                continue
+            self._recordArrivalLatency(streamInfo, imageIndex)
+            yield (imageIndex, dicomImg)
+            imageIndex += 1
 
     def getFile(self, filename: str) -> bytes:
         """Returns a file's data immediately or fails if the file doesn't exist."""
@@ -194,6 +355,167 @@ class DataInterface(RemoteableExtensible):
         #     data = data.decode(encoding)
         return data
 
+    def getFiles(self, files: Union[str, List[str]], maxSize: int=bulkArchiveSize,
+                 maxFileSize: int=streamMinFileSize) -> bytes:
+        """
+        Returns many files in one archive (see fileArchive.py), rather than with a
+        getFile() call per file. The files are added in order until the archive
+        reaches maxSize, call again with the remaining files to get the rest.
+
+        Args:
+            files: A list of filenames, or a file pattern as for listFiles()
+            maxSize: Max size of the archive, at least one file is always included
+            maxFileSize: Files of at least this size aren't included, their member
+                has flag MemberTooLarge and gives the file size, so they can be
+                transferred separately (e.g. with streamGetFile())
+        Returns:
+            The archive, its members are in the order of the files
+        """
+        if isinstance(files, str):
+            files = self.listFiles(files)
+        writer = FileArchiveWriter()
+        for filename in files:
+            if writer.numMembers > 0 and writer.size >= maxSize:
+                break
+            fileDir, fileCheck = os.path.split(filename)
+            self._checkAllowedDirs(fileDir)
+            self._checkAllowedFileTypes(fileCheck)
+            if os.path.isdir(filename):
+                writer.addFile(filename, b'IsADirectoryError', flags=MemberSkipped)
+                continue
+            if not os.path.exists(filename):
+                raise FileNotFoundError(f'File not found {filename}')
+            fileSize = os.path.getsize(filename)
+            if fileSize >= maxFileSize:
+                writer.addFile(filename, b'', flags=MemberTooLarge, size=fileSize)
+                continue
+            if writer.numMembers > 0 and writer.size + fileSize > maxSize:
+                break
+            with open(filename, 'rb') as fp:
+                writer.addFile(filename, fp.read())
+        return writer.getArchive()
+
+    def getFileStat(self, filename: str) -> List[int]:
+        """Returns [modification time in ns, size in bytes] of a file"""
+        fileDir, fileCheck = os.path.split(filename)
+        self._checkAllowedDirs(fileDir)
+        self._checkAllowedFileTypes(fileCheck)
+        fileStat = os.stat(filename)
+        return [fileStat.st_mtime_ns, fileStat.st_size]
+
+    def getFileSignature(self, filename: str, blockSize: int=None) -> bytes:
+        """
+        Returns the block signature of a file, used by the caller to compute a delta of
+        its version of the file to send with putFileDelta().
+        Args:
+            filename: Name of the file
+            blockSize: Block size of the signature, chosen from the file size if None
+        """
+        data = self.getFile(filename)
+        return computeSignature(data, blockSize)
+
+    def getFileDelta(self, filename: str, signature: bytes) -> bytes:
+        """
+        Returns the delta of a file relative to the caller's copy of the file, so that only
+        the changed blocks are transferred. The caller rebuilds the file with
+        deltaSync.applyDelta().
+        Args:
+            filename: Name of the file
+            signature: Block signature of the caller's copy (deltaSync.computeSignature())
+        """
+        data = self.getFile(filename)
+        return computeDelta(data, signature)
+
+    def putFileDelta(self, filename: str, delta: bytes) -> None:
+        """
+        Update an existing file from a delta computed with the signature returned
+        by getFileSignature().
+        Args:
+            filename: Name of the file to update
+            delta: The delta (deltaSync.computeDelta())
+        """
+        baseData = self.getFile(filename)
+        # raises ValidationError if the file changed since the signature was taken
+        data = applyDelta(baseData, delta)
+        self.putFile(filename, data)
+
+    def getFileChunk(self, filename: str, offset: int, length: int) -> bytes:
+        """
+        Returns up to length bytes of a file starting at offset, used to stream
+        large files (see streamGetFile()).
+        """
+        fileDir, fileCheck = os.path.split(filename)
+        self._checkAllowedDirs(fileDir)
+        self._checkAllowedFileTypes(fileCheck)
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f'File not found {filename}')
+        with open(filename, 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(length)
+
+    def putFileChunk(self, filename: str, offset: int, data: bytes) -> str:
+        """
+        Writes a chunk of a streamed file at offset within the file's partial file, any
+        data after the chunk is discarded. The file is created from the partial file by
+        commitPartialFile() (see streamPutFile()).
+        Args:
+            filename: Name of the file being streamed
+            offset: Offset of the chunk in the file, 0 starts a new partial file
+            data: The chunk data
+        Returns:
+            The md5 hash of the data written
+        """
+        fileDir, fileCheck = os.path.split(filename)
+        self._checkAllowedDirs(fileDir)
+        self._checkAllowedFileTypes(fileCheck)
+        partialFilename = filename + partialFileSuffix
+        if offset == 0:
+            if fileDir != '':
+                os.makedirs(fileDir, exist_ok=True)
+            mode = 'wb'
+        else:
+            if not os.path.exists(partialFilename) or os.path.getsize(partialFilename) < offset:
+                raise ValidationError(f'putFileChunk: offset {offset} is past the end of '
+                                      f'the partial file {partialFilename}')
+            mode = 'r+b'
+        with open(partialFilename, mode) as fp:
+            fp.seek(offset)
+            fp.write(data)
+            fp.truncate()
+        return hashlib.md5(data).hexdigest()
+
+    def getPartialFileChunkHashes(self, filename: str, chunkSize: int) -> List[str]:
+        """
+        Returns the md5 hashes of the full chunks in the partial file of a streamed file,
+        used to resume an interrupted streamPutFile() after the last matching chunk.
+        """
+        fileDir, fileCheck = os.path.split(filename)
+        self._checkAllowedDirs(fileDir)
+        self._checkAllowedFileTypes(fileCheck)
+        partialFilename = filename + partialFileSuffix
+        if not os.path.exists(partialFilename):
+            return []
+        return fileChunkHashes(partialFilename, chunkSize)
+
+    def commitPartialFile(self, filename: str, size: int) -> None:
+        """
+        Atomically replaces the file with its completed partial file.
+        Args:
+            filename: Name of the streamed file
+            size: Expected size of the file
+        """
+        fileDir, fileCheck = os.path.split(filename)
+        self._checkAllowedDirs(fileDir)
+        self._checkAllowedFileTypes(fileCheck)
+        partialFilename = filename + partialFileSuffix
+        if not os.path.exists(partialFilename):
+            raise FileNotFoundError(f'File not found {partialFilename}')
+        partialSize = os.path.getsize(partialFilename)
+        if partialSize != size:
+            raise ValidationError(f'commitPartialFile: partial file size {partialSize} '
+                                  f'does not match expected size {size}')
+        os.replace(partialFilename, filename)
+
     def getNewestFile(self, filepattern: str) -> bytes:
         """Searches for files matching filePattern and returns the data from the newest one."""
         data = None
@@ -230,13 +552,9 @@ class DataInterface(RemoteableExtensible):
         self._checkAllowedDirs(dir)
         self._checkAllowedFileTypes(filePattern)
         self.fileWatchLock.acquire()
-        if self.initWatchSet is True:
-            # Stop the previous watch to start a new one
-            assert self.fileWatcher is not None
-            self.fileWatcher.__del__()
-            self.fileWatcher = FileWatcher()
         self.initWatchSet = False
         try:
+            # replaces the previous initWatch() watch, the scanner stream watches are unchanged
             self.fileWatcher.initFileNotifier(dir, filePattern, minFileSize, demoStep)
             self.watchDir = dir
             self.initWatchSet = True
@@ -269,11 +587,7 @@ class DataInterface(RemoteableExtensible):
             self._checkAllowedDirs(fileDir)
         self._checkAllowedFileTypes(fileCheck)
 
-        self.fileWatchLock.acquire()
-        try:
-            foundFilename = self.fileWatcher.waitForFile(filename, timeout=timeout, timeCheckIncrement=0.25)
-        finally:
-            self.fileWatchLock.release()
+        foundFilename = self.fileWatcher.waitForFile(filename, timeout=timeout, timeCheckIncrement=0.25)
         if foundFilename is None:
             raise TimeoutError("WatchFile: Timeout {}s: {}".format(timeout, filename))
         else:
@@ -281,6 +595,27 @@ class DataInterface(RemoteableExtensible):
                 data = fp.read()
         return data
 
+    def _watchStreamFile(self, streamInfo, filename: str, timeout: int=5) -> bytes:
+        """Same as watchFile() but waits on the file watch of a scanner stream"""
+        self._checkAllowedFileTypes(filename)
+        foundFilename = self.fileWatcher.waitForFile(filename, timeout=timeout, timeCheckIncrement=0.25,
+                                                     watchId=streamInfo.watchId)
+        if foundFilename is None:
+            raise TimeoutError("WatchFile: Timeout {}s: {}".format(timeout, filename))
+        with open(foundFilename, 'rb') as fp:
+            data = fp.read()
+        return data
+
+    def _setStreamRepetitionTime(self, streamInfo, dicomImg) -> None:
+        """Tell the file watcher the expected time between images, from the Dicom TR (ms)"""
+        repetitionTime = dicomImg.get('RepetitionTime')
+        try:
+            streamInfo.repetitionTime = float(repetitionTime) / 1000
+        except (TypeError, ValueError):
+            streamInfo.repetitionTime = 0
+        if streamInfo.repetitionTime > 0 and streamInfo.watchId in self.fileWatcher.watches:
+            self.fileWatcher.setArrivalInterval(streamInfo.repetitionTime, streamInfo.watchId)
+
     def putFile(self, filename: str, data: Union[str, bytes], compress: bool=False) -> None:
         """
         Create a file (filename) and write the bytes or text to it. 
@@ -309,6 +644,28 @@ class DataInterface(RemoteableExtensible):
             binFile.write(data)
         return
 
+    def putFiles(self, archive: bytes) -> List[str]:
+        """
+        Write the files of an archive (see fileArchive.py) made with packFileArchive(),
+        each member's filename is the name of the file to write. The files are written
+        as the archive is unpacked, after checking the md5 of each.
+        Returns:
+            The list of files written
+        """
+        written = []
+        for member in iterFileArchive(archive):
+            if member.flags != MemberData:
+                continue
+            fileDir, fileCheck = os.path.split(member.filename)
+            self._checkAllowedDirs(fileDir)
+            self._checkAllowedFileTypes(fileCheck)
+            if fileDir != '' and not os.path.exists(fileDir):
+                os.makedirs(fileDir, exist_ok=True)
+            with open(member.filename, 'wb') as fp:
+                fp.write(member.data)
+            written.append(member.filename)
+        return written
+
     def listFiles(self, filepattern: str) -> List[str]:
         """Lists files matching the regex filePattern"""
         fileDir, fileCheck = os.path.split(filepattern)
@@ -369,6 +726,14 @@ class DataInterface(RemoteableExtensible):
         """Returns seconds since the epoch"""
         return time.time()
 
+    def getQueueMetrics(self) -> dict:
+        """
+        Returns the request queue metrics per lane of the remote data service, such as
+        the queue depth and average wait time (see RequestWorkerPool.getMetrics).
+        Returns None when the data isn't served by a remote service.
+        """
+        return getServiceQueueMetrics()
+
     def _checkAllowedDirs(self, dir: str) -> bool:
         if self.allowedDirs is None or len(self.allowedDirs) == 0:
             raise ValidationError('DataInterface: no allowed directories are set')
@@ -428,50 +793,240 @@ class DataInterface(RemoteableExtensible):
 #################################################################################
 ### Helper Function to upload and download sets of files from or to the cloud ###
 #################################################################################
-def uploadFilesFromList(dataInterface, fileList :List[str], outputDir :str, srcDirPrefix=None) -> None:
+def getFileWithDelta(dataInterface, filename :str, localFilename :str) -> bytes:
+    """
+    Returns the data of a remote file, if localFilename exists only the blocks which
+    differ from it are transferred.
+    """
+    if not os.path.exists(localFilename):
+        return dataInterface.getFile(filename)
+    with open(localFilename, 'rb') as fp:
+        localData = fp.read()
+    delta = dataInterface.getFileDelta(filename, computeSignature(localData))
+    try:
+        return applyDelta(localData, delta)
+    except ValidationError as err:
+        logging.warning(f'getFileWithDelta {filename}: delta failed, getting full file: {err}')
+        return dataInterface.getFile(filename)
+
+def putFileWithDelta(dataInterface, filename :str, data :bytes) -> None:
+    """
+    Writes data to a remote file, if the remote file exists only the blocks which
+    differ from it are transferred.
+    """
+    try:
+        signature = dataInterface.getFileSignature(filename)
+    except Exception as err:
+        if type(err) is FileNotFoundError or 'File not found' in str(err):
+            dataInterface.putFile(filename, data)
+            return
+        raise(err)
+    try:
+        dataInterface.putFileDelta(filename, computeDelta(data, signature))
+    except Exception as err:
+        # the remote file changed after its signature was taken
+        logging.warning(f'putFileWithDelta {filename}: delta failed, sending full file: {err}')
+        dataInterface.putFile(filename, data)
+
+def fileChunkHashes(filename :str, chunkSize :int) -> List[str]:
+    """Returns the md5 hashes of each full chunk of a file"""
+    hashes = []
+    with open(filename, 'rb') as fp:
+        while True:
+            data = fp.read(chunkSize)
+            if len(data) < chunkSize:
+                break
+            hashes.append(hashlib.md5(data).hexdigest())
+    return hashes
+
+def _writeResumeToken(tokenFilename, token):
+    tmpFilename = tokenFilename + '.tmp'
+    with open(tmpFilename, 'w') as fp:
+        json.dump(token, fp)
+    os.replace(tmpFilename, tokenFilename)
+
+def _readResumeToken(tokenFilename):
+    try:
+        with open(tokenFilename, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def streamGetFile(dataInterface, filename :str, localFilename :str, chunkSize=streamChunkSize) -> None:
+    """
+    Copies a remote file to localFilename a chunk at a time, without holding the file
+    in memory. The chunks are written to a partial file which is renamed to localFilename
+    when complete. A resume token (the transferred offset, the remote file's stat and the
+    hashes of the chunks written) is kept beside the partial file, so a transfer that was
+    interrupted resumes after the last chunk that still matches its hash.
+    """
+    mtime, size = dataInterface.getFileStat(filename)
+    partialFilename = localFilename + partialFileSuffix
+    tokenFilename = localFilename + resumeTokenSuffix
+    newToken = {'filename': filename, 'mtime': mtime, 'size': size,
+                'chunkSize': chunkSize, 'offset': 0, 'chunkHashes': []}
+    token = _readResumeToken(tokenFilename)
+    offset = 0
+    if (token is not None and os.path.exists(partialFilename) and
+            all(token.get(key) == newToken[key] for key in ('filename', 'mtime', 'size', 'chunkSize'))):
+        # resume after the chunks of the partial file which match the token
+        for partialHash, tokenHash in zip(fileChunkHashes(partialFilename, chunkSize), token['chunkHashes']):
+            if partialHash != tokenHash:
+                break
+            offset += chunkSize
+        token['chunkHashes'] = token['chunkHashes'][:offset // chunkSize]
+        logging.info(f'streamGetFile: resuming {filename} at offset {offset}')
+    else:
+        token = newToken
+    outputDir = os.path.dirname(localFilename)
+    if outputDir != '' and not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    with open(partialFilename, 'r+b' if offset > 0 else 'wb') as fp:
+        fp.seek(offset)
+        fp.truncate()
+        while offset < size:
+            length = min(chunkSize, size - offset)
+            data = dataInterface.getFileChunk(filename, offset, length)
+            if len(data) != length:
+                raise RequestError(f'streamGetFile: {filename} chunk at offset {offset} '
+                                   f'has size {len(data)}, expected {length}')
+            fp.write(data)
+            fp.flush()
+            offset += length
+            token['offset'] = offset
+            token['chunkHashes'].append(hashlib.md5(data).hexdigest())
+            _writeResumeToken(tokenFilename, token)
+    if dataInterface.getFileStat(filename) != [mtime, size]:
+        os.remove(partialFilename)
+        os.remove(tokenFilename)
+        raise RequestError(f'streamGetFile: {filename} changed during the transfer')
+    os.replace(partialFilename, localFilename)
+    if os.path.exists(tokenFilename):
+        os.remove(tokenFilename)
+
+def streamPutFile(dataInterface, localFilename :str, filename :str, chunkSize=streamChunkSize) -> None:
+    """
+    Copies localFilename to a remote file a chunk at a time, without holding the file
+    in memory. The remote writes the chunks to a partial file and verifies the hash of
+    each chunk, then atomically renames it to the file when complete. A transfer that
+    was interrupted resumes after the last chunk of the remote partial file which
+    matches the local file.
+    """
+    size = os.path.getsize(localFilename)
+    partialHashes = dataInterface.getPartialFileChunkHashes(filename, chunkSize)
+    with open(localFilename, 'rb') as fp:
+        offset = 0
+        for partialHash in partialHashes:
+            if hashlib.md5(fp.read(chunkSize)).hexdigest() != partialHash:
+                break
+            offset += chunkSize
+        # always rewrite the last chunk, which also discards any extra data in the partial file
+        offset = min(offset, max(0, (size - 1) // chunkSize * chunkSize))
+        if offset > 0:
+            logging.info(f'streamPutFile: resuming {filename} at offset {offset}')
+        fp.seek(offset)
+        while True:
+            data = fp.read(chunkSize)
+            writtenHash = dataInterface.putFileChunk(filename, offset, data)
+            if writtenHash != hashlib.md5(data).hexdigest():
+                raise RequestError(f'streamPutFile: {filename} chunk at offset {offset} '
+                                   'hash mismatch')
+            offset += len(data)
+            if offset >= size:
+                break
+    dataInterface.commitPartialFile(filename, size)
+
+def _outputFilename(file :str, outputDir :str, srcDirPrefix=None) -> str:
+    fileDir, filename = os.path.split(file)
+    if srcDirPrefix is not None and fileDir.startswith(srcDirPrefix):
+        # Get just the part of fileDir after the srcDirPrefix
+        subDir = fileDir.replace(srcDirPrefix, '')
+    else:
+        subDir = ''
+    return os.path.normpath(outputDir + '/' + subDir + '/' + filename)
+
+def uploadFilesFromList(dataInterface, fileList :List[str], outputDir :str, srcDirPrefix=None,
+                        deltaSync=False, streamMinSize=streamMinFileSize) -> None:
     """
     Copies files in fileList from the remote onto the system where this call is being made.
+    The files are fetched many at a time in archives with getFiles(). If deltaSync is True,
+    they are fetched one at a time and only the changed blocks of files which already exist
+    locally are transferred. Files of at least streamMinSize bytes are streamed to disk a
+    chunk at a time (see streamGetFile()).
     """
+    if not deltaSync:
+        remaining = list(fileList)
+        while len(remaining) > 0:
+            archive = dataInterface.getFiles(remaining, maxFileSize=streamMinSize)
+            numMembers = 0
+            # write each file as it is unpacked
+            for member in iterFileArchive(archive):
+                numMembers += 1
+                if member.flags == MemberSkipped:
+                    continue
+                outputFilename = _outputFilename(member.filename, outputDir, srcDirPrefix)
+                logging.info('upload: {} --> {}'.format(member.filename, outputFilename))
+                print('upload: {} --> {}'.format(member.filename, outputFilename))
+                if member.flags == MemberTooLarge:
+                    streamGetFile(dataInterface, member.filename, outputFilename)
+                else:
+                    utils.writeFile(outputFilename, member.data)
+            if numMembers == 0:
+                raise RequestError('uploadFilesFromList: getFiles returned no files')
+            remaining = remaining[numMembers:]
+        return
     for file in fileList:
-        fileDir, filename = os.path.split(file)
-        if srcDirPrefix is not None and fileDir.startswith(srcDirPrefix):
-            # Get just the part of fileDir after the srcDirPrefix
-            subDir = fileDir.replace(srcDirPrefix, '')
-        else:
-            subDir = ''
+        outputFilename = _outputFilename(file, outputDir, srcDirPrefix)
         try:
-            data = dataInterface.getFile(file)
+            _, fileSize = dataInterface.getFileStat(file)
+            if fileSize >= streamMinSize:
+                logging.info('upload: {} --> {}'.format(file, outputFilename))
+                print('upload: {} --> {}'.format(file, outputFilename))
+                streamGetFile(dataInterface, file, outputFilename)
+                continue
+            data = getFileWithDelta(dataInterface, file, outputFilename)
         except Exception as err:
             if type(err) is IsADirectoryError or 'IsADirectoryError' in str(err):
                 continue
             raise(err)
-        outputFilename = os.path.normpath(outputDir + '/' + subDir + '/' + filename)
         logging.info('upload: {} --> {}'.format(file, outputFilename))
         print('upload: {} --> {}'.format(file, outputFilename))
         utils.writeFile(outputFilename, data)
 
-def downloadFilesFromList(dataInterface, fileList :List[str], outputDir :str, srcDirPrefix=None) -> None:
+def downloadFilesFromList(dataInterface, fileList :List[str], outputDir :str, srcDirPrefix=None,
+                          deltaSync=False, streamMinSize=streamMinFileSize) -> None:
     """
     Copies files in fileList from this computer to the remote.
+    The files are sent many at a time in archives with putFiles(). If deltaSync is True,
+    they are sent one at a time and only the changed blocks of files which already exist
+    at the remote are transferred. Files of at least streamMinSize bytes are streamed from
+    disk a chunk at a time (see streamPutFile()).
     """
+    writer = FileArchiveWriter()
     for file in fileList:
         if os.path.isdir(file):
             continue
+        outputFilename = _outputFilename(file, outputDir, srcDirPrefix)
+        logging.info('download: {} --> {}'.format(file, outputFilename))
+        print('download: {} --> {}'.format(file, outputFilename))
+        fileSize = os.path.getsize(file)
+        if fileSize >= streamMinSize:
+            streamPutFile(dataInterface, file, outputFilename)
+            continue
+        if not deltaSync and writer.numMembers > 0 and writer.size + fileSize > bulkArchiveSize:
+            dataInterface.putFiles(writer.getArchive())
+            writer = FileArchiveWriter()
         with open(file, 'rb') as fp:
             data = fp.read()
-        fileDir, filename = os.path.split(file)
-        if srcDirPrefix is not None and fileDir.startswith(srcDirPrefix):
-            # Get just the part of fileDir after the srcDirPrefix
-            subDir = fileDir.replace(srcDirPrefix, '')
+        if deltaSync:
+            putFileWithDelta(dataInterface, outputFilename, data)
         else:
-            subDir = ''
-        outputFilename = os.path.normpath(outputDir + '/' + subDir + '/' + filename)
-        logging.info('download: {} --> {}'.format(file, outputFilename))
-        print('download: {} --> {}'.format(file, outputFilename))
-        dataInterface.putFile(outputFilename, data)
+            writer.addFile(outputFilename, data)
+    if writer.numMembers > 0:
+        dataInterface.putFiles(writer.getArchive())
     return
 
-def uploadFolderToCloud(dataInterface, srcDir :str, outputDir :str) -> None:
+def uploadFolderToCloud(dataInterface, srcDir :str, outputDir :str, deltaSync=False) -> None:
     """
     Copies a folder (directory) from the remote to the system where this call is run
     """
@@ -484,18 +1039,19 @@ def uploadFolderToCloud(dataInterface, srcDir :str, outputDir :str) -> None:
     # The src prefix is the part of the path to eliminate in the destination path
     # This will be everything except the last subdirectory in srcDir
     srcPrefix = os.path.dirname(srcDir)
-    uploadFilesFromList(dataInterface, fileList, outputDir, srcDirPrefix=srcPrefix)
+    uploadFilesFromList(dataInterface, fileList, outputDir, srcDirPrefix=srcPrefix, deltaSync=deltaSync)
 
-def uploadFilesToCloud(dataInterface, srcFilePattern :str, outputDir :str):
+def uploadFilesToCloud(dataInterface, srcFilePattern :str, outputDir :str, deltaSync=False):
     """
     Copies files matching (regex) srcFilePattern from the remote onto the system 
         where this call is being made.
     """
     # get the list of files to upload
     fileList = dataInterface.listFiles(srcFilePattern)
-    uploadFilesFromList(dataInterface, fileList, outputDir)
+    uploadFilesFromList(dataInterface, fileList, outputDir, deltaSync=deltaSync)
 
-def downloadFolderFromCloud(dataInterface, srcDir :str, outputDir :str, deleteAfter=False) -> None:
+def downloadFolderFromCloud(dataInterface, srcDir :str, outputDir :str, deleteAfter=False,
+                            deltaSync=False) -> None:
     """
     Copies a directory from the system where this call is made to the remote system.
     """
@@ -513,17 +1069,19 @@ def downloadFolderFromCloud(dataInterface, srcDir :str, outputDir :str, deleteAf
     # The src prefix is the part of the path to eliminate in the destination path
     # This will be everything except the last subdirectory in srcDir
     srcPrefix = os.path.dirname(srcDir)
-    downloadFilesFromList(dataInterface, filteredList, outputDir, srcDirPrefix=srcPrefix)
+    downloadFilesFromList(dataInterface, filteredList, outputDir, srcDirPrefix=srcPrefix,
+                          deltaSync=deltaSync)
     if deleteAfter:
         utils.deleteFilesFromList(filteredList)
 
-def downloadFilesFromCloud(dataInterface, srcFilePattern :str, outputDir :str, deleteAfter=False) -> None:
+def downloadFilesFromCloud(dataInterface, srcFilePattern :str, outputDir :str, deleteAfter=False,
+                           deltaSync=False) -> None:
     """
     Copies files matching srcFilePattern from the system where this call is made
         to the remote system.
     """
     fileList = [x for x in glob.iglob(srcFilePattern)]
-    downloadFilesFromList(dataInterface, fileList, outputDir)
+    downloadFilesFromList(dataInterface, fileList, outputDir, deltaSync=deltaSync)
     if deleteAfter:
         utils.deleteFilesFromList(fileList)
 
@@ -0,0 +1,176 @@
+"""
+rsync style delta transfer of files that are already mostly present at the receiver.
+
+The receiver computes a signature of its copy of a file, a weak rolling checksum and a
+strong hash of each block. The sender finds the blocks of its version which match a
+block of the receiver's copy, at any offset, and sends a delta made of references to
+the matching blocks and the literal data between them. The receiver rebuilds the file
+from its copy and the delta, and verifies the result with the file's md5 hash.
+
+Signatures and deltas are packed into bytes so they can be passed as a single
+bytes arg or result of an RPC call.
+    signature: header (blockSize, numBlocks), uint32 weak checksums, 8 byte strong hashes
+    delta: header (blockSize, size, md5, numOps), int64 ops, literal data
+An op >= 0 copies that block of the receiver's copy, an op < 0 copies -op bytes from
+the next position in the literal data.
+"""
+import math
+import struct
+import hashlib
+import numpy
+from rtCommon.errors import ValidationError
+
+minBlockSize = 2048
+maxBlockSize = 64 * 1024
+strongHashSize = 8
+# Number of file offsets to compute rolling checksums for at once (bounds memory use)
+checksumChunkSize = 2**20
+
+signatureHeader = struct.Struct('<II')
+deltaHeader = struct.Struct('<IQ16sQ')
+
+
+def chooseBlockSize(fileSize) -> int:
+    """Block size of about the square root of the file size, as used by rsync"""
+    blockSize = 2 ** int(math.log2(max(1, math.sqrt(fileSize))))
+    return min(maxBlockSize, max(minBlockSize, blockSize))
+
+
+def strongHash(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=strongHashSize).digest()
+
+
+def weakChecksums(data, blockSize, offsets=None):
+    """
+    Returns the weak (rolling) checksum of the block at each offset of the data.
+    Args:
+        data: bytes-like data
+        blockSize: block length
+        offsets: numpy array of block offsets, all offsets of a full block if None
+    Returns:
+        numpy int64 array of the checksums
+    """
+    x = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+    if offsets is None:
+        offsets = numpy.arange(max(0, len(x) - blockSize + 1))
+    if len(offsets) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    # A(k) = sum of the bytes in the block, B(k) = sum of (blockSize - i) * byte i,
+    #   both computed from prefix sums for all offsets at once
+    S = numpy.concatenate(([0], numpy.cumsum(x)))
+    T = numpy.concatenate(([0], numpy.cumsum(x * numpy.arange(len(x)))))
+    ends = offsets + blockSize
+    A = S[ends] - S[offsets]
+    B = (blockSize + offsets) * A - (T[ends] - T[offsets])
+    return (A & 0xffff) | ((B & 0xffff) << 16)
+
+
+def computeSignature(data, blockSize=None) -> bytes:
+    """
+    Compute the block signature of the receiver's copy of a file.
+    Args:
+        data: the receiver's copy of the file
+        blockSize: block size to use, chosen from the data size if None
+    Returns:
+        The packed signature
+    """
+    if blockSize is None:
+        blockSize = chooseBlockSize(len(data))
+    numBlocks = len(data) // blockSize
+    view = memoryview(data)
+    # checksum the blocks a chunk at a time (bounds memory use)
+    blocksPerChunk = max(1, checksumChunkSize // blockSize)
+    weak = []
+    for startBlock in range(0, numBlocks, blocksPerChunk):
+        endBlock = min(numBlocks, startBlock + blocksPerChunk)
+        offsets = numpy.arange(endBlock - startBlock) * blockSize
+        chunk = view[startBlock * blockSize:endBlock * blockSize]
+        weak.append(weakChecksums(chunk, blockSize, offsets).astype('<u4'))
+    weak = numpy.concatenate(weak) if weak else numpy.zeros(0, dtype='<u4')
+    strong = [strongHash(view[i * blockSize:(i + 1) * blockSize]) for i in range(numBlocks)]
+    return signatureHeader.pack(blockSize, numBlocks) + weak.tobytes() + b''.join(strong)
+
+
+def computeDelta(data, signature: bytes) -> bytes:
+    """
+    Compute the delta to rebuild data at the receiver from its copy with the given signature.
+    Returns:
+        The packed delta
+    """
+    blockSize, numBlocks = signatureHeader.unpack_from(signature)
+    weakStart = signatureHeader.size
+    strongStart = weakStart + 4 * numBlocks
+    if len(signature) != strongStart + strongHashSize * numBlocks:
+        raise ValidationError('computeDelta: invalid signature length')
+    sigWeak = numpy.frombuffer(signature, dtype='<u4', count=numBlocks, offset=weakStart)
+    # map from weak checksum to the strong hashes and indices of the blocks with it
+    blockTable = {}
+    for index, weak in enumerate(sigWeak.tolist()):
+        pos = strongStart + index * strongHashSize
+        blockTable.setdefault(weak, {}).setdefault(signature[pos:pos + strongHashSize], index)
+    sigWeak = numpy.array(list(blockTable.keys()), dtype=numpy.int64)
+
+    # offsets whose weak checksum matches some block, found a chunk at a time
+    view = memoryview(data)
+    candidates = [numpy.zeros(0, dtype=numpy.int64)]
+    candidateWeak = [numpy.zeros(0, dtype=numpy.int64)]
+    numOffsets = max(0, len(data) - blockSize + 1) if numBlocks > 0 else 0
+    for start in range(0, numOffsets, checksumChunkSize):
+        end = min(numOffsets, start + checksumChunkSize)
+        weak = weakChecksums(view[start:end + blockSize - 1], blockSize)
+        matches = numpy.nonzero(numpy.isin(weak, sigWeak))[0]
+        candidates.append(matches + start)
+        candidateWeak.append(weak[matches])
+    candidates = numpy.concatenate(candidates)
+    candidateWeak = numpy.concatenate(candidateWeak)
+
+    ops = []
+    literals = []
+    literalStart = 0
+    i = 0
+    while i < len(candidates):
+        offset = int(candidates[i])
+        block = view[offset:offset + blockSize]
+        index = blockTable[int(candidateWeak[i])].get(strongHash(block))
+        if index is None:
+            i += 1
+            continue
+        if offset > literalStart:
+            literals.append(view[literalStart:offset])
+            ops.append(literalStart - offset)
+        ops.append(index)
+        literalStart = offset + blockSize
+        # skip the candidates within the matched block
+        i = int(numpy.searchsorted(candidates, literalStart))
+    if literalStart < len(data):
+        literals.append(view[literalStart:])
+        ops.append(literalStart - len(data))
+    header = deltaHeader.pack(blockSize, len(data), hashlib.md5(data).digest(), len(ops))
+    return header + numpy.array(ops, dtype='<i8').tobytes() + b''.join(literals)
+
+
+def applyDelta(baseData, delta: bytes) -> bytes:
+    """Rebuild the sender's data from the receiver's copy (baseData) and a delta"""
+    blockSize, size, md5, numOps = deltaHeader.unpack_from(delta)
+    ops = numpy.frombuffer(delta, dtype='<i8', count=numOps, offset=deltaHeader.size)
+    literals = memoryview(delta)[deltaHeader.size + 8 * numOps:]
+    base = memoryview(baseData)
+    parts = []
+    literalPos = 0
+    for op in ops.tolist():
+        if op >= 0:
+            parts.append(base[op * blockSize:(op + 1) * blockSize])
+        else:
+            parts.append(literals[literalPos:literalPos - op])
+            literalPos -= op
+    data = b''.join(parts)
+    if len(data) != size or hashlib.md5(data).digest() != md5:
+        raise ValidationError('applyDelta: rebuilt data does not match, '
+                              'the base data may have changed')
+    return data
+
+
+def deltaLiteralSize(delta: bytes) -> int:
+    """Number of bytes of literal (changed) data in a delta"""
+    _, _, _, numOps = deltaHeader.unpack_from(delta)
+    return len(delta) - deltaHeader.size - 8 * numOps
@@ -36,6 +36,11 @@ class VersionError(RTError):
     pass
 
 
+class SubscriptionMissError(RTError):
+    """Requested stream data won't arrive through a subscription, request it directly"""
+    pass
+
+
 class MissedDeadlineError(RTError):
     """Server missed a deadline"""
     pass
@@ -0,0 +1,96 @@
+"""
+A simple archive format used to transfer many files in one RPC call, see
+DataInterface.getFiles() and putFiles().
+
+An archive is a header followed by its members, each member is a header, the member's
+filename and its data:
+    archive header: magic, version, numMembers
+    member header: nameLength, dataSize, flags, md5 of the data
+The md5 of each member is verified when the archive is unpacked. Members are returned
+as memoryviews into the archive so they can be written out as they are unpacked
+without copying.
+"""
+import struct
+import hashlib
+from typing import List, Tuple
+from rtCommon.errors import ValidationError
+
+archiveMagic = b'RTAR'
+archiveVersion = 1
+archiveHeader = struct.Struct('<4sHI')
+memberHeader = struct.Struct('<IQB16s')
+
+# Member flags
+MemberData = 0
+# The file was larger than the archive's max member size, dataSize is the file size
+#   and the data is omitted, the file should be transferred separately
+MemberTooLarge = 1
+# The file wasn't included, such as a directory, the data is the reason
+MemberSkipped = 2
+
+
+class ArchiveMember:
+    def __init__(self, filename, flags, size, data):
+        self.filename = filename
+        self.flags = flags
+        # size of the file, the data length unless the member is MemberTooLarge
+        self.size = size
+        self.data = data
+
+
+class FileArchiveWriter:
+    """Builds an archive a member at a time"""
+    def __init__(self):
+        self.parts = [b'']
+        self.numMembers = 0
+        self.size = archiveHeader.size
+
+    def addFile(self, filename: str, data, flags=MemberData, size=None) -> None:
+        name = filename.encode()
+        if size is None:
+            size = len(data)
+        header = memberHeader.pack(len(name), size, flags, hashlib.md5(data).digest())
+        self.parts.extend([header, name, data])
+        self.numMembers += 1
+        self.size += len(header) + len(name) + len(data)
+
+    def getArchive(self) -> bytes:
+        self.parts[0] = archiveHeader.pack(archiveMagic, archiveVersion, self.numMembers)
+        return b''.join(self.parts)
+
+
+def packFileArchive(files: List[Tuple[str, bytes]]) -> bytes:
+    """Pack a list of (filename, data) into an archive"""
+    writer = FileArchiveWriter()
+    for filename, data in files:
+        writer.addFile(filename, data)
+    return writer.getArchive()
+
+
+def iterFileArchive(archive):
+    """
+    Yields the ArchiveMembers of an archive in order, verifying each member's md5.
+    Raises ValidationError if the archive is invalid or a member is corrupted.
+    """
+    view = memoryview(archive)
+    if len(view) < archiveHeader.size:
+        raise ValidationError('iterFileArchive: archive is truncated')
+    magic, version, numMembers = archiveHeader.unpack_from(view)
+    if magic != archiveMagic or version != archiveVersion:
+        raise ValidationError(f'iterFileArchive: unknown archive format {magic} {version}')
+    offset = archiveHeader.size
+    for _ in range(numMembers):
+        if offset + memberHeader.size > len(view):
+            raise ValidationError('iterFileArchive: archive is truncated')
+        nameLength, size, flags, md5 = memberHeader.unpack_from(view, offset)
+        offset += memberHeader.size
+        filename = bytes(view[offset:offset + nameLength]).decode()
+        offset += nameLength
+        dataLength = 0 if flags == MemberTooLarge else size
+        data = view[offset:offset + dataLength]
+        offset += dataLength
+        if len(data) != dataLength:
+            raise ValidationError(f'iterFileArchive: member {filename} is truncated')
+        if hashlib.md5(data).digest() != md5:
+            raise ValidationError(f'iterFileArchive: member {filename} checksum mismatch')
+        yield ArchiveMember(filename, flags, size, data)
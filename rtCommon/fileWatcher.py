@@ -1,6 +1,17 @@
 """
 FileWatcher implements a class that watches for files to be created in a directory and then
-returns the notification that the files is now available.
+returns the notification that the files is now available. A FileWatcher can have several
+watches, each on a (directory, filePattern), so that several streams of files (such as
+the echoes of a multi-echo scan) can be waited on at once.
+
+The notifier thread records each file event in the watch's arrival index, a map from
+filename to the (arrivalTime, size) of the file. Waiting for a file is a lookup in the
+index, so files which arrive early or out of order (e.g. TR 8 while waiting for TR 7)
+are found immediately when later waited for, rather than by a periodic directory check.
+
+Where file events aren't available (inotify fails in some Docker hosts, NFS/SMB scanner
+shares don't deliver events) a PollingRouter fills the same arrival index from periodic
+os.scandir snapshots of the watched directories.
 
 The FileWatcher class is a virtual class of sorts with two underlying implementations, one
 for Mac and Windows (WatchdogFileWatcher) and one for Linux (InotifyFileWatcher).
@@ -11,16 +22,28 @@ import time
 import pathlib
 import logging
 import threading
-from typing import Optional
-from queue import Queue, Empty
+from typing import Optional, Tuple
+from collections import OrderedDict
 from watchdog.events import PatternMatchingEventHandler  # type: ignore
 from rtCommon.utils import DebugLevels, demoDelay
 from rtCommon.errors import StateError
 
+# Max number of file arrivals remembered per watch, the oldest are removed
+maxArrivals = 4096
+# Seconds between directory polls of the PollingRouter, see PollingRouter.nextPollDelay()
+minPollInterval = 0.05
+defaultPollInterval = 0.25
+maxPollInterval = 2.0
+
 
 class FileWatcher():
     """Virtual class to watch for the arrival of new files and notify."""
-    def __new__(cls):
+    def __new__(cls, usePolling=False):
+        if usePolling:
+            # poll directories, e.g. for network file systems which don't deliver file events
+            newcls = PollingFileWatcher.__new__(PollingFileWatcher)
+            newcls.__init__()
+            return newcls
         if sys.platform in ("linux", "linux2"):
             # create linux version
             newcls = InotifyFileWatcher.__new__(InotifyFileWatcher)
@@ -36,7 +59,7 @@ class FileWatcher():
             logging.log(logging.ERROR, "Unsupported os type %s" % (sys.platform))
             return None
 
-    def __init__(self):
+    def __init__(self, usePolling=False):
         logging.log(logging.ERROR, "FileWatcher is abstract class. __init__ not implemented")
 
     def __del__(self):
@@ -46,43 +69,132 @@ class FileWatcher():
         logging.log(logging.ERROR, "FileWatcher is abstract class. initFileNotifier not implemented")
         return None
 
-    def waitForFile(self, filename, timeout=0, timeCheckIncrement=1):
+    def addWatch(self, dir, filePattern, minFileSize, demoStep=0):
+        logging.log(logging.ERROR, "FileWatcher is abstract class. addWatch not implemented")
+        return None
+
+    def removeWatch(self, watchId):
+        logging.log(logging.ERROR, "FileWatcher is abstract class. removeWatch not implemented")
+
+    def setArrivalInterval(self, seconds, watchId=None):
+        logging.log(logging.ERROR, "FileWatcher is abstract class. setArrivalInterval not implemented")
+
+    def waitForFile(self, filename, timeout=0, timeCheckIncrement=1, watchId=None):
         logging.log(logging.ERROR, "FileWatcher is abstract class. waitForFile not implemented")
         return ''
 
 
-if sys.platform in ("darwin", "win32"):
-    from watchdog.observers import Observer  # type: ignore
+class FileWatch():
+    """
+    One (directory, filePattern) watch of a FileWatcher. The notifier thread records the
+    files arriving in the watch's arrival index, so several watches can be waited on at once.
+    """
+    def __init__(self, watchId, dir, filePattern, minFileSize, demoStep=0):
+        if filePattern is None or filePattern == '':
+            filePattern = '*'
+        self.watchId = watchId
+        self.watchDir = dir
+        self.realDir = os.path.realpath(dir)
+        self.filePattern = filePattern
+        self.minFileSize = minFileSize
+        self.demoStep = demoStep
+        self.prevEventTime = 0
+        # map from filename (without the path) to its (arrivalTime, size)
+        self.arrivals = OrderedDict()  # type: OrderedDict
+        self.arrivalCond = threading.Condition()
+        self.foundWithFileEvent = False
+        self.waitLoopCount = 0
+        self.arrivalTime = None
+        # expected seconds between file arrivals (e.g. the TR), used to schedule polling
+        self.expectedInterval = None
+        # number of threads in waitForArrival(), and function called when a wait starts
+        self.numWaiting = 0
+        self.waitStartedFunc = None
+
+    def matches(self, filename) -> bool:
+        return pathlib.Path(filename).match(self.filePattern)
+
+    def fullPath(self, filename) -> str:
+        """Returns the path of a file in the watch directory"""
+        _filedir, _filename = os.path.split(filename)
+        if _filedir in (None, ''):
+            return os.path.join(self.watchDir, filename)
+        elif _filedir != self.watchDir:
+            raise StateError(f"FileWatcher: file path doesn't match watch directory: {_filedir}, {self.watchDir}")
+        return filename
 
+    def recordArrival(self, filename, arrivalTime, size=None):
+        """Called from the notifier thread when a file event occurs in the watch directory"""
+        if size is None:
+            try:
+                size = os.path.getsize(os.path.join(self.realDir, filename))
+            except OSError:
+                # e.g. the file was already removed
+                return
+        with self.arrivalCond:
+            # move a re-written file to the end, so the oldest arrivals are removed first
+            self.arrivals.pop(filename, None)
+            self.arrivals[filename] = (arrivalTime, size)
+            while len(self.arrivals) > maxArrivals:
+                self.arrivals.popitem(last=False)
+            self.arrivalCond.notify_all()
+
+    def getArrival(self, filename) -> Optional[Tuple[float, int]]:
+        """Returns the (arrivalTime, size) of a file recorded by the notifier, or None"""
+        with self.arrivalCond:
+            return self.arrivals.get(os.path.basename(filename))
+
+    def waitForArrival(self, filename, timeout) -> Optional[Tuple[float, int]]:
+        """Wait up to timeout seconds for a file event, returns the file's (arrivalTime, size)"""
+        filename = os.path.basename(filename)
+        with self.arrivalCond:
+            if filename in self.arrivals:
+                return self.arrivals[filename]
+            self.numWaiting += 1
+        try:
+            if self.waitStartedFunc is not None:
+                self.waitStartedFunc()
+            with self.arrivalCond:
+                self.arrivalCond.wait_for(lambda: filename in self.arrivals, timeout=timeout)
+                return self.arrivals.get(filename)
+        finally:
+            with self.arrivalCond:
+                self.numWaiting -= 1
+
+    def forgetArrival(self, filename):
+        with self.arrivalCond:
+            self.arrivals.pop(os.path.basename(filename), None)
+
+
+class _MultiWatchFileWatcher():
+    """
+    The watch registration shared by the FileWatcher implementations. Any number of
+    watches can be added, initFileNotifier() sets a default watch used when waitForFile()
+    is called without a watchId.
+    """
+    # Seconds to wait after a file event before reading the file, for notifiers which
+    #   signal on file creation rather than once the file is closed
+    eventSettleTime = 0.0
 
-# Version of FileWatcher for Mac and Windows
-class WatchdogFileWatcher():
-    """Version of FileWatcher for Mac and Windows using Watchdog toolkit."""
     def __init__(self):
-        self.observer = None
-        self.fileNotifyHandler = None
-        self.fileNotifyQ = Queue()  # type: None
-        self.filePattern = None
+        self.watches = {}
+        self.nextWatchId = 1
+        self.defaultWatchId = None
+        self.watchLock = threading.Lock()
         self.watchDir = None
+        self.filePattern = None
         self.minFileSize = 0
         self.demoStep = 0
-        self.prevEventTime = 0
         self.foundWithFileEvent = False
         self.waitLoopCount = 0
-
-    def __del__(self):
-        if self.observer is not None:
-            try:
-                self.observer.stop()
-                self.observer.join()
-            except Exception as err:
-                # TODO - change back to log once can figure out what the observer.stop streamRef error is
-                print("FileWatcher: oberver.stop(): %s", str(err))
+        # notifier time the last file waited for arrived, None if found without an event
+        self.fileArrivalTime = None
 
     def initFileNotifier(self, dir: str, filePattern: str, minFileSize: int, demoStep: int=0) -> None:
         """
         Initialize the file watcher to watch in the specified directory for the specified
-        regex-based filepattern.
+        regex-based filepattern. This replaces the default watch, other watches added
+        with addWatch() are unchanged.
 
         Args:
             dir (str): Directory to watch in
@@ -94,125 +206,226 @@ class WatchdogFileWatcher():
                 This is used when the image files are pre-existing but we want to simulate as if
                 the arrive from the scanner every few seconds (demoStep seconds).
         """
-        self.demoStep = demoStep
-        self.minFileSize = minFileSize
-        if self.observer is not None:
-            self.observer.stop()
-            self.observer.join()
-        self.observer = Observer()
-        if filePattern is None or filePattern == '':
-            filePattern = '*'
-        self.filePattern = filePattern
+        watchId = self.addWatch(dir, filePattern, minFileSize, demoStep)
+        if self.defaultWatchId is not None:
+            self.removeWatch(self.defaultWatchId)
+        self.defaultWatchId = watchId
         self.watchDir = dir
-        self.fileNotifyHandler = FileNotifyHandler(self.fileNotifyQ, [filePattern])
-        self.observer.schedule(self.fileNotifyHandler, os.path.realpath(dir), recursive=False)
-        self.observer.start()
-
+        self.filePattern = filePattern
+        self.minFileSize = minFileSize
+        self.demoStep = demoStep
 
-    def waitForFile(self, filename: str, timeout: int=0, timeCheckIncrement: int=1) -> Optional[str]:
+    def addWatch(self, dir: str, filePattern: str, minFileSize: int, demoStep: int=0) -> int:
+        """
+        Add a watch for files matching filePattern in a directory, the arguments are as
+        for initFileNotifier().
+        Returns:
+            The watchId to pass to waitForFile() and removeWatch()
+        """
+        if dir is None:
+            raise StateError('addWatch: dir is None')
+        if not os.path.exists(dir):
+            raise NotADirectoryError("No such directory: %s" % (dir))
+        with self.watchLock:
+            watch = FileWatch(self.nextWatchId, dir, filePattern, minFileSize, demoStep)
+            self.nextWatchId += 1
+            self._startWatch(watch)
+            self.watches[watch.watchId] = watch
+        return watch.watchId
+
+    def removeWatch(self, watchId: int) -> None:
+        """Stop a watch added with addWatch()"""
+        with self.watchLock:
+            watch = self.watches.pop(watchId, None)
+            if watch is not None:
+                self._stopWatch(watch)
+            if watchId == self.defaultWatchId:
+                self.defaultWatchId = None
+
+    def removeAllWatches(self):
+        for watchId in list(self.watches.keys()):
+            self.removeWatch(watchId)
+
+    def getWatch(self, watchId=None) -> FileWatch:
+        if watchId is None:
+            watchId = self.defaultWatchId
+        watch = self.watches.get(watchId)
+        if watch is None:
+            raise StateError(f'FileWatcher: no watch {watchId}, call initFileNotifier or addWatch')
+        return watch
+
+    def waitForFile(self, filename: str, timeout: int=0, timeCheckIncrement: int=1,
+                    watchId: int=None) -> Optional[str]:
         """
-        Wait for a specific filename to be created in the directory specified in initFileNotifier.
+        Wait for a specific filename to be created in the directory of a watch.
 
         Args:
-            filename: Name of File to watch for creation of. If filename includes a path it must 
-                match that specified in initFileNotifier.
+            filename: Name of File to watch for creation of. If filename includes a path it must
+                match the directory of the watch.
             timeout: Max number of seconds to watch for the file creation. If timeout expires
                 before the file is created then None will be returned
             timeCheckIncrement: Time interval (secs) to check if file exists in case file
                 creation events are somehow missed.
+            watchId: The watch to wait on, the watch set by initFileNotifier() if None
         Returns:
             The filename of the created file (same as input arg) or None if timeout expires
         """
-        _filedir, _filename = os.path.split(filename)
-        if _filedir in (None, ''):
-            filename = os.path.join(self.watchDir, filename)
-        elif _filedir != self.watchDir:
-            raise StateError(f"FileWatcher: file path doesn't match watch directory: {_filedir}, {self.watchDir}")
+        watch = self.getWatch(watchId)
+        filename = watch.fullPath(filename)
+        # Several threads can wait on a watch at once (e.g. a read-ahead thread and a
+        #   request for an earlier file), the wait stats are those of the last wait to end
+        result = self._waitForFile(watch, filename, timeout, timeCheckIncrement)
+        self.foundWithFileEvent = watch.foundWithFileEvent
+        self.waitLoopCount = watch.waitLoopCount
+        self.fileArrivalTime = watch.arrivalTime
+        return result
+
+    def setArrivalInterval(self, seconds: float, watchId: int=None) -> None:
+        """
+        Set the expected seconds between file arrivals of a watch, such as the TR for
+        scanner images. A polling watcher polls more often around the expected arrivals.
+        """
+        watch = self.getWatch(watchId)
+        watch.expectedInterval = seconds
+        if watch.waitStartedFunc is not None:
+            watch.waitStartedFunc()
 
-        fileExists = os.path.exists(filename)
-        if not fileExists:
-            if self.observer is None:
-                raise FileNotFoundError("No fileNotifier and dicom file not found %s" % (filename))
-            else:
-                logStr = "FileWatcher: Waiting for file {}, timeout {}s ".format(filename, timeout)
-                logging.log(DebugLevels.L6, logStr)
+    def getFileArrival(self, filename: str, watchId: int=None) -> Optional[Tuple[float, int]]:
+        """
+        Returns the (arrivalTime, size) recorded when the notifier saw the file written,
+        or None if no event for the file was seen. Used for latency accounting.
+        """
+        watch = self.getWatch(watchId)
+        return watch.getArrival(watch.fullPath(filename))
+
+    def _hasNotifier(self) -> bool:
+        return True
+
+    def _fileExists(self, watch, filename) -> bool:
+        return os.path.exists(filename)
+
+    def _waitForFile(self, watch, filename, timeout, timeCheckIncrement):
         eventLoopCount = 0
-        self.foundWithFileEvent = False
-        eventTimeStamp = 0
+        watch.foundWithFileEvent = False
+        watch.arrivalTime = None
+        watch.waitLoopCount = 0
         startTime = time.time()
-        self.waitLoopCount = 0
+        arrival = watch.getArrival(filename)
+        if arrival is not None and not os.path.exists(filename):
+            # the file was removed since it arrived, wait for it to be written again
+            watch.forgetArrival(filename)
+            arrival = None
+        fileExists = arrival is not None or self._fileExists(watch, filename)
+        if not fileExists:
+            if not self._hasNotifier():
+                raise FileNotFoundError("No fileNotifier and dicom file not found %s" % (filename))
+            logStr = "FileWatcher: Waiting for file {}, timeout {}s ".format(filename, timeout)
+            logging.log(DebugLevels.L6, logStr)
         while not fileExists:
-            self.waitLoopCount += 1
+            watch.waitLoopCount += 1
             if timeout > 0:
                 remainingTime = (startTime + timeout) - time.time()
                 if remainingTime <= 0:
                     return None
                 if remainingTime < timeCheckIncrement:
                     timeCheckIncrement = remainingTime
-            # look for file creation event
+            # wait for the file's arrival to be recorded by the notifier thread
             eventLoopCount += 1
-            timeToCheckForFile = time.time() + timeCheckIncrement
-            try:
-                event, ts = self.fileNotifyQ.get(block=True, timeout=timeCheckIncrement)
-            except Empty:
-                # The timeout occured on fileNotifyQ.get()
-                fileExists = os.path.exists(filename)
-                continue
-            if event is None:
-                raise StateError('waitForFile: event is None')
-            # We may have a stale event from a previous file if multiple events
-            #   are created per file or if the previous file eventloop
-            #   timed out and then the event arrived later.
-            if os.path.realpath(event.src_path) == os.path.realpath(filename):
+            arrival = watch.waitForArrival(filename, timeCheckIncrement)
+            if arrival is not None:
                 fileExists = True
-                self.foundWithFileEvent = True
-                eventTimeStamp = ts
-                if event.event_type == 'created':
-                    # brief sleep after created event
-                    time.sleep(.05)
-                continue
-            if time.time() >= timeToCheckForFile:
-                # periodically check if file exists, can occur if we get
-                #   swamped with unrelated events
-                fileExists = os.path.exists(filename)
-
-        # wait for the full file to be written, wait at most 300 ms
-        waitIncrement = 0.1
-        totalWriteWait = 0.0
-        fileSize = os.path.getsize(filename)
-        while fileSize < self.minFileSize and totalWriteWait < 0.3:
-            time.sleep(waitIncrement)
-            totalWriteWait += waitIncrement
+                if self.eventSettleTime > 0:
+                    time.sleep(self.eventSettleTime)
+            else:
+                # check if the file exists in case the file event was missed
+                fileExists = self._fileExists(watch, filename)
+
+        if arrival is not None:
+            watch.foundWithFileEvent = True
+            watch.arrivalTime, fileSize = arrival
+        if arrival is None or fileSize < watch.minFileSize:
+            # No file-close event (e.g. the file already existed) or the file was still
+            #   being written. Check the file size and sleep up to 300 ms waiting for full size
+            waitIncrement = 0.1
+            totalWriteWait = 0.0
             fileSize = os.path.getsize(filename)
+            while fileSize < watch.minFileSize and totalWriteWait < 0.3:
+                time.sleep(waitIncrement)
+                totalWriteWait += waitIncrement
+                fileSize = os.path.getsize(filename)
         logging.log(DebugLevels.L6,
-                    "File avail: eventLoopCount %d, writeWaitTime %.3f, "
-                    "fileEventCaptured %s, fileName %s, eventTimeStamp %.5f",
-                    eventLoopCount, totalWriteWait,
-                    self.foundWithFileEvent, filename, eventTimeStamp)
-        if self.demoStep is not None and self.demoStep > 0:
-            self.prevEventTime = demoDelay(self.demoStep, self.prevEventTime)
+                    "File avail: eventLoopCount %d, fileEventCaptured %s, "
+                    "fileName %s, arrivalTime %s", eventLoopCount,
+                    watch.foundWithFileEvent, filename, watch.arrivalTime)
+        if watch.demoStep is not None and watch.demoStep > 0:
+            watch.prevEventTime = demoDelay(watch.demoStep, watch.prevEventTime)
         return filename
 
 
+if sys.platform in ("darwin", "win32"):
+    from watchdog.observers import Observer  # type: ignore
+
+
+# Version of FileWatcher for Mac and Windows
+class WatchdogFileWatcher(_MultiWatchFileWatcher):
+    """Version of FileWatcher for Mac and Windows using Watchdog toolkit."""
+    # watchdog signals file creation, give the writer a moment before the file is read
+    eventSettleTime = 0.05
+
+    def __init__(self):
+        super().__init__()
+        self.observer = None
+        # map from watchId to the watchdog ObservedWatch
+        self.observedWatches = {}
+
+    def __del__(self):
+        if self.observer is not None:
+            try:
+                self.observer.stop()
+                self.observer.join()
+            except Exception as err:
+                # TODO - change back to log once can figure out what the observer.stop streamRef error is
+                print("FileWatcher: oberver.stop(): %s", str(err))
+            self.observer = None
+
+    def _startWatch(self, watch):
+        # Called with the watchLock held
+        if self.observer is None:
+            self.observer = Observer()
+            self.observer.start()
+        fileNotifyHandler = FileNotifyHandler(watch, [watch.filePattern])
+        self.observedWatches[watch.watchId] = \
+            self.observer.schedule(fileNotifyHandler, watch.realDir, recursive=False)
+
+    def _stopWatch(self, watch):
+        # Called with the watchLock held
+        observedWatch = self.observedWatches.pop(watch.watchId, None)
+        if observedWatch is not None and self.observer is not None:
+            self.observer.unschedule(observedWatch)
+
+    def _hasNotifier(self) -> bool:
+        return self.observer is not None
+
+
 class FileNotifyHandler(PatternMatchingEventHandler):  # type: ignore
     """
-    Handler class that will receive the watchdog notifications. It will queue the notifications
-    int the queue provided during to the init function.
+    Handler class that will receive the watchdog notifications. It records the file
+    arrivals in the FileWatch provided to the init function.
     """
-    def __init__(self, q, patterns):
+    def __init__(self, watch, patterns):
         """
         Args:
-            q (queue): Queue into which file-creation notifications will be placed.
+            watch (FileWatch): Watch in which the file arrivals will be recorded.
             patterns (List[regex]): Filename patterns to watch for.
         """
         super().__init__(patterns=patterns)
-        self.q = q
+        self.watch = watch
 
     def on_created(self, event):
-        self.q.put((event, time.time()))
+        self.watch.recordArrival(os.path.basename(event.src_path), time.time())
 
     def on_modified(self, event):
-        self.q.put((event, time.time()))
+        self.watch.recordArrival(os.path.basename(event.src_path), time.time())
 
 
 # import libraries for Linux version
@@ -222,165 +435,321 @@ if sys.platform in ("linux", "linux2"):
     import inotify.calls
 
 
-# Version of FileWatcher for Linux
-class InotifyFileWatcher():
-    """Version of FileWatcher for Linux using Inotify interface."""
+class InotifyRouter():
+    """
+    A single inotify instance and event thread for the process. Each watched directory
+    is added to inotify once, and its file close events are recorded in the arrival
+    index of the watches on that directory whose filePattern matches.
+    """
     def __init__(self):
-        self.watchDir = None
-        self.filePattern = None
-        self.minFileSize = 0
-        self.shouldExit = False
-        self.demoStep = 0
-        self.prevEventTime = 0
-        self.foundWithFileEvent = False
-        self.waitLoopCount = 0
-        # create a listening thread
-        self.fileNotifyQ = Queue()  # type: None
-        try:
-            # testing_fd tests whether inotify is working, if not reverts to polling.
-            # e.g., Mac M1 testing with Docker fails with inotify
-            testing_fd = inotify.calls.inotify_init()
-            self.notifier = inotify.adapters.Inotify()
-            self.notify_thread = threading.Thread(name='inotify', target=self.notifyEventLoop)
-            self.notify_thread.setDaemon(True)
-            self.notify_thread.start()
-        except Exception as err:
-            print("Warning: Inotify not available, falling back to polling")
-            self.notifier = None
-
-    def __del__(self):
-        self.shouldExit = True
-        if self.notify_thread:
-            self.notify_thread.join(timeout=2)
-
-    def initFileNotifier(self, dir: str, filePattern: str, minFileSize: int, demoStep: int=0) -> None:
-        """
-        Initialize the file watcher to watch for files in the specified directory.
-        Note: inotify doesn't use filepatterns
+        # testing_fd tests whether inotify is working, if not reverts to polling.
+        # e.g., Mac M1 testing with Docker fails with inotify
+        testing_fd = inotify.calls.inotify_init()
+        os.close(testing_fd)
+        self.notifier = inotify.adapters.Inotify()
+        self.lock = threading.Lock()
+        # map from the real path of a watched directory to the list of its FileWatches
+        self.dirWatches = {}
+        self.notify_thread = threading.Thread(name='inotify', target=self.notifyEventLoop)
+        self.notify_thread.setDaemon(True)
+        self.notify_thread.start()
+
+    def register(self, watch: FileWatch):
+        with self.lock:
+            watches = self.dirWatches.get(watch.realDir)
+            if watches is None:
+                self.notifier.add_watch(watch.realDir, mask=inotify.constants.IN_CLOSE_WRITE)
+                watches = []
+            # replace the list so the event thread can iterate it without the lock
+            self.dirWatches[watch.realDir] = watches + [watch]
+
+    def unregister(self, watch: FileWatch):
+        with self.lock:
+            watches = [w for w in self.dirWatches.get(watch.realDir, []) if w is not watch]
+            if len(watches) > 0:
+                self.dirWatches[watch.realDir] = watches
+            elif watch.realDir in self.dirWatches:
+                del self.dirWatches[watch.realDir]
+                try:
+                    self.notifier.remove_watch(watch.realDir)
+                except Exception as err:
+                    # e.g. the directory was deleted
+                    logging.info(f'InotifyRouter: remove_watch {watch.realDir}: {err}')
 
-        Args:
-            dir (str): Directory to watch in
-            filePattern (str): ignored by inotify implementation
-            minFileSize (int): Minimum file size necessary to consider the file is wholely written.
-                Below this size the filewatcher will assume file is paritally written and continue
-                to wait.
-            demoStep (int): If non-zero then it will space out file notifications by demoStep seconds.
-                This is used when the image files are pre-existing but we want to simulate as if
-                the arrive from the scanner every few seconds (demoStep seconds).
+    def notifyEventLoop(self):
         """
-        self.filePattern = filePattern
-        self.demoStep = demoStep
-        self.minFileSize = minFileSize
-        if dir is None:
-            raise StateError('initFileNotifier: dir is None')
-        if not os.path.exists(dir):
-            raise NotADirectoryError("No such directory: %s" % (dir))
-        if dir != self.watchDir:
-            if self.watchDir is not None:
-                if self.notifier is not None:
-                    self.notifier.remove_watch(self.watchDir)
-            self.watchDir = dir
-            if self.notifier is not None:
-                self.notifier.add_watch(os.path.realpath(self.watchDir), 
-                                        mask=inotify.constants.IN_CLOSE_WRITE)
-
-    def waitForFile(self, filename: str, timeout: int=0, timeCheckIncrement: int=1) -> Optional[str]:
+        Thread function which gets notifications and records them in the arrival
+        index of the matching watches
         """
-        Wait for a specific filename to be created in the directory specified in initFileNotifier.
+        for event in self.notifier.event_gen():
+            if event is None:
+                continue
+            # print(event)      # uncomment to see all events generated
+            if 'IN_CLOSE_WRITE' not in event[1]:
+                continue
+            eventTime = time.time()
+            watches = [watch for watch in self.dirWatches.get(event[2], [])
+                       if watch.matches(event[3])]
+            if len(watches) == 0:
+                continue
+            try:
+                # the file is closed so its size is final, stat it once for all the watches
+                size = os.path.getsize(os.path.join(event[2], event[3]))
+            except OSError:
+                continue
+            for watch in watches:
+                watch.recordArrival(event[3], eventTime, size)
 
-        Args:
-            filename: Name of File to watch for creation of. If filename includes a path it must 
-                match that specified in initFileNotifier.
-            timeout: Max number of seconds to watch for the file creation. If timeout expires
-                before the file is created then None will be returned
-            timeCheckIncrement: Time interval (secs) to check if file exists in case file
-                creation events are somehow missed.
-        Returns:
-            The filename of the created file (same as input arg) or None if timeout expires
-        """
-        _filedir, _filename = os.path.split(filename)
-        if _filedir in (None, ''):
-            filename = os.path.join(self.watchDir, filename)
-        elif _filedir != self.watchDir:
-            raise StateError(f"FileWatcher: file path doesn't match watch directory: {_filedir}, {self.watchDir}")
 
-        fileExists = os.path.exists(filename)
-        if not fileExists:
-            if (self.notifier is not None) and (self.notify_thread is None):
-                raise FileNotFoundError("FileNotifier thread not initialized and dicom file not found %s" % (filename))
-            else:
-                logStr = "FileWatcher: Waiting for file {}, timeout {}s ".format(filename, timeout)
-                logging.log(DebugLevels.L6, logStr)
-        eventLoopCount = 0
-        self.foundWithFileEvent = False
-        eventTimeStamp = 0
-        startTime = time.time()
-        self.waitLoopCount = 0
-        while not fileExists:
-            self.waitLoopCount += 1
-            if timeout > 0:
-                remainingTime = (startTime + timeout) - time.time()
-                if remainingTime <= 0:
-                    return None
-                if remainingTime < timeCheckIncrement:
-                    timeCheckIncrement = remainingTime
-            # look for file creation event
-            eventLoopCount += 1
-            timeToCheckForFile = time.time() + timeCheckIncrement
+# The process's InotifyRouter, created by the first InotifyFileWatcher
+inotifyRouter = None
+inotifyRouterLock = threading.Lock()
+
+
+def getInotifyRouter() -> Optional[InotifyRouter]:
+    """Returns the process's InotifyRouter, or None if inotify isn't available"""
+    global inotifyRouter
+    with inotifyRouterLock:
+        if inotifyRouter is None:
             try:
-                eventfile, ts = self.fileNotifyQ.get(block=True, timeout=timeCheckIncrement)
-            except Empty:
-                # The timeout occured on fileNotifyQ.get()
-                fileExists = os.path.exists(filename)
+                inotifyRouter = InotifyRouter()
+            except Exception as err:
+                print(f"Warning: Inotify not available ({err}), falling back to polling")
+                inotifyRouter = False
+        return inotifyRouter or None
+
+
+class DirSnapshot():
+    """The entries of a directory polled by the PollingRouter"""
+    def __init__(self, realDir):
+        self.realDir = realDir
+        self.watches = []
+        # map from filename to its (size, mtime_ns, arrivalTime), None once the file
+        #   was unchanged between two polls
+        self.entries = {}
+        # number of entries not yet unchanged between two polls
+        self.numPending = 0
+        self.nextPollTime = 0
+        self.idleDelay = defaultPollInterval
+        self.lastArrivalTime = None
+
+
+class PollingRouter():
+    """
+    Finds the files arriving in the watched directories, for file systems without file
+    events, by periodically listing each directory with os.scandir and diffing the listing
+    with the previous one. A new file is recorded in the arrival index of the matching
+    watches, the same as a file event, once its size and mtime are unchanged between
+    two polls, so that files still being written aren't reported. Only files not yet
+    unchanged between two polls are stat'ed, so a poll of a directory of completed
+    images is a single directory listing.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeCond = threading.Condition(self.lock)
+        # map from the real path of a watched directory to its DirSnapshot
+        self.dirSnapshots = {}
+        self.pollThread = threading.Thread(name='filePoller', target=self.pollLoop)
+        self.pollThread.setDaemon(True)
+        self.pollThread.start()
+
+    def register(self, watch: FileWatch):
+        # Files already in the directory are the baseline, they don't count as arrivals
+        snapshot = self.dirSnapshots.get(watch.realDir)
+        baseline = None
+        if snapshot is None:
+            baseline = {name: None for name in self.listDir(watch.realDir)}
+        with self.lock:
+            snapshot = self.dirSnapshots.get(watch.realDir)
+            if snapshot is None:
+                snapshot = DirSnapshot(watch.realDir)
+                snapshot.entries = baseline
+                self.dirSnapshots[watch.realDir] = snapshot
+            # replace the list so the poll thread can iterate it without the lock
+            snapshot.watches = snapshot.watches + [watch]
+            watch.waitStartedFunc = self.wake
+            self.wakeCond.notify()
+
+    def unregister(self, watch: FileWatch):
+        with self.lock:
+            snapshot = self.dirSnapshots.get(watch.realDir)
+            if snapshot is None:
+                return
+            snapshot.watches = [w for w in snapshot.watches if w is not watch]
+            if len(snapshot.watches) == 0:
+                del self.dirSnapshots[watch.realDir]
+            watch.waitStartedFunc = None
+
+    def isPending(self, watch: FileWatch, filename: str) -> bool:
+        """
+        Returns True if the file hasn't yet been seen unchanged between two polls, including
+        a file written since the last poll
+        """
+        with self.lock:
+            snapshot = self.dirSnapshots.get(watch.realDir)
+            if snapshot is None:
+                return False
+            return snapshot.entries.get(os.path.basename(filename), ()) is not None
+
+    def wake(self):
+        """Poll the directories now, such as when a wait for a file starts"""
+        with self.lock:
+            for snapshot in self.dirSnapshots.values():
+                snapshot.nextPollTime = 0
+            self.wakeCond.notify()
+
+    @staticmethod
+    def listDir(dir) -> list:
+        try:
+            with os.scandir(dir) as entries:
+                return [entry.name for entry in entries]
+        except OSError as err:
+            # e.g. the network share is temporarily unavailable
+            logging.info(f'PollingRouter: scandir {dir}: {err}')
+            return []
+
+    def pollDir(self, snapshot: DirSnapshot):
+        """List a directory and record the new and changed files in the arrival indices"""
+        watches = snapshot.watches
+        pollTime = time.time()
+        names = self.listDir(snapshot.realDir)
+        entries = {}
+        for name in names:
+            prevEntry = snapshot.entries.get(name, ())
+            if prevEntry is None:
+                # already complete, don't stat it again
+                entries[name] = None
                 continue
-            if eventfile is None:
-                raise StateError('waitForFile: eventfile is None')
-            # We may have a stale event from a previous file if multiple events
-            #   are created per file or if the previous file eventloop
-            #   timed out and then the event arrived later.
-            if os.path.realpath(eventfile) == os.path.realpath(filename):
-                fileExists = True
-                self.foundWithFileEvent = True
-                eventTimeStamp = ts
+            matching = [watch for watch in watches if watch.matches(name)]
+            if len(matching) == 0:
+                entries[name] = None
                 continue
-            if time.time() >= timeToCheckForFile:
-                # periodically check if file exists, can occur if we get
-                #   swamped with unrelated events
-                fileExists = os.path.exists(filename)
-        if self.foundWithFileEvent is False:
-            # We didn't get a file-close event because the file already existed.
-            # Check the file size and sleep up to 300 ms waitig for full size
-            waitIncrement = 0.1
-            totalWriteWait = 0.0
-            fileSize = os.path.getsize(filename)
-            while fileSize < self.minFileSize and totalWriteWait < 0.3:
-                time.sleep(waitIncrement)
-                totalWriteWait += waitIncrement
-                fileSize = os.path.getsize(filename)
-        logging.log(DebugLevels.L6,
-                    "File avail: eventLoopCount %d, fileEventCaptured %s, "
-                    "fileName %s, eventTimeStamp %d", eventLoopCount,
-                    self.foundWithFileEvent, filename, eventTimeStamp)
-        if self.demoStep is not None and self.demoStep > 0:
-            self.prevEventTime = demoDelay(self.demoStep, self.prevEventTime)
-        return filename
-
-    def notifyEventLoop(self):
+            try:
+                fileStat = os.stat(os.path.join(snapshot.realDir, name))
+            except OSError:
+                # removed since the listing
+                continue
+            if len(prevEntry) == 0:
+                # a new file, recorded once it is unchanged at a following poll
+                snapshot.lastArrivalTime = pollTime
+                entries[name] = (fileStat.st_size, fileStat.st_mtime_ns, pollTime)
+            elif prevEntry[:2] != (fileStat.st_size, fileStat.st_mtime_ns):
+                # still being written
+                entries[name] = (fileStat.st_size, fileStat.st_mtime_ns, prevEntry[2])
+            else:
+                # unchanged since the last poll, the file is complete
+                entries[name] = None
+                for watch in matching:
+                    watch.recordArrival(name, prevEntry[2], fileStat.st_size)
+        snapshot.entries = entries
+        snapshot.numPending = sum(1 for entry in entries.values() if entry is not None)
+
+    @staticmethod
+    def nextPollDelay(snapshot: DirSnapshot, now: float) -> float:
         """
-        Thread function which gets notifications and queues them in the fileNotifyQ
+        Seconds until a directory should be polled again. When the expected interval
+        between arrivals (e.g. the TR) is known, polls are spaced out until shortly
+        before the next file is due and then made often until it arrives. If no file
+        arrives for several intervals (e.g. between runs), or no file is being waited
+        for, polls relax toward maxPollInterval.
         """
-        for event in self.notifier.event_gen():
-            if self.shouldExit is True:
-                break
-            if event is not None:
-                # print(event)      # uncomment to see all events generated
-                if 'IN_CLOSE_WRITE' in event[1]:
-                    path = pathlib.Path(event[3])
-                    if path.match(self.filePattern):
-                        fullpath = os.path.join(event[2], event[3])
-                        self.fileNotifyQ.put((fullpath, time.time()))
-                else:
-                    self.fileNotifyQ.put(('', time.time()))
+        if snapshot.numPending > 0:
+            # check soon whether the new files are complete
+            return minPollInterval
+        watches = snapshot.watches
+        intervals = [w.expectedInterval for w in watches if w.expectedInterval]
+        isWaiting = any(w.numWaiting > 0 for w in watches)
+        if len(intervals) > 0 and snapshot.lastArrivalTime is not None:
+            interval = min(intervals)
+            timeToNext = snapshot.lastArrivalTime + interval - now
+            if timeToNext > -2 * interval:
+                # within a run, poll often from shortly before the next arrival
+                snapshot.idleDelay = defaultPollInterval
+                return min(max(minPollInterval, timeToNext - 0.1 * interval), maxPollInterval)
+        elif isWaiting:
+            snapshot.idleDelay = defaultPollInterval
+            return defaultPollInterval
+        # between runs, relax the polling
+        delay = snapshot.idleDelay
+        snapshot.idleDelay = min(maxPollInterval, snapshot.idleDelay * 2)
+        return delay
+
+    def pollLoop(self):
+        """Thread function which polls each directory when it is due"""
+        while True:
+            with self.lock:
+                snapshots = list(self.dirSnapshots.values())
+            now = time.time()
+            for snapshot in snapshots:
+                if snapshot.nextPollTime <= now:
+                    self.pollDir(snapshot)
+                    now = time.time()
+                    snapshot.nextPollTime = now + self.nextPollDelay(snapshot, now)
+            with self.lock:
+                nextPollTime = min([snapshot.nextPollTime for snapshot in
+                                    self.dirSnapshots.values()], default=now + maxPollInterval)
+                waitTime = nextPollTime - time.time()
+                if waitTime > 0:
+                    self.wakeCond.wait(timeout=waitTime)
+
+
+# The process's PollingRouter, created by the first watcher that polls
+pollingRouter = None
+
+
+def getPollingRouter() -> PollingRouter:
+    """Returns the process's PollingRouter"""
+    global pollingRouter
+    with inotifyRouterLock:
+        if pollingRouter is None:
+            pollingRouter = PollingRouter()
+        return pollingRouter
+
+
+# Version of FileWatcher for Linux
+class InotifyFileWatcher(_MultiWatchFileWatcher):
+    """
+    Version of FileWatcher for Linux using Inotify interface. All InotifyFileWatchers
+    share one inotify instance (see InotifyRouter). If inotify isn't available the
+    directories are polled instead (see PollingRouter).
+    """
+    def __init__(self):
+        super().__init__()
+        self.router = getInotifyRouter()
+        self.notifier = self.router.notifier if self.router is not None else None
+        if self.router is None:
+            self.router = getPollingRouter()
+
+    def __del__(self):
+        self.removeAllWatches()
+
+    def _startWatch(self, watch):
+        # Called with the watchLock held
+        if self.router is not None:
+            self.router.register(watch)
+
+    def _stopWatch(self, watch):
+        # Called with the watchLock held
+        if self.router is not None:
+            self.router.unregister(watch)
+
+    def _fileExists(self, watch, filename) -> bool:
+        if isinstance(self.router, PollingRouter) and self.router.isPending(watch, filename):
+            # the poller hasn't yet seen the file unchanged, it may still be being written
+            return False
+        return os.path.exists(filename)
+
+
+class PollingFileWatcher(InotifyFileWatcher):
+    """
+    Version of FileWatcher which polls the watched directories (see PollingRouter), such
+    as for scanner directories on NFS/SMB shares where file events aren't delivered.
+    """
+    def __init__(self):
+        _MultiWatchFileWatcher.__init__(self)
+        self.notifier = None
+        self.router = getPollingRouter()
+
 
 # Uncomment to test lag time for finding files
 # if __name__ == "__main__":
@@ -6,8 +6,8 @@ nifti files, which is a file format that is better for data analyses.
 
 import os
 import time
-import copy
 import uuid
+import struct
 import logging
 import subprocess
 import warnings
@@ -133,14 +133,70 @@ def readDicomFromBuffer(data) -> pydicom.dataset.FileDataset:
     dataBytesIO = dicom.filebase.DicomBytesIO(data)
     try:
         dicomImg = dicom.dcmread(dataBytesIO)
-        # Test if the dicom image is complete
-        dicomImgTest = copy.deepcopy(dicomImg)
-        dicomImgTest.convert_pixel_data()
+        # Test if the dicom image is complete, the pixels are decoded when first used
+        checkDicomComplete(dicomImg)
     except Exception as err:
         raise ValidationError(f"readDicomFromBuffer: Dicom may be corrupted or truncated {err}")
     return dicomImg
 
 
+def checkDicomComplete(dicomImg) -> None:
+    """
+    Checks that the pixel data of a dicom is complete, such as to detect a file read while
+    it was still being written, without decoding the pixel data. Native pixel data must be
+    at least Rows x Columns x SamplesPerPixel x BitsAllocated/8 (x NumberOfFrames) bytes,
+    and encapsulated (compressed) pixel data must be whole fragment items.
+    Raises ValidationError if the pixel data is missing or incomplete.
+
+    Used internally.
+    """
+    if 'PixelData' not in dicomImg:
+        raise ValidationError("checkDicomComplete: Dicom has no PixelData")
+    pixelData = dicomImg.PixelData
+    fileMeta = getattr(dicomImg, 'file_meta', None)
+    transferSyntax = getattr(fileMeta, 'TransferSyntaxUID', None)
+    if transferSyntax is not None and transferSyntax.is_compressed:
+        checkEncapsulatedComplete(pixelData)
+        return
+    try:
+        numFrames = int(dicomImg.get('NumberOfFrames') or 1)
+        numBits = (dicomImg.Rows * dicomImg.Columns * (dicomImg.get('SamplesPerPixel') or 1)
+                   * dicomImg.BitsAllocated * numFrames)
+    except (AttributeError, TypeError, ValueError) as err:
+        raise ValidationError(f"checkDicomComplete: missing image dimensions: {err}")
+    expectedSize = (numBits + 7) // 8
+    if len(pixelData) < expectedSize:
+        raise ValidationError(f"checkDicomComplete: PixelData has {len(pixelData)} bytes, "
+                              f"expected {expectedSize}")
+
+
+def checkEncapsulatedComplete(pixelData: bytes) -> None:
+    """
+    Checks that encapsulated pixel data is a sequence of whole items (the basic offset
+    table and fragments), ending with the data or a sequence delimiter.
+    Raises ValidationError if an item is truncated.
+    """
+    offset = 0
+    numItems = 0
+    while offset < len(pixelData):
+        if offset + 8 > len(pixelData):
+            raise ValidationError("checkDicomComplete: truncated pixel data item header")
+        group, element, length = struct.unpack_from('<HHI', pixelData, offset)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            # sequence delimiter
+            return
+        if (group, element) != (0xFFFE, 0xE000) or length == 0xFFFFFFFF:
+            raise ValidationError(f"checkDicomComplete: invalid pixel data item "
+                                  f"({group:04X},{element:04X}) at {offset}")
+        offset += 8 + length
+        if offset > len(pixelData):
+            raise ValidationError("checkDicomComplete: truncated pixel data fragment")
+        numItems += 1
+    # the basic offset table item and at least one fragment
+    if numItems < 2:
+        raise ValidationError("checkDicomComplete: no pixel data fragments")
+
+
 def readRetryDicomFromDataInterface(dataInterface, filename, timeout=5):
     """
     This function is waiting and watching for a dicom file to be sent to the cloud
@@ -167,9 +223,8 @@ def readRetryDicomFromDataInterface(dataInterface, filename, timeout=5):
             loop_timeout = time_remaining
         try:
             data = dataInterface.watchFile(filename, loop_timeout)
+            # readDicomFromBuffer checks that the pixel data is complete
             dicomImg = readDicomFromBuffer(data)
-            # check that pixel array is complete
-            dicomImg.convert_pixel_data()
             # successful
             return dicomImg
         except TimeoutError as err:
@@ -0,0 +1,111 @@
+"""
+Read-ahead of the images of a scanner stream (see DataInterface.initScannerStream).
+
+Without read-ahead an image is read, parsed and anonymized when the client script
+requests it, on the critical path of the script's processing. With read-ahead a
+background thread reads each image of the stream as soon as it is written, and keeps
+the processed images in a bounded cache keyed by image index, so a request for an
+image that has already arrived returns it from memory. The thread reads at most
+maxCached images beyond the latest requested image, so images are only removed from
+the cache once later images have been requested.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# Max number of read-ahead images kept per stream, the oldest are removed
+defaultReadAheadSize = 16
+# Seconds the read-ahead thread waits for the next image before checking whether it was stopped
+readAheadPollSeconds = 1
+
+
+class ImageReadAhead:
+    """Reads the images of a stream in order in a background thread, and caches them"""
+    def __init__(self, readFunc, startIndex=0, maxCached=defaultReadAheadSize):
+        """
+        Args:
+            readFunc: function(imageIndex, timeout) which returns the processed image,
+                or None if it isn't available within the timeout
+            startIndex: index of the first image to read
+            maxCached: max number of images to keep, the oldest are removed
+        """
+        self.readFunc = readFunc
+        self.maxCached = maxCached
+        # map from image index to the image
+        self.images = OrderedDict()
+        # index of the image the thread is reading
+        self.nextIndex = startIndex
+        # highest index requested, the thread skips to it if the image at nextIndex
+        #   doesn't arrive, and reads at most maxCached images beyond it
+        self.wantedIndex = startIndex
+        self.stopped = False
+        self.hits = 0
+        self.misses = 0
+        self.cond = threading.Condition()
+        self.readThread = threading.Thread(name='imageReadAhead', target=self._readLoop)
+        self.readThread.daemon = True
+        self.readThread.start()
+
+    def get(self, imageIndex, timeout):
+        """
+        Returns an image from the cache, waiting up to timeout seconds if the image
+        hasn't been read yet. Returns None if the image isn't cached within the timeout,
+        or won't be (e.g. it was read before and removed from the cache).
+        """
+        with self.cond:
+            if imageIndex > self.wantedIndex:
+                self.wantedIndex = imageIndex
+                self.cond.notify_all()
+            self.cond.wait_for(lambda: imageIndex in self.images or imageIndex < self.nextIndex
+                               or self.stopped, timeout=timeout)
+            image = self.images.get(imageIndex)
+            if image is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return image
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.images.clear()
+            self.cond.notify_all()
+
+    def getStats(self) -> dict:
+        with self.cond:
+            return {'cached': len(self.images), 'nextIndex': self.nextIndex,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _readLoop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or
+                                   self.nextIndex < self.wantedIndex + self.maxCached)
+                if self.stopped:
+                    return
+                imageIndex = self.nextIndex
+            try:
+                image = self.readFunc(imageIndex, readAheadPollSeconds)
+            except Exception as err:
+                if self.stopped:
+                    # the stream was closed while the image was being read, e.g. its
+                    #   file watch was removed
+                    return
+                logging.error(f'ImageReadAhead: error reading image {imageIndex}: {err}')
+                image = None
+                time.sleep(readAheadPollSeconds)
+            with self.cond:
+                if self.stopped:
+                    return
+                if image is None:
+                    # skip a missing image if a later one has been requested
+                    if self.wantedIndex > self.nextIndex:
+                        self.nextIndex = self.wantedIndex
+                        self.cond.notify_all()
+                    continue
+                self.images[imageIndex] = image
+                while len(self.images) > self.maxCached:
+                    self.images.popitem(last=False)
+                self.nextIndex = imageIndex + 1
+                self.cond.notify_all()
@@ -84,7 +84,9 @@ class ProjectServer:
         # Start the rpyc RPC server that the client script connects to
         rpcService = ProjectRPCService(dataRemote=self.args.dataRemote,
                                        subjectRemote=self.args.subjectRemote,
-                                       webUI=Web.webDisplayInterface)
+                                       webUI=Web.webDisplayInterface,
+                                       rpcTraceFile=getattr(self.args, 'rpcTraceFile', None),
+                                       usePolling=getattr(self.args, 'usePolling', False))
         if self.args.dataRemote:
             rpcService.registerDataCommFunction(rpcHandlers.dataRequest)
         if self.args.subjectRemote:
@@ -121,6 +123,11 @@ if __name__ == "__main__":
                            help='Network port that the projectServer will listen for requests on')
     argParser.add_argument('--test', '-t', default=False, action='store_true',
                            help='start webServer in test mode, unsecure')
+    argParser.add_argument('--rpcTraceFile', default=None, type=str,
+                           help='json file to write the remote RPC latency stats to when the client disconnects')
+    argParser.add_argument('--usePolling', default=False, action='store_true',
+                           help="poll the scanner directories for new files, such as for NFS/SMB "
+                                "shares where file events aren't delivered (local data mode)")
     args = argParser.parse_args()
 
     if args.projectName is None:
@@ -4,18 +4,26 @@ Note: When using services local to the projectServer, RPCs call do one hop, clie
 When using remote services RPC calls traverse two links, client --> rpyc server --> (via websockets) remote service
 """
 import rpyc
+import time
 import json
 import pickle
 import logging
+import threading
 from rpyc.utils.server import ThreadedServer
 from rpyc.utils.helpers import classpartial
 from rtCommon.dataInterface import DataInterface
 from rtCommon.subjectInterface import SubjectInterface
 from rtCommon.bidsInterface import BidsInterface
 from rtCommon.exampleInterface import ExampleInterface
+from rtCommon.remoteable import subscriptionOwner
 from rtCommon.errors import StateError, RequestError
-from rtCommon.serialization import encodeByteTypeArgs, npToPy, unpackDataMessage
+from rtCommon.serialization import unpackDataMessage
+from rtCommon.serialization import canPickleOOB, decodePickleOOB
 from rtCommon.webSocketHandlers import RequestHandler
+from rtCommon import rpcTracing
+from rtCommon.rpcTracing import RpcTrace, rpcTraceStats
+from rtCommon.sharedMemoryTransport import SharedResultExporter
+from rtCommon.streamSubscription import StreamSubscription, defaultMaxBuffered
 
 
 class ProjectRPCService(rpyc.Service):
@@ -30,16 +38,27 @@ class ProjectRPCService(rpyc.Service):
     exposed_WebDisplayInterface = None
     exposed_ExampleInterface = None
 
-    def __init__(self, dataRemote=False, subjectRemote=False, webUI=None):
+    def __init__(self, dataRemote=False, subjectRemote=False, webUI=None, rpcTraceFile=None,
+                 usePolling=False):
         """
         Args:
             dataRemote: whether file read/write requests will be handled directly by the projectServer
                 or forwarded over websocket RPC to a remote service.
             subjectRemote: whether subject send/receive feedback will be handled locally within projectServer
                 or forwarded over websocket RPC to a remote service.
+            rpcTraceFile: file to write the RPC latency stats to when a client disconnects
+            usePolling: whether a local DataInterface watches for scanner files by polling
+                the directories rather than with file events
         """
         self.dataRemote = dataRemote
         self.subjectRemote = subjectRemote
+        self.rpcTraceFile = rpcTraceFile
+        if rpcTraceFile is not None:
+            rpcTracing.traceRpcCalls = True
+        # Exports large results to the client through shared memory
+        self.sharedResultExporter = SharedResultExporter()
+        self.numConnections = 0
+        self.connLock = threading.Lock()
         allowedDirs = None
         allowedFileTypes = None
         if dataRemote is False:
@@ -50,9 +69,11 @@ class ProjectRPCService(rpyc.Service):
         # Instantiate the client service instances
         ProjectRPCService.exposed_DataInterface = DataInterface(dataRemote=dataRemote,
                                                                 allowedDirs=allowedDirs,
-                                                                allowedFileTypes=allowedFileTypes)
+                                                                allowedFileTypes=allowedFileTypes,
+                                                                usePolling=usePolling)
         ProjectRPCService.exposed_BidsInterface = BidsInterface(dataRemote=dataRemote,
-                                                                allowedDirs=allowedDirs)
+                                                                allowedDirs=allowedDirs,
+                                                                usePolling=usePolling)
         ProjectRPCService.exposed_SubjectInterface = SubjectInterface(subjectRemote=subjectRemote)
         ProjectRPCService.exposed_WebDisplayInterface = webUI
         ProjectRPCService.exposed_ExampleInterface = ExampleInterface(dataRemote=dataRemote)
@@ -63,6 +84,33 @@ class ProjectRPCService(rpyc.Service):
     def exposed_isSubjectRemote(self):
         return self.subjectRemote
 
+    def exposed_callAndExport(self, obj, name, args, kwargsItems, useSharedMemory=True):
+        """
+        Calls a method of an interface and returns its serialized result, or a handle to
+        it in shared memory (see sharedMemoryTransport.importSharedResult), so that a client
+        call and the transfer of its result take one rpyc request.
+        Args:
+            obj: the interface
+            name: the method name
+            args: tuple of the call args
+            kwargsItems: tuple of (key, value) pairs of the call kwargs
+            useSharedMemory: whether the client can map shared memory segments
+        """
+        result = getattr(obj, name)(*args, **dict(kwargsItems))
+        return self.sharedResultExporter.export(result, useSharedMemory)
+
+    def exposed_setRpcTracing(self, enable=True):
+        """Turn on or off the tracing of the RPC calls forwarded to remote services"""
+        rpcTracing.traceRpcCalls = bool(enable)
+
+    def exposed_getRpcLatencyStats(self, method=None):
+        """Returns the per-span latency stats of the RPC calls forwarded to remote services"""
+        return rpcTraceStats.getStats(method)
+
+    def exposed_getRecentRpcTraces(self):
+        """Returns the span times of the most recent RPC calls forwarded to remote services"""
+        return rpcTraceStats.getRecentTraces()
+
     @staticmethod
     def registerDataCommFunction(commFunction):
         """
@@ -90,10 +138,29 @@ class ProjectRPCService(rpyc.Service):
         ProjectRPCService.exposed_SubjectInterface.registerCommFunction(commFunction)
 
     def on_connect(self, conn):
-        pass
+        with self.connLock:
+            self.numConnections += 1
+        # Each client connection is served by its own thread, mark the
+        #   subscriptions started by its calls as owned by the connection
+        subscriptionOwner.owner = conn
 
     def on_disconnect(self, conn):
-        pass
+        # stop pushing stream data for the client
+        for interface in (ProjectRPCService.exposed_DataInterface,
+                          ProjectRPCService.exposed_BidsInterface):
+            if interface is not None:
+                interface.closeSubscriptions(conn)
+        subscriptionOwner.owner = None
+        with self.connLock:
+            self.numConnections -= 1
+            if self.numConnections == 0:
+                # unlink any shared memory results the client didn't retrieve
+                self.sharedResultExporter.removeAllSegments()
+        if self.rpcTraceFile is not None:
+            try:
+                rpcTraceStats.dumpToFile(self.rpcTraceFile)
+            except Exception as err:
+                logging.error(f'ProjectRPCService: error writing {self.rpcTraceFile}: {err}')
 
 
 def startRPCThread(rpcService, hostname=None, port=12345):
@@ -184,16 +251,26 @@ class RPCHandlers:
             self.setError('SubjectRequest: ' + format(err))
             raise err;
 
-    def close_pending_requests(self, channelName):
-        """Close out all pending RPC requests when a connection is disconnected"""
+    def close_pending_requests(self, channelName, conn=None):
+        """Close out the pending RPC requests of a connection when it is disconnected"""
         handler = self.handlers.get(channelName)
         if handler is None:
             raise StateError(f'RPC Handler {channelName} not registered')
         try:
-            handler.close_pending_requests()
+            handler.close_pending_requests(conn)
         except Exception as err:
             self.setError('close_pending_requests: ' + format(err))
 
+    def resume_session(self, channelName, conn):
+        """Resend the pending RPC requests of a remote service session that reconnected"""
+        handler = self.handlers.get(channelName)
+        if handler is None:
+            raise StateError(f'RPC Handler {channelName} not registered')
+        try:
+            handler.resume_session(conn)
+        except Exception as err:
+            self.setError('resume_session: ' + format(err))
+
     def setError(self, errStr):
         """Set an error messsage in the user's browser window"""
         errStr = 'RPC Handler: ' + errStr
@@ -207,23 +284,36 @@ class RPCHandlers:
         handler = self.handlers[channelName]
         if handler is None:
             raise StateError(f'RPC Handler {channelName} not registered')
+        if cmd.get('cmd') == 'subscribe':
+            return self.subscribe(handler, cmd)
         savedError = None
         incomplete = True
-        # print(f'handle request {cmd}')
-        if cmd.get('cmd') == 'rpc':
-            # if cmd is rpc, check and encode any byte args as base64
-            cmd = encodeByteTypeArgs(cmd)
-            # Convert numpy arguments to native python types
-            cmd['args'] = npToPy(cmd.get('args', ()))
-            cmd['kwargs'] = npToPy(cmd.get('kwargs', {}))
+        trace = None
+        startTime = time.perf_counter()
+        if rpcTracing.traceRpcCalls and cmd.get('cmd') in ('rpc', 'rpcBatch'):
+            # Trace the call, the remote service returns its span times in the replies
+            method = cmd.get('attribute') if cmd.get('cmd') == 'rpc' else 'rpcBatch'
+            trace = RpcTrace(f"{cmd.get('class')}.{method}")
+            cmd['traceId'] = trace.traceId
+        # The args are encoded with the request in one pass (see RequestHandler.encodeMessage)
+        if cmd.get('cmd') in ('rpc', 'rpcBatch'):
+            if canPickleOOB():
+                # Let the remote know results can use out-of-band pickle buffers
+                cmd['oobPickle'] = True
         data = None
         while incomplete:
-            response = handler.doRequest(cmd, timeout=timeout)
+            waitStart = time.perf_counter()
+            response = handler.doRequest(cmd, timeout=timeout, trace=trace)
+            if trace is not None:
+                # time until the first reply part arrives vs. the time for the remaining parts
+                spanName = 'wait' if not cmd.get('incomplete', False) else 'transfer'
+                trace.addSpan(spanName, time.perf_counter() - waitStart)
             if response.get('status') != 200:
                 errStr = 'handleDataRequest: status {}, err {}'.format(
                             response.get('status'), response.get('error'))
                 self.setError(errStr)
                 raise RequestError(errStr)
+            unpackStart = time.perf_counter()
             try:
                 data = unpackDataMessage(response)
             except Exception as err:
@@ -231,30 +321,65 @@ class RPCHandlers:
                 logging.error(errStr)
                 if savedError is None:
                     savedError = errStr
+            if trace is not None:
+                trace.addSpan('reassemble', time.perf_counter() - unpackStart)
             incomplete = response.get('incomplete', False)
             cmd['callId'] = response.get('callId', -1)
             cmd['incomplete'] = incomplete
         if savedError:
             self.setError(savedError)
             raise RequestError(savedError)
+        deserializeStart = time.perf_counter()
         if data is not None:
-            serializationType = response.get('dataSerialization')
-            if serializationType == 'json':
-                if type(data) is bytes:
-                    data = data.decode()
-                data = json.loads(data)
-            elif serializationType == 'pickle':
-                data = pickle.loads(data)
-            elif serializationType == 'bytes':
-                # nothing to do
-                pass
-            else:
-                # Unknown encoding type
-                raise StateError(f"RPCHandler received unknown serialization " \
-                                 f"type {serializationType}")
-
+            data = deserializeResult(response, data)
+        if trace is not None:
+            endTime = time.perf_counter()
+            trace.addSpan('deserialize', endTime - deserializeStart)
+            # the last reply part holds the remote service's accumulated span times
+            remoteSpans = response.get('trace')
+            if isinstance(remoteSpans, dict):
+                trace.addSpans({'remote.' + name: secs for name, secs in remoteSpans.items()})
+            trace.addSpan('total', endTime - startTime)
+            rpcTraceStats.record(trace)
         return data
 
+    def subscribe(self, handler, cmd):
+        """
+        Subscribe to the items yielded by a generator method at the remote service.
+        Returns:
+            A StreamSubscription buffering the items as they are pushed
+        """
+        if canPickleOOB():
+            cmd['oobPickle'] = True
+        subscription = StreamSubscription(deserializeResult,
+                                          startIndex=cmd.pop('startIndex', 0),
+                                          maxBuffered=cmd.pop('maxBuffered', defaultMaxBuffered))
+        callId = handler.subscribe(cmd, subscription.addResponse)
+        subscription.unsubscribeFunc = lambda: handler.unsubscribe(callId)
+        return subscription
+
+
+def deserializeResult(response, data):
+    """Decode the result data of a reply according to its 'dataSerialization'"""
+    serializationType = response.get('dataSerialization')
+    if serializationType == 'json':
+        if type(data) is bytes:
+            data = data.decode()
+        data = json.loads(data)
+    elif serializationType == 'pickle':
+        data = pickle.loads(data)
+    elif serializationType == 'pickle5':
+        # numpy arrays are decoded as views into the received data
+        data = decodePickleOOB(data)
+    elif serializationType == 'bytes':
+        # nothing to do
+        pass
+    else:
+        # Unknown encoding type
+        raise StateError(f"RPCHandler received unknown serialization " \
+                         f"type {serializationType}")
+    return data
+
 # # Generic start RPC Thread routine
 # def startRPCThread(service, hostname=None, port=23456):
 #     threadId = ThreadedServer(service, hostname=hostname, port=port,
@@ -8,10 +8,126 @@ On the remote side we will have a RemoteHandler instance and when messages are r
 will dispatch them to the handler.
 """
 import inspect
+import threading
 import rpyc
-from rtCommon.errors import RequestError, StateError
+from concurrent.futures import Future, ThreadPoolExecutor
+from rtCommon.structDict import StructDict
+from rtCommon.errors import RequestError, StateError, ValidationError, SubscriptionMissError
+from rtCommon.resultCache import ResultCache, CacheStatic, copyResult
 
 defaultRpcTimeout = 60   # 60 sec default timeout
+# Max number of callAsync() requests that will be run concurrently
+maxAsyncCalls = 8
+asyncCallExecutor = None
+asyncCallExecutorLock = threading.Lock()
+# The owner, such as the client connection, of the subscriptions started by this
+#   thread, see RemoteableExtensible.closeSubscriptions()
+subscriptionOwner = threading.local()
+
+
+def getAsyncCallExecutor():
+    """Returns the thread pool shared by all callAsync() requests, creating it on first use"""
+    global asyncCallExecutor
+    with asyncCallExecutorLock:
+        if asyncCallExecutor is None:
+            asyncCallExecutor = ThreadPoolExecutor(max_workers=maxAsyncCalls,
+                                                   thread_name_prefix='asyncCall')
+    return asyncCallExecutor
+
+
+def runBatchCalls(runCall, calls):
+    """
+    Run a batch of calls in order, an error in one call doesn't stop the others.
+    Args:
+        runCall: function(call) that runs one call dict and returns its result
+        calls: list of call dicts with 'attribute', 'args' and 'kwargs'
+    Returns:
+        dict with 'results' and 'errors' lists, one entry per call,
+        errors[i] is None if call i succeeded
+    """
+    results = []
+    errors = []
+    for call in calls:
+        try:
+            results.append(runCall(call))
+            errors.append(None)
+        except Exception as err:
+            results.append(None)
+            errors.append(f'{type(err).__name__}: {err}')
+    return {'results': results, 'errors': errors}
+
+
+class RpcBatch:
+    """
+    Collects calls so they can be sent to the remote as a single request.
+    Each call added returns a Future that is resolved when the batch is sent.
+    When used as a context manager the calls made in the with block (on the
+    same thread) are collected and then sent when the block exits.
+    """
+    def __init__(self, runBatchFunc, batchState=None, countActiveFunc=None):
+        """
+        Args:
+            runBatchFunc: function(calls) that runs the calls and returns the
+                results and errors as from runBatchCalls()
+            batchState: threading.local in which the active batch is set by the
+                with statement
+            countActiveFunc: optional function(delta) called with 1 and -1 when
+                the with statement enters and exits the batch
+        """
+        self.runBatchFunc = runBatchFunc
+        self.batchState = batchState
+        self.countActiveFunc = countActiveFunc
+        self.calls = []
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def add(self, attribute, args, kwargs) -> Future:
+        future = Future()
+        with self.lock:
+            self.calls.append({'attribute': attribute, 'args': args, 'kwargs': kwargs})
+            self.futures.append(future)
+        return future
+
+    def flush(self):
+        """Send the calls collected so far and resolve their futures"""
+        with self.lock:
+            calls, futures = self.calls, self.futures
+            self.calls, self.futures = [], []
+        if len(calls) == 0:
+            return
+        try:
+            reply = self.runBatchFunc(calls)
+        except Exception as err:
+            for future in futures:
+                future.set_exception(err)
+            return
+        for future, result, error in zip(futures, reply['results'], reply['errors']):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RequestError(error))
+
+    def __enter__(self):
+        if getattr(self.batchState, 'batch', None) is not None:
+            raise StateError('RpcBatch: a batch is already active')
+        self.batchState.batch = self
+        if self.countActiveFunc is not None:
+            self.countActiveFunc(1)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.batchState.batch = None
+        if self.countActiveFunc is not None:
+            self.countActiveFunc(-1)
+        if excType is not None:
+            # don't send the calls if the with block raised an exception
+            with self.lock:
+                for future in self.futures:
+                    future.cancel()
+                self.calls, self.futures = [], []
+            return False
+        self.flush()
+        return False
 
 
 # Possibility A - the "has a" model, returns a 'remote' instance, nothing to do with the original class
@@ -66,6 +182,10 @@ class RemoteStub(object):
             timeout = kwargs.pop('rpc_timeout')
         return self.commFunction(callStruct, timeout=timeout)
 
+    def callAsync(self, attribute, *args, **kwargs):
+        """Start a remote call without waiting for it, returns a concurrent.futures.Future"""
+        return getAsyncCallExecutor().submit(self.remoteCall, attribute, *args, **kwargs)
+
     def __getattr__(self, name):
         # Previously just 'return self.remoteCall'
         # Create an closure function that populates the self and name args
@@ -90,15 +210,46 @@ class RemoteableExtensible(object):
     be registerd as 'local' meaning calls to them will be handled local, all other calls
     would be sent to the remote instance.
     """
+    # Map from method name to the validation policy (resultCache.CacheStatic or
+    #   CacheFileStat) of the methods whose results can be cached, see enableResultCache()
+    cacheableMethods = {}
+    # Map from method name to the cacheable methods whose cached results a call to it invalidates
+    cacheInvalidations = {}
+    # Map from the name of a subscribe method to a tuple of (the generator method run at the
+    #   remote service, the method whose calls are served from the subscription), see startSubscription()
+    subscriptionMethods = {}
+    # Methods that close a stream, given the streamId as first arg, which end its subscriptions
+    streamCloseMethods = set()
+
     def __init__(self, isRemote=False):
         self.isRemote = isRemote
         self.commFunction = None
         self.timeout = defaultRpcTimeout
-        self.localAttributes = [
+        # the batch (if any) collecting this thread's calls, see batch()
+        self.batchState = threading.local()
+        # seconds to wait collecting remote calls into a batch, see setBatchWindow()
+        self.batchWindow = 0
+        self.windowBatch = None
+        self.batchLock = threading.Lock()
+        # number of batches active in any thread, local instances only check
+        #   for a batch when there is one
+        self.numActiveBatches = 0
+        # cache of remote call results, see enableResultCache()
+        self.resultCache = None
+        # map from (served method name, streamId) to the active StreamSubscription
+        self.subscriptions = {}
+        self.localAttributes = {
             'localAttributes', 'commFunction', 'timeout',
             'addLocalAttributes', 'registerCommFunction',
-            'setRPCTimeout', 'isRunningRemote', 'isRemote'
-            ]
+            'setRPCTimeout', 'isRunningRemote', 'isRemote',
+            'remoteCall', 'callAsync', 'batch', 'runBatch', 'setBatchWindow',
+            'batchState', 'batchWindow', 'windowBatch', 'batchLock', 'flushWindowBatch',
+            'numActiveBatches', 'countActiveBatch', 'getBatchCall',
+            'resultCache', 'cacheableMethods', 'cacheInvalidations', 'enableResultCache',
+            'disableResultCache', 'invalidateResultCache', 'getResultCacheStats', 'cachedRemoteCall',
+            'subscriptions', 'subscriptionMethods', 'startSubscription', 'getSubscribedResult',
+            'unsubscribeStream', 'closeSubscriptions', 'streamCloseMethods'
+            }
 
     def isRunningRemote(self):
         return self.isRemote
@@ -120,16 +271,276 @@ class RemoteableExtensible(object):
         timeout = self.timeout
         if 'rpc_timeout' in kwargs:
             timeout = kwargs.pop('rpc_timeout')
+        if attribute in self.subscriptionMethods:
+            return self.startSubscription(attribute, args, kwargs, timeout)
+        if attribute in self.streamCloseMethods and len(self.subscriptions) > 0:
+            self.unsubscribeStream(args[0] if len(args) > 0 else kwargs.get('streamId'))
+        if len(self.subscriptions) > 0:
+            streamId = args[0] if len(args) > 0 else kwargs.get('streamId')
+            subscription = self.subscriptions.get((attribute, streamId))
+            if subscription is not None:
+                try:
+                    return self.getSubscribedResult(subscription, attribute, args, kwargs)
+                except SubscriptionMissError:
+                    # not pushed by the remote, request it below
+                    if not subscription.isActive():
+                        self.subscriptions.pop((attribute, streamId), None)
+        resultCache = self.resultCache
+        if resultCache is not None:
+            if attribute in resultCache.policies:
+                return self.cachedRemoteCall(callStruct, timeout)
+            invalidated = self.cacheInvalidations.get(attribute)
+            if invalidated is not None:
+                resultCache.invalidate(invalidated)
+        if self.batchWindow > 0:
+            # Wait for other calls made within the batch window and send them together
+            with self.batchLock:
+                if self.windowBatch is None:
+                    self.windowBatch = RpcBatch(self.runBatch)
+                    timer = threading.Timer(self.batchWindow, self.flushWindowBatch)
+                    timer.daemon = True
+                    timer.start()
+                kwargs['rpc_timeout'] = timeout
+                future = self.windowBatch.add(attribute, args, kwargs)
+            return future.result(timeout=timeout + self.batchWindow)
         # print(f'Remote call using timeout: {timeout}')
         result = self.commFunction(callStruct, timeout=timeout)
         # print(f'result: {type(result)}')
         return result
 
+    def enableResultCache(self, methods=None, maxEntries=256, maxBytes=64 * 2**20):
+        """
+        Cache the results of remote calls to the given methods, keyed by the call args,
+        so repeated calls don't need a request to the remote service.
+        Only applies when the calls are forwarded to a remote service.
+        Args:
+            methods: names of the methods to cache, must be in cacheableMethods,
+                defaults to all of the cacheableMethods
+            maxEntries: max number of cached results, least recently used are evicted
+            maxBytes: max total size of the cached results
+        """
+        if methods is None:
+            methods = list(self.cacheableMethods.keys())
+        else:
+            methods = rpyc.classic.obtain(methods)
+            if type(methods) is str:
+                methods = [methods]
+        for method in methods:
+            if method not in self.cacheableMethods:
+                raise ValidationError(f'enableResultCache: {type(self).__name__}.{method} '
+                                      f'is not cacheable')
+        policies = {method: self.cacheableMethods[method] for method in methods}
+        self.resultCache = ResultCache(policies, maxEntries=maxEntries, maxBytes=maxBytes)
+
+    def disableResultCache(self):
+        self.resultCache = None
+
+    def invalidateResultCache(self, methods=None):
+        """Remove the cached results of the given methods (or all methods if None)"""
+        if self.resultCache is not None:
+            if methods is not None:
+                methods = rpyc.classic.obtain(methods)
+                if type(methods) is str:
+                    methods = [methods]
+            self.resultCache.invalidate(methods)
+
+    def getResultCacheStats(self) -> dict:
+        """Returns the number of entries, bytes, hits and misses of the result cache"""
+        if self.resultCache is None:
+            return None
+        return self.resultCache.getStats()
+
+    def cachedRemoteCall(self, callStruct, timeout):
+        """Return the cached result of a call if still valid, otherwise make the call and cache it"""
+        resultCache = self.resultCache
+        attribute = callStruct['attribute']
+        args = callStruct['args']
+        key = resultCache.makeKey(attribute, args, callStruct['kwargs'])
+        policy = resultCache.policies[attribute]
+        entry = resultCache.get(key)
+        if policy == CacheStatic:
+            resultCache.recordLookup(entry is not None)
+            if entry is not None:
+                return copyResult(entry.result)
+            result = self.commFunction(callStruct, timeout=timeout)
+            resultCache.put(key, attribute, result)
+            return result
+        # CacheFileStat, the first arg is the filename
+        statCall = {'attribute': 'getFileStat', 'args': (args[0],), 'kwargs': {}}
+        if entry is not None:
+            statStruct = {'cmd': 'rpc', 'class': callStruct['class'], **statCall}
+            try:
+                fileStat = list(self.commFunction(statStruct, timeout=timeout))
+            except Exception:
+                fileStat = None
+            if fileStat == entry.validator:
+                resultCache.recordLookup(True)
+                return copyResult(entry.result)
+            resultCache.remove(key)
+        resultCache.recordLookup(False)
+        # Probe the file before reading it (in one request) so that a change
+        #   made after the probe causes a reload on the next call
+        batchStruct = {'cmd': 'rpcBatch', 'class': callStruct['class'],
+                       'calls': [statCall, {key: callStruct[key] for key in
+                                            ('attribute', 'args', 'kwargs')}]}
+        reply = self.commFunction(batchStruct, timeout=timeout)
+        statError, callError = reply['errors']
+        if callError is not None:
+            # make the call again so its exception is raised
+            return self.commFunction(callStruct, timeout=timeout)
+        fileStat, result = reply['results']
+        if statError is None:
+            resultCache.put(key, attribute, result, validator=list(fileStat))
+        return result
+
+    def startSubscription(self, attribute, args, kwargs, timeout):
+        """
+        Subscribe to the items of a stream pushed by the remote service, the later calls
+        of the served method for the stream are answered from the received items.
+        Args:
+            attribute: name of the subscribe method, in subscriptionMethods, whose
+                args are the streamId followed by the startIndex and maxBuffered
+        """
+        generatorName, servedAttribute = self.subscriptionMethods[attribute]
+        signature = inspect.signature(getattr(type(self), attribute))
+        callArgs = signature.bind(self, *args, **kwargs)
+        callArgs.apply_defaults()
+        streamId, startIndex, maxBuffered = list(callArgs.arguments.values())[1:4]
+        callStruct = {'cmd': 'subscribe', 'class': type(self).__name__, 'attribute': generatorName,
+                      'args': (streamId, startIndex), 'kwargs': {},
+                      'startIndex': startIndex, 'maxBuffered': maxBuffered}
+        subscription = self.commFunction(callStruct, timeout=timeout)
+        subscription.owner = getattr(subscriptionOwner, 'owner', None)
+        previous = self.subscriptions.get((servedAttribute, streamId))
+        self.subscriptions[(servedAttribute, streamId)] = subscription
+        if previous is not None:
+            previous.close()
+        return None
+
+    def getSubscribedResult(self, subscription, attribute, args, kwargs):
+        """
+        Return the result of a call to a served method from its subscription. The method's
+        args are the streamId followed by the item index, and it has a timeout arg.
+        Raises SubscriptionMissError if the item won't arrive through the subscription.
+        """
+        signature = inspect.signature(getattr(type(self), attribute))
+        callArgs = signature.bind(self, *args, **kwargs)
+        callArgs.apply_defaults()
+        index = list(callArgs.arguments.values())[2]
+        timeout = callArgs.arguments.get('timeout', self.timeout)
+        try:
+            return subscription.get(index, timeout=timeout)
+        except TimeoutError as err:
+            raise RequestError(f'{attribute}: {err}')
+
+    def unsubscribeStream(self, streamId):
+        """Stop the subscriptions of a stream"""
+        for key, subscription in list(self.subscriptions.items()):
+            if key[1] == streamId:
+                self.subscriptions.pop(key, None)
+                subscription.close()
+
+    def closeSubscriptions(self, owner):
+        """Stop the subscriptions started by an owner, such as a client that disconnected"""
+        for key, subscription in list(self.subscriptions.items()):
+            if subscription.owner is owner:
+                self.subscriptions.pop(key, None)
+                subscription.close()
+
+    def batch(self):
+        """
+        Returns an RpcBatch to use in a with statement. Calls made within the with block
+        are collected and sent as a single request when the block exits, and are run
+        in order by the remote. Within the block each call returns a Future for its result.
+        For example:
+            with dataInterface.batch():
+                dataInterface.putFile(filename, data)
+                sizeFuture = dataInterface.getFileSize(filename)
+            size = sizeFuture.result()
+        """
+        return RpcBatch(self.runBatch, self.batchState, self.countActiveBatch)
+
+    def countActiveBatch(self, delta):
+        with self.batchLock:
+            self.numActiveBatches += delta
+
+    def getBatchCall(self, name):
+        """Returns a function adding a call of the method to this thread's active batch, or None"""
+        batch = getattr(self.batchState, 'batch', None)
+        if batch is None or not callable(object.__getattribute__(self, name)):
+            return None
+        # collect the call to send with the active batch
+        def batchCall(*args, **kwargs):
+            return batch.add(name, args, kwargs)
+        return batchCall
+
+    def runBatch(self, calls):
+        """
+        Run a list of calls in order as a single request.
+        Args:
+            calls: list of dicts with the 'attribute', 'args' and 'kwargs' of each call
+        Returns:
+            dict with 'results' and 'errors' lists, one entry per call,
+            errors[i] is None if call i succeeded
+        """
+        calls = rpyc.classic.obtain(calls)
+        # use the longest rpc_timeout of the calls
+        timeouts = [call['kwargs'].pop('rpc_timeout') for call in calls
+                    if 'rpc_timeout' in (call.get('kwargs') or {})]
+        timeout = max(timeouts) if len(timeouts) > 0 else self.timeout
+        if self.isRemote is True:
+            resultCache = self.resultCache
+            if resultCache is not None:
+                for call in calls:
+                    invalidated = self.cacheInvalidations.get(call['attribute'])
+                    if invalidated is not None:
+                        resultCache.invalidate(invalidated)
+            callStruct = {'cmd': 'rpcBatch', 'class': type(self).__name__, 'calls': calls}
+            # return a plain dict, a StructDict can't be passed by reference through rpyc
+            return dict(self.commFunction(callStruct, timeout=timeout))
+        def runCall(call):
+            attr = getattr(self, call['attribute'])
+            if not callable(attr):
+                return attr
+            return attr(*(call.get('args') or ()), **(call.get('kwargs') or {}))
+        return runBatchCalls(runCall, calls)
+
+    def setBatchWindow(self, seconds):
+        """
+        Collect the remote calls made within this many seconds of each other, such
+        as from different threads, and send them as a single request. 0 disables this.
+        """
+        self.batchWindow = seconds
+
+    def flushWindowBatch(self):
+        with self.batchLock:
+            batch = self.windowBatch
+            self.windowBatch = None
+        if batch is not None:
+            batch.flush()
+
+    def callAsync(self, attribute, *args, **kwargs):
+        """
+        Start a call to the named method without waiting for it to complete, so that
+        several requests can be in flight at once.
+        Args:
+            attribute: name of the method to call
+            args, kwargs: arguments to pass to the method
+        Returns:
+            A concurrent.futures.Future for the result of the method
+        """
+        if self.isRemote is True:
+            return getAsyncCallExecutor().submit(self.remoteCall, attribute, *args, **kwargs)
+        # rpc_timeout only applies to remote calls
+        kwargs.pop('rpc_timeout', None)
+        method = getattr(self, attribute)
+        return getAsyncCallExecutor().submit(method, *args, **kwargs)
+
     def addLocalAttributes(self, methods):
         if type(methods) is str:
-            self.localAttributes.append(methods)
+            self.localAttributes.add(methods)
         elif type(methods) is list:
-            self.localAttributes.extend(methods)
+            self.localAttributes.update(methods)
 
     def __getattribute__(self, name):
         # callername = inspect.stack()[1][3]
@@ -139,6 +550,9 @@ class RemoteableExtensible(object):
         if isremote:
             localAttrs = object.__getattribute__(self, 'localAttributes')
             if name not in localAttrs:
+                batchCall = object.__getattribute__(self, 'getBatchCall')(name)
+                if batchCall is not None:
+                    return batchCall
                 remoteCallFunc = object.__getattribute__(self, 'remoteCall')
                 def anonymous(*args, **kwargs):
                     return remoteCallFunc(name, *args, **kwargs)
@@ -149,6 +563,12 @@ class RemoteableExtensible(object):
                     # call the closure function immediately and return the results
                     return anonymous()
                 return anonymous
+        elif object.__getattribute__(self, 'numActiveBatches') > 0:
+            # a local instance's calls are only collected while a batch is active
+            if name not in object.__getattribute__(self, 'localAttributes'):
+                batchCall = object.__getattribute__(self, 'getBatchCall')(name)
+                if batchCall is not None:
+                    return batchCall
         # return super().__getattribute__(name)
         # return super(RemoteableB, self).__getattribute__(name)
         return object.__getattribute__(self, name)
@@ -173,6 +593,8 @@ class RemoteHandler:
 
     def runRemoteCall(self, callDict):
         # print(f'remoteCall {callDict}')
+        if callDict.get('cmd') == 'rpcBatch':
+            return self.runRemoteBatch(callDict)
         className = callDict.get('class')
         attributeName = callDict.get('attribute')
         if None in (className, attributeName):
@@ -192,3 +614,15 @@ class RemoteHandler:
             kwargs = {}
         res = attributeInstance(*args, **kwargs)
         return res
+
+    def runRemoteBatch(self, callDict):
+        """Run the calls of a batch request in order, see RemoteableExtensible.runBatch()"""
+        className = callDict.get('class')
+        calls = callDict.get('calls')
+        if None in (className, calls):
+            raise RequestError(f'Malformed remote batch struct: missing one of '
+                               f'class {className}, calls')
+        def runCall(call):
+            return self.runRemoteCall({'class': className, **call})
+        # return a StructDict so the remote service pickles the results
+        return StructDict(runBatchCalls(runCall, calls))
@@ -0,0 +1,156 @@
+"""
+A bounded pool of worker threads that runs requests in priority lanes.
+
+WsRemoteService uses this so that a burst of requests (such as downloading a folder of
+files) doesn't start a thread per request, and so that latency critical requests, such
+as getImageData for the current TR, aren't queued behind bulk file transfers.
+
+Lanes:
+    control - run immediately in the caller's thread, never queued (e.g. ping)
+    interactive - queued, always taken by a free worker before any bulk request
+    bulk - queued, and limited to maxBulkWorkers workers so some workers are
+        always free for interactive requests
+"""
+import time
+import logging
+import threading
+from collections import deque
+from rtCommon.errors import ValidationError
+
+ControlLane = 'control'
+InteractiveLane = 'interactive'
+BulkLane = 'bulk'
+requestLanes = [ControlLane, InteractiveLane, BulkLane]
+
+# The pool running the requests of this process's remote service, see getServiceQueueMetrics()
+servicePool = None
+
+
+def getServiceQueueMetrics():
+    """
+    Returns the queue metrics (see RequestWorkerPool.getMetrics) of the remote service
+    running in this process, or None if this process doesn't run a remote service
+    """
+    if servicePool is None:
+        return None
+    return servicePool.getMetrics()
+
+
+class RequestWorkerPool:
+    """Runs submitted functions on a fixed set of worker threads by lane priority"""
+    def __init__(self, numWorkers=8, maxBulkWorkers=None, name='requestWorker'):
+        """
+        Args:
+            numWorkers (int): number of worker threads
+            maxBulkWorkers (int): max workers that can run bulk requests at once,
+                defaults to half of the workers
+            name (str): name prefix for the worker threads
+        """
+        if numWorkers < 2:
+            raise ValidationError(f'RequestWorkerPool: numWorkers must be at least 2, got {numWorkers}')
+        if maxBulkWorkers is None:
+            maxBulkWorkers = numWorkers // 2
+        if maxBulkWorkers < 1 or maxBulkWorkers >= numWorkers:
+            raise ValidationError(f'RequestWorkerPool: maxBulkWorkers must be between 1 and '
+                                  f'{numWorkers - 1}, got {maxBulkWorkers}')
+        self.numWorkers = numWorkers
+        self.maxBulkWorkers = maxBulkWorkers
+        self.queues = {InteractiveLane: deque(), BulkLane: deque()}
+        self.stats = {lane: {'queued': 0, 'maxQueued': 0, 'active': 0,
+                             'completed': 0, 'totalWaitTime': 0.0}
+                      for lane in requestLanes}
+        self.cond = threading.Condition()
+        self.shouldExit = False
+        self.workers = []
+        for i in range(numWorkers):
+            worker = threading.Thread(name=f'{name}_{i}', target=self._workerLoop)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, lane, func, *args):
+        """Run func(*args) in the given lane"""
+        if lane not in requestLanes:
+            raise ValidationError(f'RequestWorkerPool: unknown lane {lane}')
+        if lane == ControlLane:
+            with self.cond:
+                self.stats[lane]['active'] += 1
+            self._run(lane, func, args, 0)
+            return
+        with self.cond:
+            if self.shouldExit:
+                raise ValidationError('RequestWorkerPool: pool has been shut down')
+            queue = self.queues[lane]
+            queue.append((func, args, time.time()))
+            stats = self.stats[lane]
+            stats['queued'] = len(queue)
+            stats['maxQueued'] = max(stats['maxQueued'], len(queue))
+            self.cond.notify()
+
+    def getMetrics(self) -> dict:
+        """
+        Returns a dict per lane of the current queue depth ('queued'), the most
+        requests queued at once ('maxQueued'), requests running ('active'),
+        requests completed ('completed') and the average seconds requests
+        waited in the queue ('avgWaitTime').
+        """
+        with self.cond:
+            metrics = {}
+            for lane, stats in self.stats.items():
+                laneMetrics = {k: v for k, v in stats.items() if k != 'totalWaitTime'}
+                completed = stats['completed']
+                laneMetrics['avgWaitTime'] = \
+                    stats['totalWaitTime'] / completed if completed > 0 else 0.0
+                metrics[lane] = laneMetrics
+            return metrics
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the queued requests have run"""
+        with self.cond:
+            self.shouldExit = True
+            self.cond.notify_all()
+        if wait:
+            for worker in self.workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+    def _nextRequest(self):
+        # Called with self.cond held
+        if len(self.queues[InteractiveLane]) > 0:
+            lane = InteractiveLane
+        elif (len(self.queues[BulkLane]) > 0 and
+              self.stats[BulkLane]['active'] < self.maxBulkWorkers):
+            lane = BulkLane
+        else:
+            return None
+        func, args, queuedTime = self.queues[lane].popleft()
+        stats = self.stats[lane]
+        stats['queued'] = len(self.queues[lane])
+        stats['active'] += 1
+        return lane, func, args, time.time() - queuedTime
+
+    def _workerLoop(self):
+        while True:
+            with self.cond:
+                request = self._nextRequest()
+                while request is None:
+                    if self.shouldExit:
+                        return
+                    self.cond.wait()
+                    request = self._nextRequest()
+            self._run(*request)
+
+    def _run(self, lane, func, args, waitTime):
+        try:
+            func(*args)
+        except Exception as err:
+            logging.error(f'RequestWorkerPool: {lane} request error: {err}')
+        finally:
+            with self.cond:
+                stats = self.stats[lane]
+                stats['active'] -= 1
+                stats['completed'] += 1
+                stats['totalWaitTime'] += waitTime
+                if lane == BulkLane:
+                    # a bulk slot is free again
+                    self.cond.notify()
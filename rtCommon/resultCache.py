@@ -0,0 +1,124 @@
+"""
+An LRU cache of remote call results, used by RemoteableExtensible to avoid repeating
+requests to a remote service for results that don't change during a session.
+
+Each cacheable method has a validation policy:
+    CacheStatic - the cached result is used until invalidated, either explicitly
+        or by a call to a method that changes it (see cacheInvalidations)
+    CacheFileStat - the first arg is a filename, a cached result is used only if the
+        file's (mtime, size), probed with a getFileStat request, is unchanged
+"""
+import sys
+import copy
+import threading
+from collections import OrderedDict
+import numpy
+
+CacheStatic = 'static'
+CacheFileStat = 'fileStat'
+cachePolicies = [CacheStatic, CacheFileStat]
+
+
+def estimateSize(obj) -> int:
+    """Approximate size in bytes of a result"""
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimateSize(item) for item in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimateSize(key) + estimateSize(val)
+                                        for key, val in obj.items())
+    return sys.getsizeof(obj)
+
+
+def copyResult(result):
+    """Returns a copy of a list or dict result, so callers can't change a cached result"""
+    if isinstance(result, (list, dict)):
+        return copy.deepcopy(result)
+    return result
+
+
+class CacheEntry:
+    def __init__(self, attribute, result, validator, size):
+        self.attribute = attribute
+        self.result = result
+        # the (mtime, size) of the file for CacheFileStat entries
+        self.validator = validator
+        self.size = size
+
+
+class ResultCache:
+    """LRU cache of call results bounded by number of entries and total size"""
+    def __init__(self, policies, maxEntries=256, maxBytes=64 * 2**20):
+        """
+        Args:
+            policies: map from method name to its validation policy
+            maxEntries: max number of cached results
+            maxBytes: max total (estimated) size of the cached results
+        """
+        self.policies = policies
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def makeKey(attribute, args, kwargs):
+        # repr handles unhashable args such as lists
+        return repr((attribute, tuple(args), sorted(kwargs.items())))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def recordLookup(self, hit):
+        """Count a cache hit or miss, a miss includes an entry that failed validation"""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key, attribute, result, validator=None):
+        size = estimateSize(result)
+        if size > self.maxBytes:
+            return
+        result = copyResult(result)
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = CacheEntry(attribute, result, validator, size)
+            self.totalBytes += size
+            # evict the least recently used
+            while len(self.entries) > self.maxEntries or self.totalBytes > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.totalBytes -= evicted.size
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def invalidate(self, attributes=None):
+        """Remove the cached results of the named methods, or all results if None"""
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if attributes is None or entry.attribute in attributes:
+                    self._remove(key)
+
+    def getStats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.totalBytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key):
+        # Called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.totalBytes -= entry.size
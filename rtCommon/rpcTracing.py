@@ -0,0 +1,169 @@
+"""
+Latency tracing for RPC calls forwarded from the projectServer to a remote service.
+
+Each forwarded call is given a trace id and the time spent in each stage (span) of
+the call is measured: on the projectServer serializing the request, waiting in the
+tornado IOLoop to be sent, waiting for the reply, reassembling the data parts and
+deserializing the result; and on the remote service waiting in the worker queue,
+executing the call, encoding the result and sending the data parts. The remote
+service returns its span times in the reply header. Each side only measures
+durations on its own clock, so clock skew between the computers doesn't matter.
+
+The spans are aggregated into per-method latency histograms (rpcTraceStats) which
+can be queried through the projectServer RPC service and dumped to a file.
+"""
+import math
+import time
+import json
+import uuid
+import threading
+
+# Whether to trace RPC calls, off unless enabled with the projectServer --rpcTraceFile
+#   arg or ClientInterface.setRpcTracing(), so untraced calls don't pay for the spans
+traceRpcCalls = False
+
+# Histogram bucket upper bounds in seconds, log spaced from 0.1 ms to 100 s
+histogramBuckets = [1e-4 * 10 ** (i / 4) for i in range(25)]
+
+
+def newTraceId():
+    return uuid.uuid4().hex[:16]
+
+
+class RpcTrace:
+    """The span times of one traced RPC call"""
+    def __init__(self, method, traceId=None):
+        """
+        Args:
+            method: name of the traced method, e.g. 'DataInterface.getFile'
+            traceId: id shared by the spans of the call on each hop
+        """
+        self.method = method
+        self.traceId = traceId if traceId is not None else newTraceId()
+        self.spans = {}
+
+    def addSpan(self, name, seconds):
+        """Add time to a span, spans that occur several times (e.g. per part) accumulate"""
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def addSpans(self, spans):
+        for name, seconds in spans.items():
+            self.addSpan(name, seconds)
+
+    def span(self, name):
+        """Context manager that adds the time within the with block to the span"""
+        return _SpanTimer(self, name)
+
+
+class _SpanTimer:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.trace.addSpan(self.name, time.perf_counter() - self.startTime)
+        return False
+
+
+class LatencyHistogram:
+    """Counts of latencies in log spaced buckets along with summary statistics"""
+    def __init__(self):
+        # the last bucket counts values larger than the largest bound
+        self.counts = [0] * (len(histogramBuckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = 0
+        while index < len(histogramBuckets) and seconds > histogramBuckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct):
+        """Approximate percentile (the upper bound of the bucket it falls in)"""
+        if self.count == 0:
+            return 0.0
+        target = self.count * pct / 100
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                if index < len(histogramBuckets):
+                    return min(histogramBuckets[index], self.max)
+                return self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count > 0 else 0.0,
+            'min': self.min if self.count > 0 else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {f'{bound:.6f}': count for bound, count in
+                        zip(histogramBuckets + [math.inf], self.counts) if count > 0},
+        }
+
+
+class RpcTraceStats:
+    """Per-method and per-span latency histograms of the traced calls"""
+    def __init__(self, maxRecentTraces=100):
+        self.lock = threading.Lock()
+        # map from method name to map from span name to LatencyHistogram
+        self.histograms = {}
+        # the span times of the most recent calls, for looking at individual calls
+        self.recentTraces = []
+        self.maxRecentTraces = maxRecentTraces
+
+    def record(self, trace: RpcTrace):
+        with self.lock:
+            methodHists = self.histograms.setdefault(trace.method, {})
+            for name, seconds in trace.spans.items():
+                methodHists.setdefault(name, LatencyHistogram()).add(seconds)
+            self.recentTraces.append({'traceId': trace.traceId, 'method': trace.method,
+                                      'spans': dict(trace.spans)})
+            if len(self.recentTraces) > self.maxRecentTraces:
+                self.recentTraces.pop(0)
+
+    def getStats(self, method=None) -> dict:
+        """
+        Returns a dict from method name to a dict of span name to the span's latency
+        summary (count, mean, min, max, p50, p90, p99 and histogram bucket counts).
+        Args:
+            method: only return the stats of this method (e.g. 'DataInterface.getFile')
+        """
+        with self.lock:
+            return {name: {span: hist.summary() for span, hist in methodHists.items()}
+                    for name, methodHists in self.histograms.items()
+                    if method is None or name == method}
+
+    def getRecentTraces(self) -> list:
+        with self.lock:
+            return list(self.recentTraces)
+
+    def dumpToFile(self, filename):
+        """Write the stats and recent traces to a json file"""
+        output = {'stats': self.getStats(), 'recentTraces': self.getRecentTraces()}
+        with open(filename, 'w') as fp:
+            json.dump(output, fp, indent=2)
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+            self.recentTraces = []
+
+
+# The stats of the calls traced in this process
+rpcTraceStats = RpcTraceStats()
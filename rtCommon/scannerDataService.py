@@ -39,14 +39,18 @@ class ScannerDataService:
         """
         if args.scannerClockSkew is None:
             args.scannerClockSkew = 0
+        if not hasattr(args, 'usePolling') or args.usePolling is None:
+            args.usePolling = False
 
         self.dataInterface = DataInterface(dataRemote=False,
                                            allowedDirs=args.allowedDirs,
                                            allowedFileTypes=args.allowedFileTypes,
-                                           scannerClockSkew=args.scannerClockSkew)
+                                           scannerClockSkew=args.scannerClockSkew,
+                                           usePolling=args.usePolling)
         self.bidsInterface = BidsInterface(dataRemote=False,
                                            allowedDirs=args.allowedDirs,
-                                           scannerClockSkew=args.scannerClockSkew)
+                                           scannerClockSkew=args.scannerClockSkew,
+                                           usePolling=args.usePolling)
 
         self.wsRemoteService = WsRemoteService(args, webSocketChannelName)
         self.wsRemoteService.addHandlerClass(DataInterface, self.dataInterface)
@@ -69,6 +73,9 @@ if __name__ == "__main__":
                         help="Allowed file types - comma separated list")
     parser.add_argument('--scannerClockSkew', default=0.0, type=float,
                         help="Seconds (float) that the scanner clock is ahead of the data server clock")
+    parser.add_argument('--usePolling', default=False, action='store_true',
+                        help="Poll the scanner directories for new files, such as for NFS/SMB "
+                             "shares where file events aren't delivered")
     args, _ = parser.parse_known_args(namespace=connectionArgs)
 
     if type(args.allowedDirs) is str:
@@ -1,15 +1,54 @@
 import os
+import sys
+import json
+import math
+import struct
 import hashlib
 import logging
 import numpy
-import zlib
 from base64 import b64encode, b64decode
-from rtCommon.structDict import StructDict
-from rtCommon.errors import RequestError, StateError, ValidationError
+from rtCommon.compression import compressData, decompressData, defaultCodec
+from rtCommon.errors import RequestError, ValidationError
+# Pickle protocol 5 (out-of-band buffers) is built in from python 3.8, before that
+#   it is available from the pickle5 backport package if installed
+if sys.version_info >= (3, 8):
+    import pickle as pickle5
+else:
+    try:
+        import pickle5  # type: ignore
+    except ModuleNotFoundError:
+        pickle5 = None
 
 # Cache of multi-part data transfers in progress
 multiPartDataCache = {}
 dataPartSize = 10 * (2**20)
+# Largest multipart transfer accepted, the receive buffer is allocated to the full size
+maxTransferSize = 4 * (2**30)
+# HTTP header a remote service sets at connect time to advertise that it can
+#   send results as binary websocket frames (see packBinaryFrame)
+binaryFramesHeader = 'X-RTCloud-Binary-Frames'
+# Binary frames start with the length of the JSON header as a 4 byte unsigned int
+binaryFrameLenFormat = '!I'
+binaryFrameLenSize = struct.calcsize(binaryFrameLenFormat)
+# Out-of-band pickle data starts with the number of buffers followed by the lengths
+#   of the pickle stream and each buffer (see encodePickleOOB)
+oobCountFormat = '!I'
+oobLenFormat = '!Q'
+# HTTP header a remote service sets at connect time to advertise that it can decode
+#   requests encoded with encodeRpcMessage
+rpcCodecHeader = 'X-RTCloud-Rpc-Codec'
+# Binary requests start with the length of the JSON and the number of raw buffers,
+#   followed by the length of each buffer (see encodeRpcMessage)
+rpcFrameHeaderFormat = '!II'
+# Bytes args at least this large are sent as raw buffers rather than base64 encoded
+minRawBufferSize = 1024
+# Values JSON can't encode (bytes, numpy arrays, sets) are encoded as dicts with this
+#   reserved key set to the kind of value, and exactly the keys listed for the kind
+rpcValueTag = '__rt__'
+rpcValueKeys = {'bytes': {rpcValueTag, 'data'},
+                'buffer': {rpcValueTag, 'index'},
+                'ndarray': {rpcValueTag, 'data', 'dtype', 'shape'},
+                'set': {rpcValueTag, 'items'}}
 
 
 def encodeByteTypeArgs(cmd) -> dict:
@@ -80,6 +119,118 @@ def decodeByteTypeArgs(cmd) -> dict:
     return cmd
 
 
+def encodeRpcMessage(msg, binary=False):
+    """
+    Encode a request for the remote service in a single pass. The JSON encoder walks
+    the message once and only calls back for values JSON can't represent: bytes,
+    numpy scalars and arrays, sets and rpyc references to dicts and lists. Bytes are
+    base64 encoded within the JSON, or if binary is set and they are large, placed as
+    raw buffers after the JSON in a binary frame. Decode with decodeRpcMessage.
+    Args:
+        msg: the request dict
+        binary: whether the request can be sent as a binary frame
+    Returns:
+        A JSON string, or bytes of a binary frame if it holds raw buffers
+    """
+    buffers = [] if binary else None
+    text = json.dumps(msg, default=lambda obj: _encodeRpcValue(obj, buffers))
+    if not buffers:
+        return text
+    textBytes = text.encode()
+    header = struct.pack(rpcFrameHeaderFormat, len(textBytes), len(buffers))
+    sizes = struct.pack(f'!{len(buffers)}Q', *[memoryview(buf).nbytes for buf in buffers])
+    return b''.join([header, sizes, textBytes, *buffers])
+
+
+def decodeRpcMessage(message) -> dict:
+    """
+    Decode a request encoded with encodeRpcMessage (or plain JSON) in a single pass.
+    Numpy arrays are decoded as read-only views of the received data.
+    """
+    if isinstance(message, (bytes, bytearray)):
+        view = memoryview(message)
+        textLen, numBuffers = struct.unpack_from(rpcFrameHeaderFormat, view)
+        offset = struct.calcsize(rpcFrameHeaderFormat)
+        sizes = struct.unpack_from(f'!{numBuffers}Q', view, offset)
+        offset += 8 * numBuffers
+        text = bytes(view[offset:offset + textLen]).decode()
+        offset += textLen
+        buffers = []
+        for size in sizes:
+            buffers.append(view[offset:offset + size])
+            offset += size
+        if offset != len(view):
+            raise RequestError(f'decodeRpcMessage: frame size {len(view)} expected {offset}')
+    else:
+        text = message
+        buffers = []
+    return json.loads(text, object_hook=lambda obj: _decodeRpcValue(obj, buffers))
+
+
+def _encodeRpcValue(obj, buffers):
+    # Called by the JSON encoder for values it can't encode
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        if buffers is not None and memoryview(obj).nbytes >= minRawBufferSize:
+            buffers.append(obj)
+            return {rpcValueTag: 'buffer', 'index': len(buffers) - 1}
+        return {rpcValueTag: 'bytes', 'data': b64encode(obj).decode('utf-8')}
+    elif isinstance(obj, numpy.generic):
+        return obj.item()
+    elif isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError(f'Object array args are not supported, dtype {obj.dtype}')
+        data = numpy.ascontiguousarray(obj).reshape(-1).view(numpy.uint8)
+        return {rpcValueTag: 'ndarray', 'data': _encodeRpcValue(memoryview(data), buffers),
+                'dtype': obj.dtype.str, 'shape': obj.shape}
+    elif isinstance(obj, (set, frozenset)):
+        return {rpcValueTag: 'set', 'items': list(obj)}
+    elif isinstance(obj, dict):
+        # an rpyc reference to a dict of the client
+        return dict(obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _decodeRpcValue(obj, buffers):
+    # Called by the JSON decoder for each decoded dict. Only dicts with exactly the
+    #   keys of a tagged value are decoded, other dicts are returned as is
+    kind = obj.get(rpcValueTag)
+    if not isinstance(kind, str) or obj.keys() != rpcValueKeys.get(kind):
+        return obj
+    if kind == 'bytes':
+        return b64decode(obj['data'])
+    elif kind == 'buffer':
+        index = obj['index']
+        if not isinstance(index, int) or not 0 <= index < len(buffers):
+            raise RequestError(f'decodeRpcMessage: buffer index {index} of {len(buffers)} buffers')
+        return bytes(buffers[index])
+    elif kind == 'ndarray':
+        # the data was decoded to bytes by the inner dict's call
+        return numpy.frombuffer(obj['data'], dtype=obj['dtype']).reshape(obj['shape'])
+    else:
+        # a set, tuples were encoded as lists
+        return set(tuple(val) if isinstance(val, list) else val for val in obj['items'])
+
+
+def encodeLegacyRpcMessage(msg) -> str:
+    """
+    Encode a request for remote services that don't decode encodeRpcMessage requests,
+    byte args are tagged and base64 encoded (see encodeByteTypeArgs).
+    """
+    def encodeCall(call):
+        call = encodeByteTypeArgs(dict(call))
+        call['args'] = npToPy(call.get('args', ()))
+        call['kwargs'] = npToPy(call.get('kwargs', {}))
+        return call
+    cmd = msg.get('cmd')
+    if cmd in ('rpc', 'subscribe'):
+        msg = encodeCall(msg)
+    elif cmd == 'rpcBatch':
+        msg = dict(msg, calls=[encodeCall(call) for call in msg.get('calls', [])])
+    return json.dumps(msg)
+
+
 def npToPy(data):
     """
     Converts components in data that are numpy types to regular python types.
@@ -109,29 +260,115 @@ def npToPy(data):
     # kwargs = {key: val.item() if isinstance(val, numpy.generic) else val for key, val in kwargs.items()}
 
 
-def encodeMessageData(message, data, compress):
+def canPickleOOB() -> bool:
+    """Whether pickle protocol 5 out-of-band buffers are supported by this process"""
+    return pickle5 is not None
+
+
+def encodePickleOOB(obj):
+    """
+    Pickle an object using protocol 5 so that large buffers, such as the data of
+    numpy arrays, are kept out of the pickle stream and not copied into it. The
+    pickle stream and the raw buffers are packed into a single bytes object.
+    Args:
+        obj: the object to serialize
+    Returns:
+        The packed bytes
+    """
+    return b''.join(encodePickleOOBParts(obj))
+
+
+def encodePickleOOBParts(obj):
+    """
+    Same as encodePickleOOB() but returns the list of parts (the header, the pickle
+    stream and the raw buffers) rather than joining them, so they can be copied
+    directly to their destination (e.g. a shared memory segment).
+    """
+    buffers = []
+    pickleData = pickle5.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    rawBuffers = [buf.raw() for buf in buffers]
+    lengths = [len(pickleData)] + [buf.nbytes for buf in rawBuffers]
+    header = struct.pack(oobCountFormat, len(rawBuffers)) + \
+        b''.join([struct.pack(oobLenFormat, length) for length in lengths])
+    return [header, pickleData] + rawBuffers
+
+
+def decodePickleOOB(data):
+    """
+    Unpickle data packed by encodePickleOOB. The out-of-band buffers are passed to
+    pickle as views into data, so numpy arrays are created directly over the received
+    data (like np.frombuffer) without copying. Read-only data (e.g. bytes) is copied
+    once into a bytearray so the resulting arrays are writeable.
+    """
+    if pickle5 is None:
+        raise RequestError('decodePickleOOB: pickle protocol 5 not available, install pickle5')
+    view = memoryview(data)
+    if view.readonly:
+        view = memoryview(bytearray(view))
+    numBuffers, = struct.unpack_from(oobCountFormat, view, 0)
+    offset = struct.calcsize(oobCountFormat)
+    lenSize = struct.calcsize(oobLenFormat)
+    lengths = []
+    for _ in range(numBuffers + 1):
+        length, = struct.unpack_from(oobLenFormat, view, offset)
+        lengths.append(length)
+        offset += lenSize
+    if offset + sum(lengths) != len(view):
+        raise RequestError('decodePickleOOB: buffer lengths {} inconsistent with data size {}'.
+                           format(sum(lengths), len(view)))
+    pickleData = view[offset:offset + lengths[0]]
+    offset += lengths[0]
+    buffers = []
+    for length in lengths[1:]:
+        buffers.append(view[offset:offset + length])
+        offset += length
+    return pickle5.loads(pickleData, buffers=buffers)
+
+
+def encodeMessageData(message, data, compress, binaryFrame=False, hashData=True):
     """
     b64 encode binary data in preparation for sending. Updates the message header
     as needed
     Args:
         message (dict): message header
         data (bytes): binary data
-        compress (bool): whether to compress binary data
+        compress (bool or str): whether to compress binary data, or the name of the
+            codec to compress with (see compression.py)
+        binaryFrame (bool): leave the data as raw bytes to be sent in a binary
+            websocket frame (see packBinaryFrame) rather than b64 encoding it
+        hashData (bool): whether to add an md5 'hash' of the data to the message,
+            not needed when the caller already has a checksum covering the data
     Returns:
         Modified message dict with appropriate fields filled in
     """
-    message['hash'] = hashlib.md5(data).hexdigest()
+    if hashData is True:
+        message['hash'] = hashlib.md5(data).hexdigest()
     dataSize = len(data)
-    if compress or dataSize > (20*2**20):
+    codec = None
+    if compress is True:
+        codec = defaultCodec
+    elif type(compress) is str and compress != 'none':
+        codec = compress
+    if compress is False and dataSize > (20*2**20):
+        # large data is compressed unless a codec (or 'none') was chosen by the caller
+        codec = defaultCodec
+    if codec is not None:
         message['compressed'] = True
-        data = zlib.compress(data)
-    message['data'] = b64encode(data).decode('utf-8')
+        message['codec'] = codec
+        data = compressData(codec, data)
+    if binaryFrame is True:
+        message['binaryData'] = True
+        # packBinaryFrame copies the data into the frame, so a memoryview is fine here
+        message['data'] = data
+    else:
+        message['data'] = b64encode(data).decode('utf-8')
     message['dataSize'] = dataSize
     # if 'compressed' in message:
     #     print('Compression ratio: {:.2f}'.format(len(message['data'])/dataSize))
     if len(message['data']) > 100*1024*1024:
         message['data'] = None
-        raise ValidationError('encodeMessageData: encoded file exceeds max size of 100MB')
+        raise ValidationError('encodeMessageData: encoded file exceeds max size of 100MB, '
+                              'transfer large files with streamGetFile or streamPutFile')
     return message
 
 
@@ -142,14 +379,20 @@ def decodeMessageData(message):
     Args:
         message (dict): encoded message to decode
     Returns:
-        The byte data of the original message from the sender
+        The byte data of the original message from the sender, this can be a
+        memoryview into the received frame for uncompressed binary frames
     """
     data = None
     if 'data' not in message:
         raise RequestError('decodeMessageData: data field not in response')
-    decodedData = b64decode(message['data'])
+    if message.get('binaryData') is True:
+        # data was sent as raw bytes in a binary frame
+        decodedData = message['data']
+    else:
+        decodedData = b64decode(message['data'])
     if 'compressed' in message:
-        data = zlib.decompress(decodedData)
+        # senders that predate codec negotiation always use zlib
+        data = decompressData(message.get('codec', 'zlib'), decodedData)
     else:
         data = decodedData
     if 'hash' in message:
@@ -160,14 +403,57 @@ def decodeMessageData(message):
     return data
 
 
-def generateDataParts(data, msg, compress):
+def packBinaryFrame(message) -> bytes:
+    """
+    Pack a message encoded with encodeMessageData(binaryFrame=True) into a single
+    buffer for sending as a binary websocket frame. The frame layout is a 4 byte
+    header length, followed by the JSON message header, followed by the raw data bytes.
+    Args:
+        message (dict): message with a raw bytes 'data' field
+    Returns:
+        The bytes of the binary frame
+    """
+    data = message.get('data')
+    if data is None:
+        data = b''
+    header = {k: v for k, v in message.items() if k != 'data'}
+    headerBytes = json.dumps(header).encode()
+    return b''.join([struct.pack(binaryFrameLenFormat, len(headerBytes)), headerBytes, data])
+
+
+def unpackBinaryFrame(frame) -> dict:
+    """
+    Unpack a binary websocket frame created by packBinaryFrame.
+    Args:
+        frame (bytes): the received binary frame
+    Returns:
+        The message dict with the raw bytes placed in the 'data' field
+    """
+    if len(frame) < binaryFrameLenSize:
+        raise RequestError('unpackBinaryFrame: frame too short {}'.format(len(frame)))
+    headerLen, = struct.unpack_from(binaryFrameLenFormat, frame, 0)
+    dataStart = binaryFrameLenSize + headerLen
+    if dataStart > len(frame):
+        raise RequestError('unpackBinaryFrame: header length {} exceeds frame size {}'.
+                           format(headerLen, len(frame)))
+    message = json.loads(bytes(frame[binaryFrameLenSize:dataStart]))
+    if message.get('binaryData') is True:
+        # reference the data within the frame rather than copying it
+        message['data'] = memoryview(frame)[dataStart:]
+    return message
+
+
+def generateDataParts(data, msg, compress, binaryFrame=False):
     """
     A python "generator" that, for data > 10 MB, will create multi-part
     messages of 10MB each to send the data incrementally
     Args:
         data (bytes): data to send
         msg (dict): message header for the request
-        compress (bool): whether to compress the data befor sending
+        compress (bool or str): whether to compress the data befor sending,
+            or the name of the codec to use
+        binaryFrame (bool): whether the parts will be sent as binary frames,
+            see encodeMessageData
     Returns:
         Repeated calls return the next partial message to be sent until
             None is returned
@@ -179,23 +465,30 @@ def generateDataParts(data, msg, compress):
     # update message for all data parts with the following info
     msg['status'] = 200
     msg['fileSize'] = dataSize
-    msg['fileHash'] = hashlib.md5(data).hexdigest()
+    # The fileHash covers all the parts so the parts don't need their own hash
+    fileHash = hashlib.md5(data).hexdigest()
+    msg['fileHash'] = fileHash
     msg['numParts'] = numParts
+    msg['partSize'] = dataPartSize
     if numParts > 1:
         msg['multipart'] = True
     i = 0
     partId = 0
-    dataSize = len(data)
+    # slice the parts from a memoryview to avoid copying them
+    dataView = memoryview(data)
     while i < dataSize:
         msgPart = msg.copy()
         partId += 1
         sendSize = dataSize - i
         if sendSize > dataPartSize:
             sendSize = dataPartSize
-        dataPart = data[i:i+sendSize]
+        dataPart = dataView[i:i+sendSize]
         msgPart['partId'] = partId
+        if numParts == 1:
+            msgPart['hash'] = fileHash
         try:
-            msgPart = encodeMessageData(msgPart, dataPart, compress)
+            msgPart = encodeMessageData(msgPart, dataPart, compress,
+                                        binaryFrame=binaryFrame, hashData=False)
         except Exception as err:
             msgPart['status'] = 400
             msgPart['error'] = str(err)
@@ -206,6 +499,62 @@ def generateDataParts(data, msg, compress):
     return
 
 
+class MultipartReassembler:
+    """
+    Reassembles the parts of a multipart transfer. Each part is written directly into a
+    buffer preallocated to the full file size, at the offset given by its partId, and
+    the md5 checksum is updated incrementally as the contiguous parts are filled in.
+    """
+    def __init__(self, fileSize, numParts, partSize):
+        # check the sizes claimed by the sender before allocating the buffer
+        for name, value in (('fileSize', fileSize), ('numParts', numParts), ('partSize', partSize)):
+            if type(value) is not int or value < 1:
+                raise RequestError(f'unpackDataMessage: invalid multipart {name} {value}')
+        if fileSize > maxTransferSize:
+            raise RequestError(f'unpackDataMessage: multipart fileSize {fileSize} exceeds '
+                               f'the max transfer size {maxTransferSize}')
+        if numParts != math.ceil(fileSize / partSize):
+            raise RequestError(f'unpackDataMessage: numParts {numParts} inconsistent with '
+                               f'fileSize {fileSize} and partSize {partSize}')
+        self.fileSize = fileSize
+        self.numParts = numParts
+        self.partSize = partSize
+        self.buffer = bytearray(fileSize)
+        self.bufferView = memoryview(self.buffer)
+        self.receivedParts = [False] * numParts
+        self.numReceivedParts = 0
+        # parts are hashed in order, nextHashPart is the first part not yet hashed
+        self.hasher = hashlib.md5()
+        self.nextHashPart = 0
+
+    def addPart(self, partId, data):
+        """Copy part partId (1-based) into the buffer, returns True when all parts are in"""
+        partIdx = partId - 1
+        if self.receivedParts[partIdx] is True:
+            raise RequestError('unpackDataMessage: duplicate part {}'.format(partId))
+        offset = partIdx * self.partSize
+        endOffset = offset + len(data)
+        expectedEnd = min(offset + self.partSize, self.fileSize)
+        if endOffset != expectedEnd:
+            raise RequestError('unpackDataMessage: part {} size {} inconsistent with file size {}'.
+                               format(partId, len(data), self.fileSize))
+        self.bufferView[offset:endOffset] = data
+        self.receivedParts[partIdx] = True
+        self.numReceivedParts += 1
+        while self.nextHashPart < self.numParts and self.receivedParts[self.nextHashPart]:
+            hashStart = self.nextHashPart * self.partSize
+            hashEnd = min(hashStart + self.partSize, self.fileSize)
+            self.hasher.update(self.bufferView[hashStart:hashEnd])
+            self.nextHashPart += 1
+        return self.numReceivedParts == self.numParts
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def release(self):
+        self.bufferView.release()
+
+
 def unpackDataMessage(msg):
     """
     Handles receiving multipart (an singlepart) data messages and returns the data bytes.
@@ -218,12 +567,12 @@ def unpackDataMessage(msg):
         Data bytes if all multipart messages have been received.
     """
     global multiPartDataCache
+    # Key the transfer by callId also in case the same data is requested twice at once
+    cacheKey = (msg.get('callId'), msg.get('fileHash'))
     try:
         if msg.get('status') != 200:
             # On error delete any partial transfers
-            fileHash = msg.get('fileHash')
-            if fileHash is not None and fileHash in multiPartDataCache:
-                del multiPartDataCache[fileHash]
+            multiPartDataCache.pop(cacheKey, None)
             raise RequestError('unpackDataMessage: {} {}'.format(msg.get('status'), msg.get('error')))
         data = decodeMessageData(msg)
         multipart = msg.get('multipart', False)
@@ -232,51 +581,40 @@ def unpackDataMessage(msg):
         logging.debug('unpackDataMessage: callid {}, part {} of {}'.format(msg.get('callId'), partId, numParts))
         if multipart is False or numParts == 1:
             # All data sent in a single message
+            if isinstance(data, memoryview):
+                data = data.tobytes()
             return data
         else:
             assert numParts > 1
             assert multipart is True
-            if partId > numParts:
+            if partId < 1 or partId > numParts:
                 raise RequestError(
                     'unpackDataMessage: Inconsistent parts: partId {} exceeds numParts {}'.
                     format(partId, numParts))
-            # get the data structure for this data
-            fileHash = msg.get('fileHash')
-            if partId > 1:
-                partialDataStruct = multiPartDataCache.get(fileHash)
-                if partialDataStruct is None:
-                    raise RequestError('unpackDataMessage: partialDataStruct not found')
-            else:
-                partialDataStruct = StructDict({'cachedDataParts': [None]*numParts, 'numCachedParts': 0})
-                multiPartDataCache[fileHash] = partialDataStruct
-            partialDataStruct.cachedDataParts[partId-1] = data
-            partialDataStruct.numCachedParts += 1
-            if partialDataStruct.numCachedParts == numParts:
+            # get the reassembly buffer for this data, parts may arrive in any order
+            reassembler = multiPartDataCache.get(cacheKey)
+            if reassembler is None:
+                fileSize = msg.get('fileSize')
+                if fileSize is None:
+                    raise RequestError('unpackDataMessage: multipart message missing fileSize')
+                reassembler = MultipartReassembler(fileSize, numParts,
+                                                   msg.get('partSize', dataPartSize))
+                multiPartDataCache[cacheKey] = reassembler
+            if reassembler.addPart(partId, data) is True:
                 # All parts of the multipart transfer have been received
-                # Concatenate the data into one bytearray
-                data = bytearray()
-                for i in range(numParts):
-                    dataPart = partialDataStruct.cachedDataParts[i]
-                    if dataPart is None:
-                        raise StateError('unpackDataMessage: missing dataPart {}'.format(i))
-                    data.extend(dataPart)
-                # Check fileHash and fileSize
-                dataHash = hashlib.md5(data).hexdigest()
-                dataSize = len(data)
+                # Check fileHash, the size was checked as each part was added
+                dataHash = reassembler.hexdigest()
+                fileHash = msg.get('fileHash')
                 if dataHash != fileHash:
                     raise RequestError("unpackDataMessage: File checksum mismatch {} {}".
                                        format(dataHash, fileHash))
-                if dataSize != msg.get('fileSize', 0):
-                    raise RequestError("unpackDataMessage: File size mismatch {} {}".
-                                       format(dataSize, msg.get('fileSize', 0)))
                 # delete the multipart data cache for this item
-                del multiPartDataCache[fileHash]
-                return data
+                del multiPartDataCache[cacheKey]
+                reassembler.release()
+                return reassembler.buffer
         # Multi-part transfer not complete, nothing to return
         return None
     except Exception as err:
         # removed any cached data
-        fileHash = msg.get('fileHash')
-        if fileHash and fileHash in multiPartDataCache:
-            del multiPartDataCache[fileHash]
+        multiPartDataCache.pop(cacheKey, None)
         raise err
@@ -0,0 +1,193 @@
+"""
+Shared memory fast path for results returned from the projectServer to the client script.
+
+The client script and projectServer run on the same computer. Rather than pickling
+a large result (e.g. a DICOM image or BidsIncremental) through the rpyc socket, the
+projectServer pickles it with out-of-band buffers (pickle protocol 5) directly into a
+shared memory segment and returns a small handle. The client maps the segment and
+unpickles from it, numpy arrays are created as views into the mapped segment
+without copying.
+
+Segment lifetime:
+    The projectServer creates the segment and closes its own mapping. The client
+    unlinks the segment name as soon as it has mapped it, so the memory is freed once
+    the client's mapping is closed. The client mapping is reference counted: it is
+    closed after all objects decoded from it (and views of them) have been released.
+    Segments never mapped by a client (e.g. the client exited) are unlinked by the
+    projectServer after maxSegmentAge seconds or when the client disconnects.
+
+Requires multiprocessing.shared_memory (python 3.8+) or the shared-memory38
+backport, otherwise results are returned through rpyc as before.
+"""
+import time
+import pickle
+import logging
+import weakref
+import threading
+import numpy
+from rtCommon.serialization import canPickleOOB, encodePickleOOBParts, decodePickleOOB
+from rtCommon.errors import ValidationError
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    try:
+        # backport for python 3.7, pip install shared-memory38
+        import shared_memory  # type: ignore
+        from shared_memory import resource_tracker  # type: ignore
+    except ImportError:
+        shared_memory = None
+        resource_tracker = None
+
+# Results smaller than this are returned in the reply rather than in shared memory
+minSharedMemorySize = 2**20
+# Seconds an exported segment is kept if no client maps it
+maxSegmentAge = 300
+
+
+def canUseSharedMemory() -> bool:
+    """Whether this process can exchange results through shared memory"""
+    return shared_memory is not None and canPickleOOB()
+
+
+class SharedResultExporter:
+    """Used by the projectServer to export results to the client"""
+    def __init__(self, minSize=minSharedMemorySize, maxAge=maxSegmentAge):
+        """
+        Args:
+            minSize: smallest serialized result (in bytes) to place in shared memory
+            maxAge: seconds after which an exported segment not yet mapped is unlinked
+        """
+        self.minSize = minSize
+        self.maxAge = maxAge
+        # map from segment name to the time it was exported
+        self.exportedSegments = {}
+        self.lock = threading.Lock()
+
+    def export(self, obj, useSharedMemory=True) -> tuple:
+        """
+        Serialize a result for the client.
+        Args:
+            obj: the result to serialize
+            useSharedMemory: whether the client can map shared memory segments
+        Returns:
+            A tuple handle, one of ('value', obj), ('shm', segmentName, size),
+            ('pickle5', data) or ('pickle', data), to pass to importSharedResult()
+        """
+        if obj is None or type(obj) in (bool, int, float, str):
+            # rpyc sends these by value
+            return ('value', obj)
+        if not canPickleOOB():
+            return ('pickle', pickle.dumps(obj))
+        try:
+            parts = encodePickleOOBParts(obj)
+        except Exception:
+            # e.g. the result holds rpyc references to objects passed in by an older
+            #   client which can't pickle them with protocol 5
+            return ('pickle', pickle.dumps(obj))
+        size = sum(memoryview(part).nbytes for part in parts)
+        if not useSharedMemory or shared_memory is None or size < self.minSize:
+            return ('pickle5', b''.join(parts))
+        self.removeExpiredSegments()
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            offset = 0
+            for part in parts:
+                partSize = memoryview(part).nbytes
+                shm.buf[offset:offset + partSize] = part
+                offset += partSize
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+        name = shm.name
+        shm.close()
+        # The client unlinks the segment, stop this process's resource tracker from
+        #   also unlinking it (and warning about a leak) at exit
+        _untrackSegment(name)
+        with self.lock:
+            self.exportedSegments[name] = time.time()
+        return ('shm', name, size)
+
+    def removeExpiredSegments(self, maxAge=None):
+        """Unlink exported segments older than maxAge seconds that a client never mapped"""
+        if maxAge is None:
+            maxAge = self.maxAge
+        now = time.time()
+        with self.lock:
+            expired = [name for name, exportTime in self.exportedSegments.items()
+                       if now - exportTime >= maxAge]
+            for name in expired:
+                del self.exportedSegments[name]
+        for name in expired:
+            _unlinkSegment(name)
+
+    def removeAllSegments(self):
+        self.removeExpiredSegments(maxAge=0)
+
+
+def importSharedResult(handle):
+    """
+    Deserialize a result exported by SharedResultExporter.export(). Results in
+    shared memory are mapped and decoded without copying the numpy array data.
+    """
+    kind = handle[0]
+    if kind == 'value':
+        return handle[1]
+    elif kind == 'pickle':
+        return pickle.loads(handle[1])
+    elif kind == 'pickle5':
+        return decodePickleOOB(handle[1])
+    elif kind != 'shm':
+        raise ValidationError(f'importSharedResult: unknown result type {kind}')
+    _, name, size = handle
+    _closeReleasedSegments()
+    shm = shared_memory.SharedMemory(name=name)
+    # The mapping remains valid after the name is unlinked
+    shm.unlink()
+    # All objects decoded from the segment reference this array, when it is
+    #   released the segment mapping can be closed
+    owner = numpy.frombuffer(shm.buf, dtype=numpy.uint8, count=size)
+    weakref.finalize(owner, _segmentReleased, shm)
+    return decodePickleOOB(memoryview(owner))
+
+
+# Mapped segments whose decoded objects have been released
+releasedSegments = []
+releasedLock = threading.Lock()
+
+
+def _segmentReleased(shm):
+    # Called while the owner array still holds its buffer, so the close is
+    #   done later by _closeReleasedSegments
+    with releasedLock:
+        releasedSegments.append(shm)
+
+
+def _closeReleasedSegments():
+    with releasedLock:
+        segments = list(releasedSegments)
+        releasedSegments.clear()
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            with releasedLock:
+                releasedSegments.append(shm)
+
+
+def _untrackSegment(name):
+    try:
+        resource_tracker.unregister('/' + name.lstrip('/'), 'shared_memory')
+    except Exception as err:
+        logging.debug(f'sharedMemoryTransport: unregister {name}: {err}')
+
+
+def _unlinkSegment(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        # already unlinked by the client
+        return
+    shm.close()
+    shm.unlink()
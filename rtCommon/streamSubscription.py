@@ -0,0 +1,144 @@
+"""
+Server push of stream data (such as DICOM images) from a remote service to the projectServer.
+
+Rather than the client script requesting each image, and the request waiting at the
+remote service for the image to be written, the projectServer subscribes to the stream.
+The remote service then runs a generator method of the interface which yields each
+image as soon as it is written, and sends it to the projectServer as a reply to the
+subscribe request (see WsRemoteService.handle_subscribe). The projectServer buffers the
+received images in a StreamSubscription, so that a client call such as
+getImageData(streamId, i) returns immediately once image i has arrived.
+
+Subscription replies carry the 'subscriptionIndex' of the item (e.g. the image index),
+and a final reply with 'subscriptionEnd' set is sent when the generator finishes
+or the subscription fails.
+"""
+import queue
+import logging
+import threading
+from rtCommon.serialization import unpackDataMessage
+from rtCommon.errors import SubscriptionMissError
+
+# Seconds the remote generators wait for the next item before checking whether
+#   the subscription has been cancelled
+subscriptionPollSeconds = 1
+# Max number of received items a subscription buffers
+defaultMaxBuffered = 32
+
+
+class StreamSubscription:
+    """
+    The projectServer side buffer of the items pushed by a remote service for a subscription.
+    Replies are queued by the websocket callback and decoded in a separate thread
+    so the tornado IOLoop isn't blocked.
+    """
+    def __init__(self, decodeFunc, startIndex=0, maxBuffered=defaultMaxBuffered):
+        """
+        Args:
+            decodeFunc: function(response, data) which deserializes a reply's data
+            startIndex: index of the first item the remote will send
+            maxBuffered: max number of received items to keep, the oldest are removed
+        """
+        self.decodeFunc = decodeFunc
+        self.startIndex = startIndex
+        self.maxBuffered = maxBuffered
+        self.unsubscribeFunc = None
+        # who started the subscription, see RemoteableExtensible.closeSubscriptions()
+        self.owner = None
+        # map from item index to the decoded item
+        self.items = {}
+        self.nextIndex = startIndex
+        self.lastReceivedIndex = None
+        self.ended = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.responses = queue.Queue()
+        self.decodeThread = threading.Thread(name='subscriptionDecode', target=self._decodeLoop)
+        self.decodeThread.daemon = True
+        self.decodeThread.start()
+
+    def addResponse(self, response):
+        """Queue a reply received for the subscription, called from the websocket callback"""
+        self.responses.put(response)
+
+    def get(self, index=None, timeout=5):
+        """
+        Return a pushed item, waiting for it to arrive if needed.
+        Args:
+            index: index of the item, None or < 0 for the item after the last one returned
+            timeout: max seconds to wait for the item
+        Raises:
+            SubscriptionMissError if the item won't arrive through the subscription
+            TimeoutError if the item doesn't arrive within the timeout
+        """
+        with self.cond:
+            if index is None or index < 0:
+                index = self.nextIndex
+            if index < self.startIndex:
+                raise SubscriptionMissError(f'item {index} is before the subscription start')
+            found = self.cond.wait_for(lambda: index in self.items or self._cantArrive(index),
+                                       timeout=timeout)
+            if index in self.items:
+                self.nextIndex = index + 1
+                return self.items[index]
+            if found:
+                raise SubscriptionMissError(f'item {index} not received: {self.error}')
+            raise TimeoutError(f'Subscription item {index} not received within {timeout}s')
+
+    def close(self):
+        """End the subscription, and ask the remote service to stop sending"""
+        with self.cond:
+            alreadyEnded = self.ended
+            self._end('Subscription closed')
+        if not alreadyEnded and self.unsubscribeFunc is not None:
+            try:
+                self.unsubscribeFunc()
+            except Exception as err:
+                logging.info(f'StreamSubscription: unsubscribe failed: {err}')
+
+    def isActive(self) -> bool:
+        return not self.ended
+
+    def _cantArrive(self, index):
+        # Called with the lock held. Items arrive in index order
+        if self.lastReceivedIndex is not None and index <= self.lastReceivedIndex:
+            return True
+        return self.ended
+
+    def _end(self, error=None):
+        # Called with the lock held
+        if not self.ended:
+            self.ended = True
+            self.error = error
+            # stop the decode thread
+            self.responses.put(None)
+        self.cond.notify_all()
+
+    def _decodeLoop(self):
+        while True:
+            response = self.responses.get()
+            if response is None:
+                return
+            try:
+                if response.get('subscriptionEnd') is True:
+                    with self.cond:
+                        self._end(response.get('error'))
+                    return
+                data = unpackDataMessage(response)
+                if data is None:
+                    # more parts of the item to come
+                    continue
+                item = self.decodeFunc(response, data)
+                index = response.get('subscriptionIndex')
+            except Exception as err:
+                logging.error(f'StreamSubscription: error receiving item: {err}')
+                with self.cond:
+                    self._end(str(err))
+                return
+            with self.cond:
+                self.items[index] = item
+                self.lastReceivedIndex = index
+                while len(self.items) > self.maxBuffered:
+                    del self.items[min(self.items)]
+                self.cond.notify_all()
+
@@ -9,6 +9,7 @@ import json
 import toml
 import time
 import glob
+import fnmatch
 import shutil
 import subprocess
 import pathlib
@@ -123,10 +124,35 @@ def findNewestFile(filepath, filepattern):
         # for now concatenate them also
         full_path_pattern = os.path.join(filepath, filepattern)
 
+    fileDir, namePattern = os.path.split(full_path_pattern)
+    if glob.has_magic(fileDir):
+        try:
+            return max(glob.iglob(full_path_pattern), key=os.path.getctime)
+        except ValueError:
+            return None
+    # List the directory once with scandir and stat only the entries matching the pattern.
+    #   On Windows the stat comes with the listing, on POSIX it is one stat per match.
+    newestName = None
+    newestTime = None
     try:
-        return max(glob.iglob(full_path_pattern), key=os.path.getctime)
-    except ValueError:
+        with os.scandir(fileDir or '.') as entries:
+            for entry in entries:
+                # glob doesn't match hidden files unless the pattern does
+                if entry.name.startswith('.') and not namePattern.startswith('.'):
+                    continue
+                if not fnmatch.fnmatch(entry.name, namePattern):
+                    continue
+                try:
+                    ctime = entry.stat().st_ctime
+                except OSError:
+                    continue
+                if newestTime is None or ctime > newestTime:
+                    newestName, newestTime = entry.name, ctime
+    except OSError:
         return None
+    if newestName is None:
+        return None
+    return os.path.join(fileDir, newestName)
 
 
 def copyFileWildcard(src, dst):
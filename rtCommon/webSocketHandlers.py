@@ -1,13 +1,23 @@
 """This module provides classes for handling web socket communication in the web interface."""
 import time
 import json
+import heapq
+import struct
 import logging
+import itertools
 import threading
 import tornado.websocket
-from rtCommon.structDict import StructDict
+from collections import deque
 from rtCommon.utils import DebugLevels, trimDictBytes
 from rtCommon.errors import StateError
+from rtCommon.serialization import binaryFramesHeader, unpackBinaryFrame
+from rtCommon.serialization import rpcCodecHeader, encodeRpcMessage, encodeLegacyRpcMessage
+from rtCommon.serialization import rpcFrameHeaderFormat
+from rtCommon.compression import codecsHeader, negotiateCodecs
 
+# HTTP header a remote service sets at connect time with the id of its session, which
+#   persists across reconnects so that requests in flight can be resent (see RequestHandler)
+sessionHeader = 'X-RTCloud-Session'
 
 # Maintain websocket local state (using class as a struct)
 class websocketState:
@@ -45,6 +55,15 @@ class BaseWebSocketHandler(tornado.websocket.WebSocketHandler):
 
     def open(self):
         """Called when a new client connection is established"""
+        # Remote services advertise at connect time whether they can send binary frames
+        self.binaryFrames = (self.request.headers.get(binaryFramesHeader) == '1')
+        # and which compression codecs they can send with
+        self.codecs = negotiateCodecs(self.request.headers.get(codecsHeader))
+        # whether it decodes requests encoded with encodeRpcMessage
+        self.rpcCodec = (self.request.headers.get(rpcCodecHeader) == '1')
+        # and the session it is (re)connecting, None for remote services without sessions
+        self.sessionId = self.request.headers.get(sessionHeader)
+        self.authenticated = False
         user_id = self.get_secure_cookie("login")
         if not user_id:
             logging.warning(f'websocket {self.name} authentication failed')
@@ -53,6 +72,7 @@ class BaseWebSocketHandler(tornado.websocket.WebSocketHandler):
             self.close()
             return
         logging.log(DebugLevels.L1, f"{self.name} WebSocket opened")
+        self.authenticated = True
         self.set_nodelay(True)
         websocketState.wsConnLock.acquire()
         try:
@@ -92,13 +112,23 @@ class BaseWebSocketHandler(tornado.websocket.WebSocketHandler):
 
 
 class DataWebSocketHandler(BaseWebSocketHandler):
-    """Sub-class the base handler in order to clean up any outstanding requests on close."""
+    """
+    Sub-class the base handler in order to clean up any outstanding requests on close,
+    and to resend the requests in flight when a remote service's session reconnects.
+    """
+    def open(self):
+        super().open()
+        if self.authenticated and self.sessionId is not None:
+            callback_func = websocketState.wsCallbacks.get(self.name)
+            requestHandler = callback_func.__self__
+            requestHandler.resume_session(self.name, conn=self)
+
     def on_close(self):
         super().on_close()
         # get the corresponding RequestHandler object so we can clear any waiting threads
         callback_func = websocketState.wsCallbacks.get(self.name)
         requestHandler = callback_func.__self__
-        requestHandler.close_pending_requests(self.name)
+        requestHandler.close_pending_requests(self.name, conn=self)
 
 
 class RejectWebSocketHandler(tornado.websocket.WebSocketHandler):
@@ -131,7 +161,11 @@ def sendWebSocketMessage(wsName, msg, conn=None):
             else:
                 if conn not in connList:
                     raise StateError(f'sendWebSocketMessage: {wsName} no matching connection {conn}')
-                conn.write_message(msg)
+                if isinstance(msg, bytes):
+                    # a request with raw buffers, see encodeRpcMessage
+                    conn.write_message(msg, binary=True)
+                else:
+                    conn.write_message(msg)
         else:
             logging.log(DebugLevels.L6, f'sendWebSocketMessage: {wsName} has no connectionList')
     finally:
@@ -164,27 +198,181 @@ Step 1: Prepare to send request, cache a callback structure which will match wit
 Step 2: Send the request
 Step 3: Get replies, match the reply to the callback structure and signal a semaphore
 '''
+# Requests that use state kept in the remote service, such as an open image stream.
+#   These are all sent to the same connection (per interface class) when several
+#   remote services are connected on a channel.
+statefulRequests = {'initScannerStream', 'getImageData', 'closeScannerStream',
+                    'getStreamLatencyStats', 'initWatch', 'watchFile',
+                    'initDicomBidsStream', 'initBidsStream', 'initOpenNeuroStream',
+                    'getIncremental', 'getIncrementalDelta', 'getNumVolumes', 'closeStream',
+                    'scannerStreamGenerator', 'bidsStreamGenerator'}
+# Interface classes where all requests use state kept in the remote service
+statefulClasses = {'SubjectInterface'}
+# Requests that can be safely resent to another connection if their connection drops
+idempotentRequests = {'getFile', 'getFiles', 'getNewestFile', 'listFiles', 'listDirs',
+                      'getAllowedFileTypes', 'getClockSkew', 'ping', 'getQueueMetrics'}
+
+
+def requestAttributes(request):
+    """Returns the (class, attribute) pairs of the calls in a request"""
+    if request.get('cmd') == 'rpcBatch':
+        return [(request.get('class'), call.get('attribute')) for call in request.get('calls', [])]
+    return [(request.get('class'), request.get('attribute'))]
+
+
+def markResent(sentMsg):
+    """
+    Add 'resend' to an encoded request. The JSON of a request is a dict so starts with '{',
+    this avoids decoding and re-encoding requests that hold file data.
+    """
+    if isinstance(sentMsg, bytes):
+        # a binary request, the JSON follows the header and buffer lengths
+        textLen, numBuffers = struct.unpack_from(rpcFrameHeaderFormat, sentMsg)
+        textStart = struct.calcsize(rpcFrameHeaderFormat) + 8 * numBuffers
+        marker = b'"resend": true, '
+        header = struct.pack(rpcFrameHeaderFormat, textLen + len(marker), numBuffers)
+        return b''.join([header, sentMsg[struct.calcsize(rpcFrameHeaderFormat):textStart + 1],
+                         marker, sentMsg[textStart + 1:]])
+    return '{"resend": true, ' + sentMsg[1:]
+
+
+def isStatefulRequest(request) -> bool:
+    return any(className in statefulClasses or attribute in statefulRequests
+               for className, attribute in requestAttributes(request))
+
+
+def isIdempotentRequest(request) -> bool:
+    return all(attribute in idempotentRequests
+               for _, attribute in requestAttributes(request))
+
+
+class PendingCall:
+    """
+    The state of one outstanding request. Reply parts are queued on it as they arrive and
+    the requesting thread is signaled through its semaphore, so completing a multipart
+    reply only touches this object, not the shared RequestHandler state.
+    """
+    def __init__(self, callId, dataConn, msg, expireTime):
+        self.callId = callId
+        self.dataConn = dataConn
+        self.msg = msg
+        self.timeStamp = time.time()
+        self.expireTime = expireTime
+        self.numResponses = 0
+        self.responses = deque()
+        self.semaphore = threading.Semaphore(value=0)
+        self.status = None
+        self.error = None
+        # the json request sent, kept to resend the request on failover or session resume
+        self.sentMsg = None
+        # the partIds of the data replies received, a resent request may repeat some
+        self.receivedParts = set()
+
+    def addResponse(self, response):
+        """Queue a reply part and wake the waiting thread, repeated data parts are dropped"""
+        if 'data' in response:
+            partId = response.get('partId', 1)
+            if partId in self.receivedParts:
+                return
+            self.receivedParts.add(partId)
+        self.responses.append(response)
+        self.numResponses += 1
+        self.semaphore.release()
+
+    def fail(self, status, error):
+        """Queue an error reply, the waiting thread receives it after any earlier parts"""
+        self.status = status
+        self.error = error
+        self.responses.append({'cmd': 'unknown', 'status': status, 'error': error})
+        self.semaphore.release()
+
+
+class Subscription:
+    """A subscription to data pushed by a remote service, see streamSubscription.py"""
+    def __init__(self, callId, dataConn, onResponse):
+        self.callId = callId
+        self.dataConn = dataConn
+        # function called with each reply received for the subscription
+        self.onResponse = onResponse
+
+
+class SessionJournal:
+    """The requests in flight when a remote service's session dropped, see RequestHandler"""
+    def __init__(self, sessionId):
+        self.sessionId = sessionId
+        self.pendingCalls = []
+        # the interface classes whose stateful requests went to the session
+        self.affinityClasses = []
+
+
 class RequestHandler:
     """
     Class for handling remote requests (such with a remote DataInterface). Each data requests is
     given a unique ID and callbacks from the client are matched to the original request and results
-    returned to the corresponding caller.
+    returned to the corresponding caller. A subscribe request can receive any number of
+    replies, which are passed to the subscription's onResponse function as they arrive.
+
+    The pending calls are kept in a dict keyed by callId, single get/set/pop operations on a dict
+    are atomic in CPython so looking up a call needs no lock. Calls that never get a reply are
+    expired using a heap ordered by expiration time rather than by scanning all pending calls.
+
+    When several remote services are connected on the channel, each request is sent to the
+    connection with the fewest outstanding requests. Stateful requests (see statefulRequests)
+    stay on one connection per interface class, and idempotent requests waiting on a
+    connection that drops are resent on another connection.
+
+    Remote services that connect with a session id (see sessionHeader) can resume their
+    session. The requests in flight when such a connection drops are kept in a journal
+    for resumeSeconds, and if the same session reconnects within that time they are resent
+    on the new connection rather than failed. The remote service recognizes the resent
+    requests it already received and only resends their replies.
     """
-    def __init__(self, name, ioLoopInst):
+    # Seconds after which a call without a reply is removed
+    maxCallbackSeconds = 300
+    # Seconds to wait for a dropped session to reconnect before failing its requests
+    resumeSeconds = 30
+
+    def __init__(self, name, ioLoopInst, statefulAffinity=True):
+        """
+        Args:
+            name: the websocket channel name, such as 'wsData'
+            ioLoopInst: the tornado IOLoop used to send the requests
+            statefulAffinity: whether to send stateful requests of an interface class
+                to the same connection
+        """
         self.dataCallbacks = {}
-        self.dataSequenceNum = 0
-        self.cbPruneTime = 0
-        self.callbackLock = threading.Lock()
+        # map from callId to the Subscription of subscribe requests
+        self.subscriptions = {}
+        self.statefulAffinity = statefulAffinity
+        # number of outstanding requests per connection
+        self.connLoad = {}
+        # map from interface class name to the connection used for its stateful requests
+        self.affinityConns = {}
+        self.loadLock = threading.Lock()
+        self.callIds = itertools.count(1)
+        # map from the sessionId of a dropped connection to a SessionJournal of the
+        #   requests to resend if the session reconnects
+        self.sessionJournal = {}
+        # map from sessionId to the callIds of completed calls, sent with the session's
+        #   next request so the remote service can drop their logged replies
+        self.sessionAcks = {}
+        # heap of (expireTime, callId), entries of completed calls are skipped when popped
+        self.expiryHeap = []
+        self.expiryLock = threading.Lock()
         self.name = name
         self.ioLoopInst = ioLoopInst
 
     # Top level function to make a remote request
-    def doRequest(self, msg, timeout=None):
+    def doRequest(self, msg, timeout=None, trace=None):
         """
         Send a request over the web socket, i.e. to the remote FileWatcher.
         This is typically the only call that a user of this class would make.
         It is the highest level call of this class, it uses the other methods to
         complete the request.
+        Args:
+            msg: the request dict
+            timeout: seconds to wait for the reply
+            trace: an rpcTracing.RpcTrace to add the serialize and send span times to
         """
         # print(f'doRequest: {msg}')
         call_id, conn = self.prepare_request(msg)
@@ -192,54 +380,166 @@ class RequestHandler:
         cmd = msg.get('cmd')
         logging.log(DebugLevels.L6, f'wsRequest, {cmd}, call_id {call_id} newRequest {isNewRequest}')
         if isNewRequest is True:
-            json_msg = json.dumps(msg)
-            self.ioLoopInst.add_callback(sendWebSocketMessage, wsName=self.name, msg=json_msg, conn=conn)
+            if getattr(conn, 'binaryFrames', False) is True:
+                # Let the remote service know it can reply using binary frames
+                msg['binaryFrames'] = True
+            codecs = getattr(conn, 'codecs', None)
+            if codecs is not None:
+                # The codecs both sides support, the remote service chooses among these
+                msg['codecs'] = codecs
+            sessionId = getattr(conn, 'sessionId', None)
+            if sessionId is not None:
+                with self.loadLock:
+                    ackCallIds = self.sessionAcks.pop(sessionId, None)
+                if ackCallIds is not None:
+                    msg['ackCallIds'] = ackCallIds
+            if trace is None:
+                json_msg = self.encodeMessage(msg, conn)
+            else:
+                with trace.span('serialize'):
+                    json_msg = self.encodeMessage(msg, conn)
+            pendingCall = self.dataCallbacks.get(call_id)
+            if pendingCall is not None and (getattr(conn, 'sessionId', None) is not None or
+                                            isIdempotentRequest(msg)):
+                # only kept if it can be resent, see failoverCall() and resume_session()
+                pendingCall.sentMsg = json_msg
+            if trace is None:
+                self.ioLoopInst.add_callback(sendWebSocketMessage, wsName=self.name, msg=json_msg, conn=conn)
+            else:
+                queuedTime = time.perf_counter()
+
+                def tracedSend():
+                    # time waiting for the IOLoop thread and then writing the message
+                    sendStart = time.perf_counter()
+                    trace.addSpan('ioLoopQueue', sendStart - queuedTime)
+                    sendWebSocketMessage(wsName=self.name, msg=json_msg, conn=conn)
+                    trace.addSpan('send', time.perf_counter() - sendStart)
+                self.ioLoopInst.add_callback(tracedSend)
         response = self.get_response(call_id, timeout=timeout)
         return response
 
+    def subscribe(self, msg, onResponse):
+        """
+        Send a subscribe request, the remote service replies with each item of the
+        stream as it becomes available.
+        Args:
+            msg: the subscribe request dict
+            onResponse: function called (in the IOLoop thread) with each reply
+        Returns:
+            The callId of the subscription, to pass to unsubscribe()
+        """
+        conn = self.selectConnection(msg)
+        callId = next(self.callIds)
+        msg['callId'] = callId
+        if getattr(conn, 'binaryFrames', False) is True:
+            msg['binaryFrames'] = True
+        codecs = getattr(conn, 'codecs', None)
+        if codecs is not None:
+            msg['codecs'] = codecs
+        self.subscriptions[callId] = Subscription(callId, conn, onResponse)
+        self.ioLoopInst.add_callback(sendWebSocketMessage, wsName=self.name,
+                                     msg=self.encodeMessage(msg, conn), conn=conn)
+        return callId
+
+    @staticmethod
+    def encodeMessage(msg, conn):
+        """Encode a request with the encoding the connection's remote service can decode"""
+        if getattr(conn, 'rpcCodec', False) is True:
+            return encodeRpcMessage(msg, binary=True)
+        return encodeLegacyRpcMessage(msg)
+
+    def unsubscribe(self, callId):
+        """Ask the remote service to stop sending a subscription's replies"""
+        subscription = self.subscriptions.pop(callId, None)
+        if subscription is None:
+            return
+        msg = json.dumps({'cmd': 'unsubscribe', 'callId': callId})
+        self.ioLoopInst.add_callback(sendWebSocketMessage, wsName=self.name,
+                                     msg=msg, conn=subscription.dataConn)
+
     # Step 1 - Prepare the request, record the callback struct and ID for when the reply comes
     def prepare_request(self, msg):
-        """Prepate a request to be sent, including creating a callback structure and unique ID."""
-        # Get data server connection the request will be sent on
+        """Prepate a request to be sent, including creating a PendingCall and unique ID."""
+        callId = msg.get('callId')
+        if callId:
+            # continuing a multipart reply, stay on the call's connection
+            pendingCall = self.dataCallbacks.get(callId)
+            if pendingCall is not None:
+                return callId, pendingCall.dataConn
+        reqConn = self.selectConnection(msg)
+        if not callId:
+            callMsg = msg.copy()
+            if 'data' in callMsg:
+                del callMsg['data']
+            callId = next(self.callIds)
+            expireTime = time.time() + self.maxCallbackSeconds
+            with self.loadLock:
+                self.connLoad[reqConn] = self.connLoad.get(reqConn, 0) + 1
+            self.dataCallbacks[callId] = PendingCall(callId, reqConn, callMsg, expireTime)
+            msg['callId'] = callId
+            with self.expiryLock:
+                heapq.heappush(self.expiryHeap, (expireTime, callId))
+        return callId, reqConn
+
+    def getConnections(self) -> list:
+        """Returns the connected remote services on this channel"""
         websocketState.wsConnLock.acquire()
         try:
-            wsConnections = websocketState.wsConnectionLists.get(self.name)
-            if wsConnections is None or len(wsConnections) == 0:
-                serviceName = 'DataService'
-                if self.name == 'wsSubject':
-                    serviceName = 'SubjectService'
-                raise StateError(f"RemoteService: {serviceName} not connected. Please start the remote service.")
-            reqConn = wsConnections[-1]  # always use most recent connection
+            return list(websocketState.wsConnectionLists.get(self.name) or [])
         finally:
             websocketState.wsConnLock.release()
-        callId = msg.get('callId')
-        if not callId:
-            callbackStruct = StructDict()
-            callbackStruct.dataConn = reqConn
-            callbackStruct.numResponses = 0
-            callbackStruct.responses = []
-            callbackStruct.semaphore = threading.Semaphore(value=0)
-            callbackStruct.timeStamp = time.time()
-            callbackStruct.msg = msg.copy()
-            if 'data' in callbackStruct.msg:
-                del callbackStruct.msg['data']
-            self.callbackLock.acquire()
-            try:
-                self.dataSequenceNum += 1
-                callId = self.dataSequenceNum
-                callbackStruct.callId = callId
-                msg['callId'] = callId
-                self.dataCallbacks[callId] = callbackStruct
-            finally:
-                self.callbackLock.release()
-            # self.ioLoopInst.add_callback(Web.sendDataMessage, msg)
-        return callId, reqConn
+
+    def selectConnection(self, msg):
+        """Choose the connection to send a new request on"""
+        wsConnections = self.getConnections()
+        if len(wsConnections) == 0:
+            serviceName = 'DataService'
+            if self.name == 'wsSubject':
+                serviceName = 'SubjectService'
+            raise StateError(f"RemoteService: {serviceName} not connected. Please start the remote service.")
+        with self.loadLock:
+            className = msg.get('class')
+            if self.statefulAffinity and isStatefulRequest(msg):
+                reqConn = self.affinityConns.get(className)
+                if reqConn in wsConnections:
+                    return reqConn
+                reqConn = self._leastLoaded(wsConnections)
+                self.affinityConns[className] = reqConn
+                return reqConn
+            return self._leastLoaded(wsConnections)
+
+    def _leastLoaded(self, wsConnections):
+        # Called with loadLock held. On ties prefer the most recent connection
+        return min(reversed(wsConnections), key=lambda conn: self.connLoad.get(conn, 0))
+
+    def _removeCall(self, callId):
+        """Remove a finished call and update its connection's outstanding count"""
+        pendingCall = self.dataCallbacks.pop(callId, None)
+        if pendingCall is not None:
+            with self.loadLock:
+                numCalls = self.connLoad.get(pendingCall.dataConn, 0) - 1
+                if numCalls > 0:
+                    self.connLoad[pendingCall.dataConn] = numCalls
+                else:
+                    self.connLoad.pop(pendingCall.dataConn, None)
+        return pendingCall
+
+    def _ackCall(self, pendingCall):
+        """Record that a session's call is complete, its replies won't be needed again"""
+        sessionId = getattr(pendingCall.dataConn, 'sessionId', None)
+        if sessionId is not None:
+            with self.loadLock:
+                self.sessionAcks.setdefault(sessionId, []).append(pendingCall.callId)
 
     # Step 2: Receive a reply and match up the orig callback structure, 
     #   then call semaphore release on that callback struct to trigger waiting threads
     def callback(self, client, message):
         """Recieve a callback from the client and match it to the original request that was sent."""
-        response = json.loads(message)
+        if isinstance(message, bytes):
+            # binary frame with a json header followed by the raw data
+            response = unpackBinaryFrame(message)
+        else:
+            response = json.loads(message)
         if 'cmd' not in response:
             raise StateError('dataCallback: cmd field missing from response: {}'.format(response))
         if 'status' not in response:
@@ -250,125 +550,192 @@ class RequestHandler:
         callId = response.get('callId', -1)
         origCmd = response.get('cmd', 'NoCommand')
         logging.log(DebugLevels.L6, "callback {}: {} {}".format(callId, origCmd, status))
-        # numParts = response.get('numParts')
-        # partId = response.get('partId')
-        # print(f'callback {callId}: {origCmd} {status} numParts {numParts} partId {partId}')
-        # Thread Synchronized Section
-        self.callbackLock.acquire()
-        try:
-            callbackStruct = self.dataCallbacks.get(callId, None)
-            if callbackStruct is None:
-                # print(f'webServer: dataCallback callId {callId} not found, current callId {self.dataSequenceNum}')
-                logging.error('webServer: dataCallback callId {} not found, current callId {}'
-                                .format(callId, self.dataSequenceNum))
-                return
-            if callbackStruct.callId != callId:
-                # This should never happen
-                raise StateError('callId mismtach {} {}'.format(callbackStruct.callId, callId))
-            callbackStruct.responses.append(response)
-            callbackStruct.numResponses += 1
-            callbackStruct.semaphore.release()
-        except Exception as err:
-            logging.error('webServer: dataCallback error: {}'.format(err))
-            raise err
-        finally:
-            self.callbackLock.release()
-        if time.time() > self.cbPruneTime:
-            self.cbPruneTime = time.time() + 60
-            self.pruneCallbacks()
+        subscription = self.subscriptions.get(callId)
+        if subscription is not None:
+            if response.get('subscriptionEnd') is True:
+                self.subscriptions.pop(callId, None)
+            subscription.onResponse(response)
+            return
+        pendingCall = self.dataCallbacks.get(callId, None)
+        if pendingCall is None:
+            logging.error('webServer: dataCallback callId {} not found'.format(callId))
+        else:
+            pendingCall.addResponse(response)
+        self.pruneCallbacks()
 
     # Step 3: Caller Wait for the semaphore signal indicating a reply has been received
     def get_response(self, callId, timeout=None):
         """Client calls get_response() to wait for the callback results to be returned."""
-        self.callbackLock.acquire()
-        try:
-            callbackStruct = self.dataCallbacks.get(callId, None)
-            if callbackStruct is None:
-                raise StateError('sendDataMsgFromThread: no callbackStruct found for callId {}'.format(callId))
-        finally:
-            self.callbackLock.release()
+        pendingCall = self.dataCallbacks.get(callId, None)
+        if pendingCall is None:
+            raise StateError('sendDataMsgFromThread: no callbackStruct found for callId {}'.format(callId))
         # wait for semaphore signal indicating a callback for this callId has occured
-        signaled = callbackStruct.semaphore.acquire(timeout=timeout)
+        signaled = pendingCall.semaphore.acquire(timeout=timeout)
         if signaled is False:
-            trimDictBytes(callbackStruct.msg)
+            trimDictBytes(pendingCall.msg)
             raise TimeoutError("sendDataMessage: Data Request Timed Out({}) {}".
-                                format(timeout, callbackStruct.msg))
-        self.callbackLock.acquire()
+                                format(timeout, pendingCall.msg))
         try:
-            # Remove from front of list not back to stay in order
-            # Can test removing from back of list to make sure out-of-order works too
-            response = callbackStruct.responses.pop(0)
-            if 'data' in response:
-                status = response.get('status', -1)
-                numParts = response.get('numParts', 1)
-                complete = (callbackStruct.numResponses == numParts and len(callbackStruct.responses) == 0)
-                if complete or status != 200:
-                    # End the multipart transfer
-                    response['incomplete'] = False
-                    self.dataCallbacks.pop(callId, None)
-                else:
-                    response['incomplete'] = True
-            else:
-                if len(callbackStruct.responses) != 0:
-                    print(f'callback num responses not zero {response}')
-                self.dataCallbacks.pop(callId, None)
+            # Remove from front of the queue to stay in order
+            response = pendingCall.responses.popleft()
         except IndexError:
-            trimDictBytes(callbackStruct.msg)
+            trimDictBytes(pendingCall.msg)
             raise StateError('sendDataMessage: callbackStruct.response is None for command {}'.
-                                format(callbackStruct.msg))
-        finally:
-            self.callbackLock.release()
-        response['callId'] = callbackStruct.callId
+                                format(pendingCall.msg))
+        if 'data' in response:
+            status = response.get('status', -1)
+            numParts = response.get('numParts', 1)
+            complete = (pendingCall.numResponses == numParts and len(pendingCall.responses) == 0)
+            if complete or status != 200:
+                # End the multipart transfer
+                response['incomplete'] = False
+                self._removeCall(callId)
+                self._ackCall(pendingCall)
+            else:
+                response['incomplete'] = True
+        else:
+            if len(pendingCall.responses) != 0:
+                print(f'callback num responses not zero {response}')
+            self._removeCall(callId)
+            self._ackCall(pendingCall)
+        response['callId'] = pendingCall.callId
         return response
 
-    def close_pending_requests(self):
-        """Close requests and signal any threads waiting for responses."""
-        self.callbackLock.acquire()
-        try:
+    def close_pending_requests(self, conn=None):
+        """
+        Close requests and signal any threads waiting for responses.
+        Args:
+            conn: the connection that closed, None to close all requests. Idempotent
+                requests with no reply yet are resent on another connection if one is available.
+                Otherwise if the connection has a session the requests are kept to be resent
+                when it reconnects.
+        """
+        sessionId = getattr(conn, 'sessionId', None) if conn is not None else None
+        journal = SessionJournal(sessionId)
+        for callId, pendingCall in self.dataCallbacks.copy().items():
+            if conn is not None and pendingCall.dataConn is not conn:
+                continue
+            if conn is not None and self.failoverCall(pendingCall):
+                continue
+            if sessionId is not None and pendingCall.sentMsg is not None:
+                journal.pendingCalls.append(pendingCall)
+                continue
             # signal the close to anyone waiting for replies
-            callIdsToRemove = []
-            for callId, cb in self.dataCallbacks.items():
-                if cb.dataConn == self:
-                    callIdsToRemove.append(callId)
-                    cb.status = 499
-                    cb.error = 'Client closed connection'
-                    # TODO - check this logic
-                    cb.responses.append({'cmd': 'unknown', 'status': cb.status, 'error': cb.error})
-                    for _ in range(len(cb.responses)):
-                        cb.semaphore.release()
-            for callId in callIdsToRemove:
-                self.dataCallbacks.pop(callId, None)
-        finally:
-            self.callbackLock.release()
+            if self._removeCall(callId) is not None:
+                pendingCall.fail(499, 'Client closed connection')
+        if conn is None:
+            for journal in list(self.sessionJournal.values()):
+                self.expireSession(journal)
+        elif len(journal.pendingCalls) > 0:
+            with self.loadLock:
+                journal.affinityClasses = [className for className, affinityConn
+                                           in self.affinityConns.items() if affinityConn is conn]
+            # a session that drops again before its requests expire keeps its first deadline
+            prevJournal = self.sessionJournal.get(sessionId)
+            if prevJournal is not None:
+                prevJournal.pendingCalls.extend(journal.pendingCalls)
+            else:
+                self.sessionJournal[sessionId] = journal
+                self.ioLoopInst.call_later(self.resumeSeconds, self.expireSession, journal)
+            logging.info(f'RequestHandler {self.name}: keeping {len(journal.pendingCalls)} '
+                         f'requests for session {sessionId} to reconnect')
+            # the session may have reconnected before the old connection's close was seen
+            for liveConn in self.getConnections():
+                if liveConn is not conn and getattr(liveConn, 'sessionId', None) == sessionId:
+                    self.resume_session(liveConn)
+                    break
+        for callId, subscription in self.subscriptions.copy().items():
+            if conn is not None and subscription.dataConn is not conn:
+                continue
+            if self.subscriptions.pop(callId, None) is not None:
+                subscription.onResponse({'cmd': 'subscribe', 'callId': callId, 'status': 499,
+                                         'error': 'Client closed connection',
+                                         'subscriptionEnd': True})
+        with self.loadLock:
+            self.connLoad.pop(conn, None)
+            for className, affinityConn in list(self.affinityConns.items()):
+                if conn is None or affinityConn is conn:
+                    del self.affinityConns[className]
+
+    def resume_session(self, conn):
+        """Resend the requests that were in flight when a session's previous connection dropped"""
+        journal = self.sessionJournal.pop(getattr(conn, 'sessionId', None), None)
+        if journal is None:
+            return
+        logging.info(f'RequestHandler {self.name}: session {conn.sessionId} reconnected, '
+                     f'resending {len(journal.pendingCalls)} requests')
+        wsConnections = self.getConnections()
+        with self.loadLock:
+            # stateful requests go back to the session that holds their state
+            for className in journal.affinityClasses:
+                if self.affinityConns.get(className) not in wsConnections:
+                    self.affinityConns[className] = conn
+        for pendingCall in journal.pendingCalls:
+            if self.dataCallbacks.get(pendingCall.callId) is not pendingCall:
+                # the call expired
+                continue
+            with self.loadLock:
+                pendingCall.dataConn = conn
+                self.connLoad[conn] = self.connLoad.get(conn, 0) + 1
+            self.ioLoopInst.add_callback(sendWebSocketMessage, wsName=self.name,
+                                         msg=markResent(pendingCall.sentMsg), conn=conn)
+
+    def expireSession(self, journal):
+        """Fail the journaled requests of a session that didn't reconnect in time"""
+        if self.sessionJournal.get(journal.sessionId) is not journal:
+            # the session already reconnected
+            return
+        del self.sessionJournal[journal.sessionId]
+        with self.loadLock:
+            self.sessionAcks.pop(journal.sessionId, None)
+        logging.info(f'RequestHandler {self.name}: session {journal.sessionId} did not reconnect')
+        for pendingCall in journal.pendingCalls:
+            if self.dataCallbacks.get(pendingCall.callId) is not pendingCall:
+                continue
+            if self._removeCall(pendingCall.callId) is not None:
+                pendingCall.fail(499, 'Client closed connection')
+
+    def failoverCall(self, pendingCall) -> bool:
+        """Resend an idempotent request on another connection, returns False if it can't be"""
+        if (pendingCall.sentMsg is None or pendingCall.numResponses > 0 or
+                not isIdempotentRequest(pendingCall.msg)):
+            return False
+        wsConnections = [c for c in self.getConnections() if c is not pendingCall.dataConn]
+        if len(wsConnections) == 0:
+            return False
+        with self.loadLock:
+            newConn = self._leastLoaded(wsConnections)
+            self.connLoad[newConn] = self.connLoad.get(newConn, 0) + 1
+            oldConn = pendingCall.dataConn
+            pendingCall.dataConn = newConn
+            numCalls = self.connLoad.get(oldConn, 0) - 1
+            if numCalls > 0:
+                self.connLoad[oldConn] = numCalls
+            else:
+                self.connLoad.pop(oldConn, None)
+        logging.info(f'RequestHandler {self.name}: resending callId {pendingCall.callId} '
+                     f'on another connection')
+        self.ioLoopInst.add_callback(sendWebSocketMessage, wsName=self.name,
+                                     msg=pendingCall.sentMsg, conn=newConn)
+        return True
 
     def pruneCallbacks(self):
         """Remove any orphaned callback structures that never got a response back."""
-        numWaitingCallbacks = len(self.dataCallbacks)
-        if numWaitingCallbacks == 0:
+        now = time.time()
+        expiryHeap = self.expiryHeap
+        if len(expiryHeap) == 0 or expiryHeap[0][0] > now:
             return
-        logging.info(f'RequestHandler {self.name} pruneCallbacks: checking {numWaitingCallbacks} callbaks')
-        self.callbackLock.acquire()
-        try:
-            maxSeconds = 300
-            now = time.time()
-            callIdsToRemove = []
-            for callId in self.dataCallbacks.keys():
-                # check how many seconds old each callback is
-                cb = self.dataCallbacks[callId]
-                secondsElapsed = now - cb.timeStamp
-                if secondsElapsed > maxSeconds:
-                    # older than max threshold so remove
-                    callIdsToRemove.append(callId)
-                    cb.status = 400
-                    cb.error = 'Callback time exceeded max threshold {}s {}s'.format(maxSeconds, secondsElapsed)
-                    cb.responses.append({'cmd': 'unknown', 'status': cb.status, 'error': cb.error})
-                    for _ in range(len(cb.responses)):
-                        cb.semaphore.release()
-            for callId in callIdsToRemove:
-                self.dataCallbacks.pop(callId, None)
-        except Exception as err:
-            logging.error(f'RequestHandler {self.name} pruneCallbacks: error {err}')
-        finally:
-            self.callbackLock.release()
+        expiredCalls = []
+        with self.expiryLock:
+            while len(expiryHeap) > 0 and expiryHeap[0][0] <= now:
+                _, callId = heapq.heappop(expiryHeap)
+                pendingCall = self._removeCall(callId)
+                if pendingCall is not None:
+                    expiredCalls.append(pendingCall)
+        for pendingCall in expiredCalls:
+            secondsElapsed = now - pendingCall.timeStamp
+            logging.info(f'RequestHandler {self.name} pruneCallbacks: removing callId {pendingCall.callId}')
+            pendingCall.fail(400, 'Callback time exceeded max threshold {}s {}s'.format(
+                                  self.maxCallbackSeconds, secondsElapsed))
 
 
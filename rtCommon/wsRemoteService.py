@@ -8,34 +8,207 @@ import sys
 import re
 import time
 import json
+import uuid
 import pickle
+import random
 import logging
 import argparse
 import threading
 import websocket
+from collections import OrderedDict
 from rtCommon.remoteable import RemoteHandler
 from rtCommon.utils import DebugLevels, trimDictBytes, md5SumFile
 from rtCommon.errors import StateError
 from rtCommon.serialization import decodeByteTypeArgs, generateDataParts
+from rtCommon.serialization import binaryFramesHeader, packBinaryFrame
+from rtCommon.serialization import rpcCodecHeader, decodeRpcMessage
+from rtCommon.serialization import canPickleOOB, encodePickleOOB
+from rtCommon.compression import CompressionPolicy, codecsHeader, availableCodecs
+import rtCommon.requestWorkerPool as requestWorkerPool
+from rtCommon.requestWorkerPool import RequestWorkerPool, ControlLane, InteractiveLane, BulkLane
+from rtCommon.rpcTracing import RpcTrace
+from rtCommon.webSocketHandlers import sessionHeader
 from rtCommon.projectUtils import login, checkSSLCertAltName, makeSSLCertFile
 from rtCommon.certsUtils import getSslCertFilePath, getSslKeyFilePath
 
+# Requests that are run immediately when received rather than queued
+controlRequests = {'ping', 'getClockSkew', 'getAllowedFileTypes', 'getQueueMetrics'}
+# Requests run in the bulk lane of the worker pool, all others use the interactive lane
+bulkRequests = {'getFile', 'getNewestFile', 'putFile', 'listFiles', 'listDirs',
+                'getFiles', 'putFiles', 'getFileSignature', 'getFileDelta', 'putFileDelta',
+                'getFileChunk', 'putFileChunk', 'getPartialFileChunkHashes', 'commitPartialFile',
+                'initBidsStream', 'initOpenNeuroStream'}
+# Reconnect delays: the first reconnect is immediate, then the delay doubles from
+#   minReconnectDelay up to the --interval arg, with random jitter
+minReconnectDelay = 0.1
+# A connection that stays open this many seconds resets the reconnect delay
+stableConnectionSeconds = 10
+
+
+def reconnectDelay(attempt, maxDelay) -> float:
+    """Seconds to wait before reconnect attempt number attempt (0 based)"""
+    if attempt == 0:
+        return 0
+    delay = min(maxDelay, minReconnectDelay * 2 ** (attempt - 1))
+    # jitter so that remote services don't all reconnect at once after a server restart
+    return delay * random.uniform(0.5, 1.0)
+
+
+def requestLane(request):
+    """Returns the worker pool lane a request should run in"""
+    if request.get('cmd') == 'rpcBatch':
+        attributes = [call.get('attribute') for call in request.get('calls', [])]
+    else:
+        attributes = [request.get('attribute')]
+    if len(attributes) > 0 and all(attr in controlRequests for attr in attributes):
+        return ControlLane
+    if any(attr in bulkRequests for attr in attributes):
+        return BulkLane
+    return InteractiveLane
+
+
+class RemoteSession:
+    """
+    The remote service side of a session with the projectServer, which persists across
+    websocket reconnects. Replies are sent on the session's current connection, and the
+    reply frames of recent calls are logged until the projectServer acknowledges that it
+    received them (see ackCalls). When the projectServer resends the requests in flight
+    after a reconnect (marked 'resend'), the calls already received are not run again,
+    their logged replies are resent instead, or an error if the replies exceeded the log.
+    """
+    def __init__(self, maxLogBytes=64 * 2**20, maxLogCalls=1000):
+        """
+        Args:
+            maxLogBytes: max total size of the logged reply frames
+            maxLogCalls: max number of calls to log the replies of
+        """
+        self.sessionId = uuid.uuid4().hex
+        self.client = None
+        self.maxLogBytes = maxLogBytes
+        self.maxLogCalls = maxLogCalls
+        # map from callId to the list of (frame, opcode) sent as its replies
+        self.replyLog = OrderedDict()
+        self.logBytes = 0
+        # callIds of the calls whose replies were removed from the log to stay within the limits
+        self.unloggedCalls = OrderedDict()
+        # callIds of the calls being run
+        self.activeCalls = set()
+        self.lock = threading.Lock()
+
+    def setClient(self, client):
+        """Set the current connection, None when disconnected"""
+        with self.lock:
+            self.client = client
+
+    def clearClient(self, client):
+        with self.lock:
+            if self.client is client:
+                self.client = None
+
+    def startCall(self, request):
+        """
+        Record a received request.
+        Returns:
+            None if the request should be run, or for a resent request that was already
+            received the list of (frame, opcode) replies to resend
+        """
+        callId = request.get('callId')
+        with self.lock:
+            if request.get('resend') is True:
+                if callId in self.replyLog:
+                    return list(self.replyLog[callId])
+                if callId in self.unloggedCalls:
+                    # the replies can't be resent, and running the call again may not be safe
+                    errorResponse = {'cmd': request.get('cmd'), 'callId': callId, 'status': 500,
+                                     'error': 'RemoteSession: reply too large to resend'}
+                    return [(json.dumps(errorResponse), websocket.ABNF.OPCODE_TEXT)]
+                if callId in self.activeCalls:
+                    # the replies weren't logged, but the call is still running
+                    return []
+            self.activeCalls.add(callId)
+            self._removeLog(callId)
+            self.replyLog[callId] = []
+            while len(self.replyLog) > self.maxLogCalls:
+                self._evictLog(next(iter(self.replyLog)))
+        return None
+
+    def endCall(self, callId):
+        with self.lock:
+            self.activeCalls.discard(callId)
+
+    def ackCalls(self, callIds):
+        """Remove the logged replies of calls the projectServer has received in full"""
+        with self.lock:
+            for callId in callIds:
+                self._removeLog(callId)
+
+    def send(self, frame, opcode, callId=None):
+        """Log a reply frame and send it on the current connection"""
+        with self.lock:
+            frames = self.replyLog.get(callId)
+            if frames is not None:
+                frames.append((frame, opcode))
+                self.logBytes += len(frame)
+                # remove the oldest logs, including this call's if it alone is too large
+                while self.logBytes > self.maxLogBytes:
+                    self._evictLog(next(iter(self.replyLog)))
+            client = self.client
+        if client is None:
+            # the reply is resent if the request is resent after reconnecting
+            return
+        try:
+            client.send(frame, opcode=opcode)
+        except Exception as err:
+            logging.info(f'RemoteSession: reply for callId {callId} not sent: {err}')
+
+    def _removeLog(self, callId):
+        # Called with the lock held
+        frames = self.replyLog.pop(callId, None)
+        if frames is not None:
+            self.logBytes -= sum(len(frame) for frame, _ in frames)
+
+    def _evictLog(self, callId):
+        # Called with the lock held
+        self._removeLog(callId)
+        self.unloggedCalls[callId] = True
+        while len(self.unloggedCalls) > self.maxLogCalls:
+            self.unloggedCalls.popitem(last=False)
+
+
 class WsRemoteService:
     remoteHandler = RemoteHandler()
     commLock = threading.Lock()
     shouldExit = False
+    # Selects the compression codec for results based on measured performance
+    compressionPolicy = CompressionPolicy()
+    # Worker threads that run the received requests
+    workerPool = None
+    # map from the callId of each active subscription to the event that stops it
+    subscriptions = {}
 
-    def __init__(self, args, channelName):
+    def __init__(self, args, channelName, numWorkers=8, maxBulkWorkers=None):
         """
         Args:
             args: Argparse args for establishing a connection to the projectServer
             channelName: the websocket channel to connect on, e.g. 'wsData'
+            numWorkers: number of threads for running requests
+            maxBulkWorkers: max threads running bulk requests (such as file
+                transfers) at once, defaults to half of numWorkers
+            (numWorkers and maxBulkWorkers are taken from args if set there)
         """
+        numWorkers = getattr(args, 'numWorkers', None) or numWorkers
+        maxBulkWorkers = getattr(args, 'maxBulkWorkers', None) or maxBulkWorkers
+        if WsRemoteService.workerPool is None:
+            WsRemoteService.workerPool = RequestWorkerPool(numWorkers, maxBulkWorkers)
+            # the handler classes report the queue metrics with getQueueMetrics()
+            requestWorkerPool.servicePool = WsRemoteService.workerPool
         self.channelName = channelName
         self.args = args
         self.sessionCookie = None
         self.needLogin = True
         self.started = False
+        # persists across reconnects so the projectServer can resend requests in flight
+        self.session = RemoteSession()
 
         # # Starts the receiver in it's own thread
         # self.recvThread = threading.Thread(name='recvThread', target=self.wsReceiver)
@@ -51,15 +224,22 @@ class WsRemoteService:
         WsRemoteService.remoteHandler.registerClassNameInstance(className, classInstance)
 
     def runForever(self):
-        """Run the receiver loop. This function doesn't return."""
+        """
+        Run the receiver loop. This function doesn't return.
+        When the connection drops it reconnects immediately and then with increasing
+        delays, reusing the login session cookie until the projectServer rejects it.
+        """
         # go into loop trying to do webSocket connection periodically
         args = self.args
         # print(f'args {self.args}')
         WsRemoteService.shouldExit = False
+        reconnectAttempt = 0
         while not WsRemoteService.shouldExit:
+            openTime = None
             try:
                 if self.needLogin or self.sessionCookie is None:
                     self.sessionCookie = login(args.server, args.username, args.password, testMode=args.test)
+                    self.needLogin = False
                 wsAddr = os.path.join('wss://', args.server, self.channelName)
                 if args.test:
                     print("Warning: using non-encrypted connection for test mode")
@@ -69,18 +249,35 @@ class WsRemoteService:
                     sslopts = {"ca_certs": getSslCertFilePath()}
                 logging.log(DebugLevels.L6, "Trying connection: %s", wsAddr)
                 ws = websocket.WebSocketApp(wsAddr,
+                                            on_open=WsRemoteService.on_open,
                                             on_message=WsRemoteService.on_message,
                                             on_close=WsRemoteService.on_close,
                                             on_error=WsRemoteService.on_error,
-                                            cookie="login="+self.sessionCookie)
+                                            cookie="login="+self.sessionCookie,
+                                            header=[f'{binaryFramesHeader}: 1',
+                                                    f'{codecsHeader}: {",".join(availableCodecs())}',
+                                                    f'{sessionHeader}: {self.session.sessionId}',
+                                                    f'{rpcCodecHeader}: 1'])
+                ws.session = self.session
+                ws.openTime = None
+                ws.authFailed = False
                 logging.log(logging.INFO, "Connected to: %s", wsAddr)
                 print("Connected to: {}".format(wsAddr))
                 self.started = True
                 ws.run_forever(sslopt=sslopts, ping_interval=5, ping_timeout=1)
+                openTime = ws.openTime
+                if ws.authFailed:
+                    # the session cookie is no longer valid
+                    self.needLogin = True
             except Exception as err:
                 logging.log(logging.INFO, "WsRemoteService Exception {}: {}".format(type(err).__name__, str(err)))
-            print('sleep {}'.format(args.interval))
-            time.sleep(args.interval)
+            if openTime is not None and time.time() - openTime >= stableConnectionSeconds:
+                reconnectAttempt = 0
+            delay = reconnectDelay(reconnectAttempt, args.interval)
+            reconnectAttempt += 1
+            if delay > 0:
+                print('sleep {:.1f}'.format(delay))
+                time.sleep(delay)
 
     @staticmethod
     def stop():
@@ -88,57 +285,93 @@ class WsRemoteService:
 
     @staticmethod
     def send_response(client, response):
+        if response.get('binaryData') is True:
+            # raw data bytes are sent after a json header in a binary frame
+            frame = packBinaryFrame(response)
+            opcode = websocket.ABNF.OPCODE_BINARY
+        else:
+            frame = json.dumps(response)
+            opcode = websocket.ABNF.OPCODE_TEXT
         WsRemoteService.commLock.acquire()
         try:
-            client.send(json.dumps(response))
+            startTime = time.time()
+            if isinstance(client, RemoteSession):
+                client.send(frame, opcode, callId=response.get('callId'))
+            else:
+                client.send(frame, opcode=opcode)
+            # use the send time to estimate the link bandwidth
+            WsRemoteService.compressionPolicy.recordTransfer(len(frame), time.time() - startTime)
         finally:
             WsRemoteService.commLock.release()
 
     @staticmethod
-    def handle_request(client, message):
+    def handle_request(client, request, receivedTime=None):
         """
         Handle requests from the projectServer. It will call
         the registered handler to process the request and then
         return the result back to the projectServer.
+        Args:
+            client: the websocket connection or RemoteSession to reply on
+            request: the decoded json request
+            receivedTime: time.perf_counter() when the request was received
         """
+        try:
+            WsRemoteService._handle_request(client, request, receivedTime)
+        finally:
+            if isinstance(client, RemoteSession):
+                client.endCall(request.get('callId'))
+
+    @staticmethod
+    def _handle_request(client, request, receivedTime=None):
         response = {'status': 400, 'error': 'unhandled request'}
         cmd = 'unknown'
+        trace = None
+        if request.get('traceId') is not None:
+            # the projectServer traces this call, the span times are returned in the replies
+            trace = RpcTrace(request.get('attribute'), request.get('traceId'))
+            if receivedTime is not None:
+                trace.addSpan('queue', time.perf_counter() - receivedTime)
         try:
-            request = json.loads(message)
+            # byte args of projectServers that don't encode requests with encodeRpcMessage
             request = decodeByteTypeArgs(request)
+            if request.get('cmd') == 'rpcBatch':
+                request['calls'] = [decodeByteTypeArgs(call) for call in request.get('calls', [])]
             # print(f'on_message: message {request} type: {type(request)}')
             # create the response message but without data objects
-            response = {k: v for k, v in request.items() if k not in {'data', 'args', 'kwargs'}}
+            response = {k: v for k, v in request.items() if k not in {'data', 'args', 'kwargs', 'calls', 'codecs', 'oobPickle'}}
+            # The projectServer sets binaryFrames if it can receive binary frame replies
+            binaryFrame = (request.get('binaryFrames') is True)
             trimDictBytes(response)
             cmd = request.get('cmd')
             # decode any encoded byte args
+            startTime = time.perf_counter()
             callResult = WsRemoteService.remoteHandler.runRemoteCall(request)
+            serializeTime = time.perf_counter()
             # serialize and return the callResult data
             # print(f'callresult type: {type(callResult)}')
             # TODO - move all this encoding code to a function such as
             #   encodeResultMessage() or similar
 
-            if isNativeType(callResult):
-                if type(callResult) == bytes:
-                    data = callResult
-                    response['dataSerialization'] = 'bytes'
-                else:
-                    # encode to json and then as a byte array
-                    data = json.dumps(callResult).encode()
-                    response['dataSerialization'] = 'json'
-            else:
-                # note pickle produces a byte array also
-                data = pickle.dumps(callResult)
-                response['dataSerialization'] = 'pickle'
-            if type(data) != bytes:
-                raise StateError(f"WsRemoteService: on_message: expecting callResult type " \
-                                 f"bytes: got {type(data)}")
+            data = serializeResult(callResult, request, response)
             response['status'] = 200
-            compress = False
-            if len(data) > 1024 * 1024:
-                compress = True
-            for msgPart in generateDataParts(data, response, compress=compress):
+            if trace is not None:
+                trace.addSpan('execute', serializeTime - startTime)
+                trace.addSpan('serialize', time.perf_counter() - serializeTime)
+            # The request lists the codecs the projectServer can decode (None for older servers)
+            compress = WsRemoteService.compressionPolicy.selectCodec(data, request.get('codecs'))
+            encodeStart = time.perf_counter()
+            for msgPart in generateDataParts(data, response, compress=compress,
+                                             binaryFrame=binaryFrame):
+                if trace is not None:
+                    # each part reports the span times so far, including the
+                    #   encode and send times of the previous parts
+                    sendStart = time.perf_counter()
+                    trace.addSpan('encode', sendStart - encodeStart)
+                    msgPart['trace'] = dict(trace.spans)
                 WsRemoteService.send_response(client, msgPart)
+                if trace is not None:
+                    encodeStart = time.perf_counter()
+                    trace.addSpan('send', encodeStart - sendStart)
         except Exception as err:
             errStr = "RPC Exception: {}: {}".format(cmd, err)
             print(errStr)
@@ -148,19 +381,103 @@ class WsRemoteService:
                 sys.exit()
             return
 
+    @staticmethod
+    def handle_subscribe(client, request):
+        """
+        Handle a subscribe request from the projectServer. The requested generator method
+        is run and each item it yields, an (index, result) tuple, is sent as a reply as soon
+        as it is available. The generator yields None while waiting for the next item so
+        that an unsubscribe request can stop it. A final reply with 'subscriptionEnd'
+        is sent when the generator finishes.
+        """
+        callId = request.get('callId')
+        stopEvent = threading.Event()
+        WsRemoteService.subscriptions[callId] = stopEvent
+        response = {k: v for k, v in request.items() if k not in {'data', 'args', 'kwargs', 'codecs', 'oobPickle'}}
+        trimDictBytes(response)
+        generator = None
+        try:
+            request = decodeByteTypeArgs(request)
+            binaryFrame = (request.get('binaryFrames') is True)
+            generator = WsRemoteService.remoteHandler.runRemoteCall(request)
+            for item in generator:
+                if stopEvent.is_set():
+                    break
+                if item is None:
+                    continue
+                index, result = item
+                itemResponse = response.copy()
+                itemResponse['subscriptionIndex'] = index
+                data = serializeResult(result, request, itemResponse)
+                compress = WsRemoteService.compressionPolicy.selectCodec(data, request.get('codecs'))
+                for msgPart in generateDataParts(data, itemResponse, compress=compress,
+                                                 binaryFrame=binaryFrame):
+                    WsRemoteService.send_response(client, msgPart)
+            endResponse = dict(response, status=200, subscriptionEnd=True)
+        except Exception as err:
+            errStr = "Subscription Exception: {}: {}".format(request.get('attribute'), err)
+            logging.error(errStr)
+            endResponse = dict(response, status=400, error=errStr, subscriptionEnd=True)
+        finally:
+            WsRemoteService.subscriptions.pop(callId, None)
+            if generator is not None:
+                generator.close()
+        if not stopEvent.is_set():
+            try:
+                WsRemoteService.send_response(client, endResponse)
+            except Exception as err:
+                logging.info(f'WsRemoteService: subscription end not sent: {err}')
+
     @staticmethod
     def on_message(client, message):
         """
         Main message dispatcher that will get a request from projectServer
-        and start a thread to handle the request.
+        and queue it to be handled by the worker pool.
         """
-        # Spin off a thread for each request, passing in the client arg so
-        #   the thread can call client.send to reply
-        requestThread = threading.Thread(name='requestThread',
-                                         target=WsRemoteService.handle_request,
-                                         args=(client, message))
-        requestThread.setDaemon(True)
-        requestThread.start()
+        receivedTime = time.perf_counter()
+        try:
+            request = decodeRpcMessage(message)
+        except Exception as err:
+            logging.error(f'WsRemoteService: on_message: invalid request: {err}')
+            return
+        if request.get('cmd') == 'subscribe':
+            # subscriptions run for the length of the stream, so get their own thread
+            thread = threading.Thread(name='subscription', target=WsRemoteService.handle_subscribe,
+                                      args=(client, request))
+            thread.daemon = True
+            thread.start()
+            return
+        if request.get('cmd') == 'unsubscribe':
+            stopEvent = WsRemoteService.subscriptions.get(request.get('callId'))
+            if stopEvent is not None:
+                stopEvent.set()
+            return
+        if request.get('cmd') == 'error' and request.get('status') == 401:
+            # the projectServer rejected the session cookie, login again on reconnect
+            logging.warning(f"WsRemoteService: {request.get('error')}")
+            client.authFailed = True
+            return
+        # Replies are sent through the session so they reach the projectServer
+        #   even if the connection is replaced while the request runs
+        session = getattr(client, 'session', None)
+        # calls whose replies the projectServer has received in full
+        ackCallIds = request.pop('ackCallIds', None)
+        if session is not None:
+            if ackCallIds is not None:
+                session.ackCalls(ackCallIds)
+            resendFrames = session.startCall(request)
+            if resendFrames is not None:
+                logging.info(f"WsRemoteService: resending {len(resendFrames)} replies "
+                             f"for callId {request.get('callId')}")
+                with WsRemoteService.commLock:
+                    for frame, opcode in resendFrames:
+                        client.send(frame, opcode=opcode)
+                return
+            client = session
+        # Pass in the client arg so the worker can call client.send to reply
+        WsRemoteService.workerPool.submit(requestLane(request),
+                                          WsRemoteService.handle_request,
+                                          client, request, receivedTime)
         return
 
     @staticmethod
@@ -171,11 +488,48 @@ class WsRemoteService:
             logging.log(logging.WARNING, "on_error: WsRemoteService: {} {}".
                         format(type(error), str(error)))
 
+    @staticmethod
+    def on_open(client):
+        client.openTime = time.time()
+        session = getattr(client, 'session', None)
+        if session is not None:
+            session.setClient(client)
+
     @staticmethod
     def on_close(client, code, reason):
         print('## Connection closed, check if projectServer allows remote services.')
         print('## May need to restart projectServer with --dataRemote --subjectRemote options.')
         logging.info(f'Connection closed {code} {reason}')
+        session = getattr(client, 'session', None)
+        if session is not None:
+            session.clearClient(client)
+        # stop the subscriptions, the projectServer ends them when the connection closes
+        for stopEvent in list(WsRemoteService.subscriptions.values()):
+            stopEvent.set()
+
+
+def serializeResult(callResult, request, response) -> bytes:
+    """Serialize a call result for the reply, sets the response 'dataSerialization'"""
+    if isNativeType(callResult):
+        if type(callResult) == bytes:
+            data = callResult
+            response['dataSerialization'] = 'bytes'
+        else:
+            # encode to json and then as a byte array
+            data = json.dumps(callResult).encode()
+            response['dataSerialization'] = 'json'
+    elif request.get('oobPickle') is True and canPickleOOB():
+        # send numpy array data as raw buffers outside of the pickle stream
+        data = encodePickleOOB(callResult)
+        response['dataSerialization'] = 'pickle5'
+    else:
+        # note pickle produces a byte array also
+        data = pickle.dumps(callResult)
+        response['dataSerialization'] = 'pickle'
+    if type(data) != bytes:
+        raise StateError(f"WsRemoteService: on_message: expecting callResult type " \
+                         f"bytes: got {type(data)}")
+    return data
 
 
 def isNativeType(var):
@@ -192,13 +546,17 @@ def parseConnectionArgs():
     parser.add_argument('-s', '--server', action="store", dest="server", default="localhost:8888",
                         help="Server Address with Port [server:port]")
     parser.add_argument('-i', '--interval', action="store", dest="interval", type=int, default=5,
-                        help="Retry connection interval (seconds)")
+                        help="Max retry connection interval (seconds)")
     parser.add_argument('-u', '--username', action="store", dest="username", default=None,
                         help="rtcloud website username")
     parser.add_argument('-p', '--password', action="store", dest="password", default=None,
                         help="rtcloud website password")
     parser.add_argument('--test', default=False, action='store_true',
                         help='Use unsecure non-encrypted connection')
+    parser.add_argument('--workers', action="store", dest="numWorkers", type=int, default=8,
+                        help="Number of threads for running requests")
+    parser.add_argument('--bulkWorkers', action="store", dest="maxBulkWorkers", type=int, default=None,
+                        help="Max threads running bulk requests such as file transfers")
     args, _ = parser.parse_known_args()
 
     if not re.match(r'.*:\d+', args.server):
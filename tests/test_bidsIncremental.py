@@ -452,4 +452,26 @@ def test_bidsTimeToTr(validBidsI):
     now = dtime(hour=12, minute=47, second=57, microsecond=500000)
     clockSkew = 0.10
     secToTr = validBidsI.timeToNextTr(clockSkew, now=now)
-    assert math.isclose(secToTr, .2275)
\ No newline at end of file
+    assert math.isclose(secToTr, .2275)
+
+# Test an incremental can be sent as a delta against the cached stream base
+def test_streamDelta(validBidsI):
+    base = validBidsI.getStreamBase()
+    delta = validBidsI.getStreamDelta(base)
+    # Nothing but the voxels should be sent when the base matches
+    assert delta['changedMetadata'] == {}
+    assert delta['removedMetadata'] == []
+    for key in ['header', 'datasetDescription', 'readme', 'events']:
+        assert key not in delta
+    assert BidsIncremental.fromStreamDelta(delta, base) == validBidsI
+
+    # Changed metadata is sent in the delta
+    nextBidsI = deepcopy(validBidsI)
+    nextBidsI.setMetadataField('AcquisitionTime', '12:47:57.827500')
+    nextBidsI.readme = 'changed readme'
+    delta = nextBidsI.getStreamDelta(base)
+    assert delta['changedMetadata'] == {'AcquisitionTime': '12:47:57.827500'}
+    assert delta['readme'] == 'changed readme'
+    recreated = BidsIncremental.fromStreamDelta(delta, pickle.loads(pickle.dumps(base)))
+    assert recreated == nextBidsI
+    assert recreated != validBidsI
@@ -48,6 +48,7 @@ class TestBidsInterface:
         clientInterface = ClientInterface()
         bidsInterface = clientInterface.bidsInterface
         dicomStreamTest(bidsInterface)
+        dicomSubscriptionTest(bidsInterface)
         openNeuroStreamTest(bidsInterface)
 
     # bidsInterface created locally by the client (no projectServer)
@@ -58,6 +59,16 @@ class TestBidsInterface:
         dicomStreamTest(bidsInterface)
         # run again without dicom anonymization
         dicomStreamTest(bidsInterface, anonymize=False)
+        # unknown arguments aren't silently dropped
+        streamId = bidsInterface.initDicomBidsStream(test_sampleProjectDicomPath,
+                                                     "001_000013_{TR:06d}.dcm", 300*1024,
+                                                     subject='01', task='test', run=1)
+        with pytest.raises(TypeError):
+            bidsInterface.getIncremental(streamId, volIdx=1, badArg=True)
+        # closing the stream closes its scanner stream and file watch
+        dicomStream = bidsInterface.streamMap[streamId]
+        bidsInterface.closeStream(streamId)
+        assert len(dicomStream.dataInterface.streams) == 0
         openNeuroStreamTest(bidsInterface)
 
 
@@ -87,6 +98,29 @@ def readLocalDicomIncremental(volIdx, anonymize=True, **entities):
     return localIncremental
 
 
+def dicomSubscriptionTest(bidsInterface):
+    # The remote pushes each incremental, getIncremental returns them from the buffer
+    entities = {'subject': '01', 'task': 'test', 'run': 1, 'suffix': 'bold', 'datatype': 'func'}
+    streamId = bidsInterface.initDicomBidsStream(test_sampleProjectDicomPath,
+                                                 "001_000013_{TR:06d}.dcm",
+                                                 300*1024, anonymize=True,
+                                                 **entities)
+    bidsInterface.subscribeStream(streamId, startIndex=2)
+    for idx in [2, 3, 4]:
+        streamIncremental = bidsInterface.getIncremental(streamId, volIdx=idx)
+        localIncremental = readLocalDicomIncremental(idx, anonymize=True, **entities)
+        assert streamIncremental == localIncremental
+    # the next volume without a volIdx
+    streamIncremental = bidsInterface.getIncremental(streamId)
+    assert streamIncremental == readLocalDicomIncremental(5, anonymize=True, **entities)
+    # a volume before the subscription start is requested from the remote
+    streamIncremental = bidsInterface.getIncremental(streamId, volIdx=1)
+    assert streamIncremental == readLocalDicomIncremental(1, anonymize=True, **entities)
+    bidsInterface.unsubscribeStream(streamId)
+    streamIncremental = bidsInterface.getIncremental(streamId, volIdx=6)
+    assert streamIncremental == readLocalDicomIncremental(6, anonymize=True, **entities)
+
+
 def dicomStreamTest(bidsInterface, anonymize=True):
     # initialize the stream
     entities = {'subject': '01', 'task': 'test', 'run': 1, 'suffix': 'bold', 'datatype': 'func'}
@@ -0,0 +1,43 @@
+import os
+import pytest
+from rtCommon.errors import RequestError
+from rtCommon.compression import CompressionPolicy, availableCodecs, negotiateCodecs
+from rtCommon.compression import compressData, decompressData, legacyCodecs
+from rtCommon.serialization import encodeMessageData, decodeMessageData
+
+
+def test_codecs():
+    data = b'some repetitive data ' * 1000
+    for codec in availableCodecs():
+        compressed = compressData(codec, data)
+        assert decompressData(codec, compressed) == data
+        # the codec used is reported in the message header
+        msg = encodeMessageData({'test': codec}, data, compress=codec)
+        if codec != 'none':
+            assert msg['codec'] == codec
+        assert decodeMessageData(msg) == data
+    with pytest.raises(RequestError):
+        compressData('nocodec', data)
+
+
+def test_negotiateCodecs():
+    assert negotiateCodecs(None) is None
+    assert negotiateCodecs('zlib, lzma,nocodec') == ['zlib', 'lzma']
+
+
+def test_compressionPolicy():
+    policy = CompressionPolicy(minCompressSize=1024, sampleSize=64*1024)
+    compressible = b'\x00\x01' * (2**20)
+    random = os.urandom(2**20)
+    # small data is never compressed
+    assert policy.selectCodec(b'1234') == 'none'
+    # over a slow link compressible data should be compressed
+    policy.linkBandwidth = 2**20
+    codec = policy.selectCodec(compressible, legacyCodecs)
+    assert codec in legacyCodecs and codec != 'none'
+    # over a fast link random data isn't worth compressing
+    policy.linkBandwidth = 2**40
+    assert policy.selectCodec(random, legacyCodecs) == 'none'
+    # only codecs the receiver supports are chosen
+    policy.linkBandwidth = 2**20
+    assert policy.selectCodec(compressible, ['none', 'lzma']) in ('none', 'lzma')
@@ -1,13 +1,23 @@
 import pytest
 import os
+import asyncio
 import copy
 import time
 import math
 import shutil
+import threading
 import rtCommon.utils as utils
 from rtCommon.clientInterface import ClientInterface
 from rtCommon.dataInterface import DataInterface, uploadFilesToCloud, downloadFilesFromCloud
-from rtCommon.imageHandling import readDicomFromBuffer, readDicomFromFile
+from rtCommon.dataInterface import maxScannerStreams
+from rtCommon.dataInterface import getFileWithDelta, putFileWithDelta
+from rtCommon.dataInterface import streamGetFile, streamPutFile, uploadFilesFromList, downloadFilesFromList
+from rtCommon.dataInterface import partialFileSuffix, resumeTokenSuffix
+from rtCommon.fileArchive import iterFileArchive, packFileArchive, MemberData, MemberTooLarge
+from rtCommon.imageHandling import readDicomFromBuffer, readDicomFromFile, anonymizeDicom
+from rtCommon.imageReadAhead import ImageReadAhead
+from rtCommon.fileWatcher import PollingFileWatcher
+from rtCommon.requestWorkerPool import BulkLane, ControlLane
 from rtCommon.errors import ValidationError, RequestError
 import rtCommon.utils as utils
 from tests.backgroundTestServers import BackgroundTestServers
@@ -46,8 +56,15 @@ class TestDataInterface:
                                       allowedDirs=allowedDirs,
                                       allowedFileTypes=allowedFileTypes)
         runDataInterfaceMethodTests(dataInterface, dicomTestFilename)
+        # no remote service queues the requests of a local dataInterface
+        assert dataInterface.getQueueMetrics() is None
+        runStreamLimitTest(dataInterface)
+        runStreamGeneratorTest(dataInterface)
         runLocalFileValidationTests(dataInterface)
         runReadWriteFileTest(dataInterface, bigTestFile, isUsingProjectServer=False)
+        runDeltaSyncTest(dataInterface)
+        runStreamTransferTest(dataInterface)
+        runBulkTransferTest(dataInterface)
         return
 
     # Remote dataInterface test
@@ -64,11 +81,156 @@ class TestDataInterface:
         assert dataInterface.isRemote == False
         runDataInterfaceMethodTests(dataInterface, dicomTestFilename)
         runReadWriteFileTest(dataInterface, bigTestFile, isUsingProjectServer=True)
+        # The medium file's data returns through shared memory (when available) in well
+        #   under 0.1s, so test the timeout with a client receiving it over the rpyc socket
+        socketClientInterface = ClientInterface(rpyc_timeout=70, useSharedMemory=False)
         with pytest.raises(TimeoutError):
-            runRpcTimeoutTest(dataInterface, mediumTestFile, timeout=0.1)
+            runRpcTimeoutTest(socketClientInterface.dataInterface, mediumTestFile, timeout=0.1)
+        socketClientInterface.close()
         runRpcTimeoutTest(dataInterface, mediumTestFile, timeout=60)
+        runDeltaSyncTest(dataInterface)
+        runStreamTransferTest(dataInterface)
+        runBulkTransferTest(dataInterface)
+        # Test the asyncio facade
+        async def getFiles():
+            return await asyncio.gather(
+                clientInterface.asyncDataInterface.getFile(dicomTestFilename),
+                clientInterface.asyncDataInterface.getFile(mediumTestFile))
+        dicomData, mediumData = asyncio.run(getFiles())
+        for filename, data in ((dicomTestFilename, dicomData), (mediumTestFile, mediumData)):
+            with open(filename, 'rb') as fp:
+                assert data == fp.read()
+        clientInterface.close()
         return
 
+    # Images pushed from a remote dataInterface
+    def test_remoteScannerSubscription(self):
+        TestDataInterface.serversForTests.stopServers()
+        TestDataInterface.serversForTests.startServers(allowedDirs=allowedDirs,
+                                                       allowedFileTypes=allowedFileTypes,
+                                                       dataRemote=True,
+                                                       subjectRemote=False)
+        clientInterface = ClientInterface(rpyc_timeout=70)
+        dataInterface = clientInterface.dataInterface
+        assert clientInterface.isDataRemote() == True
+        filePattern = "001_000013_{TR:06d}.dcm"
+        streamId = dataInterface.initScannerStream(sampleProjectDicomDir, filePattern,
+                                                   300*1024, anonymize=False)
+        dataInterface.subscribeScannerStream(streamId, startIndex=0)
+        clientInterface.setRpcTracing(True)
+        requestStats = clientInterface.getRpcLatencyStats('DataInterface.getImageData')
+        for i in range(5):
+            streamImage = dataInterface.getImageData(streamId)
+            directImage = readDicomFromFile(os.path.join(sampleProjectDicomDir,
+                                                         filePattern.format(TR=i)))
+            assert streamImage == directImage
+        for i in [2, 6]:
+            streamImage = dataInterface.getImageData(streamId, i)
+            directImage = readDicomFromFile(os.path.join(sampleProjectDicomDir,
+                                                         filePattern.format(TR=i)))
+            assert streamImage == directImage
+        # the images were returned from the subscription without requests to the remote
+        assert clientInterface.getRpcLatencyStats('DataInterface.getImageData') == requestStats
+        dataInterface.unsubscribeStream(streamId)
+        streamImage = dataInterface.getImageData(streamId, 7)
+        assert streamImage == readDicomFromFile(os.path.join(sampleProjectDicomDir,
+                                                             filePattern.format(TR=7)))
+        # closing the stream also ends its subscription
+        dataInterface.subscribeScannerStream(streamId, startIndex=8)
+        dataInterface.closeScannerStream(streamId)
+        with pytest.raises(Exception):
+            dataInterface.getImageData(streamId, 8, timeout=1)
+        clientInterface.close()
+
+    # Bulk transfers through a remote dataInterface
+    def test_remoteBulkTransfer(self):
+        TestDataInterface.serversForTests.stopServers()
+        TestDataInterface.serversForTests.startServers(allowedDirs=allowedDirs,
+                                                       allowedFileTypes=allowedFileTypes,
+                                                       dataRemote=True,
+                                                       subjectRemote=False)
+        clientInterface = ClientInterface(rpyc_timeout=70)
+        dataInterface = clientInterface.dataInterface
+        assert clientInterface.isDataRemote() == True
+        runBulkTransferTest(dataInterface)
+        # the remote service reports the queue metrics of its request lanes
+        metrics = dataInterface.getQueueMetrics()
+        assert metrics[BulkLane]['completed'] > 0
+        assert metrics[BulkLane]['queued'] == 0
+        # this getQueueMetrics call runs in the control lane
+        assert metrics[ControlLane]['active'] >= 1
+        clientInterface.close()
+
+    # Streamed file written to the current directory (a filename without a directory)
+    def test_putFileChunkNoDir(self):
+        dataInterface = DataInterface(dataRemote=False, allowedDirs=['*'],
+                                      allowedFileTypes=['*'])
+        prevDir = os.getcwd()
+        os.makedirs(tmpDir, exist_ok=True)
+        os.chdir(tmpDir)
+        try:
+            dataInterface.putFileChunk('chunkNoDir.txt', 0, b'chunk1')
+            dataInterface.putFileChunk('chunkNoDir.txt', 6, b'chunk2')
+            dataInterface.commitPartialFile('chunkNoDir.txt', 12)
+            with open('chunkNoDir.txt', 'rb') as fp:
+                assert fp.read() == b'chunk1chunk2'
+        finally:
+            if os.path.exists('chunkNoDir.txt'):
+                os.remove('chunkNoDir.txt')
+            os.chdir(prevDir)
+
+    # Scanner stream whose files are found by polling the directory
+    def test_pollingScannerStream(self):
+        dataInterface = DataInterface(dataRemote=False,
+                                      allowedDirs=allowedDirs,
+                                      allowedFileTypes=allowedFileTypes,
+                                      usePolling=True)
+        assert isinstance(dataInterface.fileWatcher, PollingFileWatcher)
+        streamDir = os.path.join(tmpDir, 'pollingStream')
+        shutil.rmtree(streamDir, ignore_errors=True)
+        os.makedirs(streamDir)
+        filePattern = "001_000013_{TR:06d}.dcm"
+        streamId = dataInterface.initScannerStream(streamDir, filePattern, 300*1024,
+                                                   anonymize=False)
+        def writeImages():
+            for i in range(3):
+                time.sleep(0.2)
+                shutil.copy(os.path.join(sampleProjectDicomDir, filePattern.format(TR=i)),
+                            streamDir)
+        writeThread = threading.Thread(name='writeThread', target=writeImages)
+        writeThread.start()
+        try:
+            for i in range(3):
+                streamImage = dataInterface.getImageData(streamId, i, timeout=10)
+                assert streamImage == readDicomFromFile(
+                    os.path.join(sampleProjectDicomDir, filePattern.format(TR=i)))
+                assert dataInterface.fileWatcher.getFileArrival(
+                    filePattern.format(TR=i), dataInterface.streams[streamId].watchId) is not None
+            # the time from each image's arrival to its return is recorded
+            latencyStats = dataInterface.getStreamLatencyStats(streamId)
+            assert latencyStats['count'] == 3
+            assert 0 <= latencyStats['min'] <= latencyStats['max'] < 10
+        finally:
+            writeThread.join()
+            dataInterface.closeScannerStream(streamId)
+            shutil.rmtree(streamDir, ignore_errors=True)
+
+    # Stopping a read-ahead while it is reading an image isn't logged as an error
+    def test_readAheadStop(self, caplog):
+        readStarted = threading.Event()
+        watchRemoved = threading.Event()
+        def readFunc(imageIndex, timeout):
+            readStarted.set()
+            watchRemoved.wait(timeout=5)
+            raise KeyError('watch removed')
+        readAhead = ImageReadAhead(readFunc)
+        assert readStarted.wait(timeout=5)
+        readAhead.stop()
+        watchRemoved.set()
+        readAhead.readThread.join(timeout=5)
+        assert not readAhead.readThread.is_alive()
+        assert 'ImageReadAhead' not in caplog.text
+
     # PS note: it seems like this timeouts sometimes but not always when running test suite... 
     # for now I'm commenting it out so I can push the latest rtfin release. 
     # # Remote dataInterface test
@@ -86,6 +248,8 @@ class TestDataInterface:
     #     runDataInterfaceMethodTests(dataInterface, dicomTestFilename)
     #     runRemoteFileValidationTests(dataInterface)
     #     runUploadDownloadTest(dataInterface)
+    #     runDeltaSyncTest(dataInterface)
+    #     runStreamTransferTest(dataInterface)
     #     runReadWriteFileTest(dataInterface, bigTestFile, isUsingProjectServer=True)
     #     with pytest.raises(TimeoutError):
     #         runRpcTimeoutTest(dataInterface, mediumTestFile, timeout=0.1)
@@ -93,6 +257,38 @@ class TestDataInterface:
     #     return
 
 
+def runStreamLimitTest(dataInterface):
+    # opening more than maxScannerStreams streams closes the oldest ones
+    filePattern = "001_000013_{TR:06d}.dcm"
+    streamIds = [dataInterface.initScannerStream(sampleProjectDicomDir, filePattern, 300*1024,
+                                                 anonymize=False)
+                 for _ in range(maxScannerStreams + 2)]
+    assert list(dataInterface.streams.keys()) == streamIds[2:]
+    with pytest.raises(ValidationError):
+        dataInterface.getImageData(streamIds[0], 0, timeout=1)
+    streamImage = dataInterface.getImageData(streamIds[-1], 0)
+    assert streamImage == readDicomFromFile(os.path.join(sampleProjectDicomDir,
+                                                         filePattern.format(TR=0)))
+    for streamId in streamIds[2:]:
+        dataInterface.closeScannerStream(streamId)
+
+
+def runStreamGeneratorTest(dataInterface):
+    # the subscription generator doesn't move the stream's position
+    filePattern = "001_000013_{TR:06d}.dcm"
+    streamId = dataInterface.initScannerStream(sampleProjectDicomDir, filePattern, 300*1024,
+                                               anonymize=False)
+    generator = dataInterface.scannerStreamGenerator(streamId, startIndex=3)
+    assert next(generator)[0] == 3
+    assert next(generator)[0] == 4
+    streamImage = dataInterface.getImageData(streamId)
+    assert streamImage == readDicomFromFile(os.path.join(sampleProjectDicomDir,
+                                                         filePattern.format(TR=0)))
+    # the generator ends when the stream is closed
+    dataInterface.closeScannerStream(streamId)
+    assert list(generator) == []
+
+
 def runRpcTimeoutTest(dataInterface, testFileName, timeout=0):
     extraArgs = {'rpc_timeout': timeout}
     responseData = dataInterface.getFile(testFileName, **extraArgs)
@@ -145,6 +341,20 @@ def runDataInterfaceMethodTests(dataInterface, dicomTestFilename):
     data2 = dataInterface.getFile(dicomTestFilename)
     assert data1 == data2, 'getFile data assertion'
 
+    # Test async calls
+    print('test callAsync')
+    futures = [dataInterface.callAsync('getFile', dicomTestFilename) for _ in range(4)]
+    for future in futures:
+        assert future.result(timeout=60) == data1, 'callAsync getFile data assertion'
+
+    # Test batched calls
+    print('test batch')
+    with dataInterface.batch():
+        fileFuture = dataInterface.getFile(dicomTestFilename)
+        fileTypesFuture = dataInterface.getAllowedFileTypes()
+    assert fileFuture.result() == data1, 'batch getFile data assertion'
+    assert fileTypesFuture.result() == dataInterface.getAllowedFileTypes()
+
     # Test getNewestFile
     print('test getNewestFile')
     filePattern = os.path.splitext(dicomTestFilename)[0] + '*'
@@ -234,6 +444,43 @@ def runDataInterfaceMethodTests(dataInterface, dicomTestFilename):
     assert countUnanonymizedSensitiveAttrs(regImage) >= 1
     assert countUnanonymizedSensitiveAttrs(anonImage) == 0
 
+    # Test several streams open at once, each with its own file watch
+    regStreamId = dataInterface.initScannerStream(sampleProjectDicomDir,
+                                                  "001_000013_{TR:06d}.dcm",
+                                                  300*1024, anonymize=False)
+    anonStreamId = dataInterface.initScannerStream(sampleProjectDicomDir,
+                                                   "001_000013_{TR:06d}.dcm",
+                                                   300*1024, anonymize=True)
+    assert regStreamId != anonStreamId
+    for i in range(3):
+        assert dataInterface.getImageData(anonStreamId) != dataInterface.getImageData(regStreamId)
+    assert dataInterface.getImageData(regStreamId) == readDicomFromFile(
+        os.path.join(sampleProjectDicomDir, "001_000013_{TR:06d}.dcm".format(TR=3)))
+    dataInterface.closeScannerStream(anonStreamId)
+    with pytest.raises((ValidationError, Exception)):
+        dataInterface.getImageData(anonStreamId, 0)
+    assert dataInterface.getImageData(regStreamId, 4) == readDicomFromFile(
+        os.path.join(sampleProjectDicomDir, "001_000013_{TR:06d}.dcm".format(TR=4)))
+    dataInterface.closeScannerStream(regStreamId)
+
+    # Test a stream with read-ahead, images come from the read-ahead cache
+    streamId = dataInterface.initScannerStream(sampleProjectDicomDir,
+                                               "001_000013_{TR:06d}.dcm",
+                                               300*1024, anonymize=True,
+                                               readAhead=True, readAheadSize=4)
+    for i in range(8):
+        streamImage = dataInterface.getImageData(streamId)
+        assert streamImage == anonymizeDicom(readDicomFromFile(
+            os.path.join(sampleProjectDicomDir, "001_000013_{TR:06d}.dcm".format(TR=i))))
+    # an image no longer in the cache is read again
+    assert dataInterface.getImageData(streamId, 1) == anonymizeDicom(readDicomFromFile(
+        os.path.join(sampleProjectDicomDir, "001_000013_{TR:06d}.dcm".format(TR=1))))
+    if isinstance(dataInterface, DataInterface):
+        stats = dataInterface.streams[streamId].readAhead.getStats()
+        assert stats['hits'] >= 7 and stats['misses'] == 1
+        assert stats['cached'] <= 4
+    dataInterface.closeScannerStream(streamId)
+
     # Test timeouts of getImageData
     # set a directory and image pattern that won't exist so will timeout
     streamId = dataInterface.initScannerStream(tmpDir,
@@ -354,4 +601,133 @@ def runUploadDownloadTest(dataInterface):
     assert d3text1 == text1
     assert d3text2 == text2
     assert d3bin1 == bindata1
-    assert d3bin2 == bindata2
\ No newline at end of file
+    assert d3bin2 == bindata2
+
+def runDeltaSyncTest(dataInterface):
+    # A remote file changed in place and by an insertion is synced with a delta
+    remoteFile = os.path.join(tmpDir, 'deltaSync', 'remote.bin')
+    localFile = os.path.join(tmpDir, 'deltaSync', 'local.bin')
+    baseData = os.urandom(200 * 1024)
+    newData = baseData[:1000] + b'inserted' + baseData[1000:150000] + b'x' * 100 + baseData[150100:]
+    utils.writeFile(localFile, baseData)
+    utils.writeFile(remoteFile, newData)
+    assert getFileWithDelta(dataInterface, remoteFile, localFile) == newData
+    # Put the local version back to the remote file
+    putFileWithDelta(dataInterface, remoteFile, baseData)
+    assert utils.readFile(remoteFile) == baseData
+    # A remote file that doesn't exist is sent in full
+    os.remove(remoteFile)
+    putFileWithDelta(dataInterface, remoteFile, newData)
+    assert utils.readFile(remoteFile) == newData
+
+
+class FailingChunkInterface:
+    """Passes calls to a dataInterface, but fails chunk transfers after numChunks calls"""
+    def __init__(self, dataInterface, numChunks):
+        self.dataInterface = dataInterface
+        self.numChunks = numChunks
+
+    def __getattr__(self, name):
+        method = getattr(self.dataInterface, name)
+        if name not in ('getFileChunk', 'putFileChunk'):
+            return method
+        def chunkCall(*args, **kwargs):
+            if self.numChunks == 0:
+                raise ConnectionError('test transfer interrupted')
+            self.numChunks -= 1
+            return method(*args, **kwargs)
+        return chunkCall
+
+
+def runStreamTransferTest(dataInterface):
+    chunkSize = 64 * 1024
+    streamDir = os.path.join(tmpDir, 'streamTransfer')
+    shutil.rmtree(streamDir, ignore_errors=True)
+    remoteFile = os.path.join(streamDir, 'remote', 'data.bin')
+    localFile = os.path.join(streamDir, 'local', 'data.bin')
+    fileData = os.urandom(10 * chunkSize + 123)
+    utils.writeFile(remoteFile, fileData)
+    # An interrupted streamed get leaves a partial file and resume token, and resumes
+    interrupted = FailingChunkInterface(dataInterface, numChunks=4)
+    with pytest.raises(Exception):
+        streamGetFile(interrupted, remoteFile, localFile, chunkSize=chunkSize)
+    assert not os.path.exists(localFile)
+    assert os.path.getsize(localFile + partialFileSuffix) == 4 * chunkSize
+    resumed = FailingChunkInterface(dataInterface, numChunks=7)
+    streamGetFile(resumed, remoteFile, localFile, chunkSize=chunkSize)
+    assert resumed.numChunks == 0
+    assert utils.readFile(localFile) == fileData
+    assert not os.path.exists(localFile + partialFileSuffix)
+    assert not os.path.exists(localFile + resumeTokenSuffix)
+
+    # An interrupted streamed put resumes after the verified chunks at the remote
+    newData = os.urandom(5 * chunkSize)
+    utils.writeFile(localFile, newData)
+    interrupted = FailingChunkInterface(dataInterface, numChunks=3)
+    with pytest.raises(Exception):
+        streamPutFile(interrupted, localFile, remoteFile, chunkSize=chunkSize)
+    # the remote file is unchanged until the transfer completes
+    assert utils.readFile(remoteFile) == fileData
+    resumed = FailingChunkInterface(dataInterface, numChunks=2)
+    streamPutFile(resumed, localFile, remoteFile, chunkSize=chunkSize)
+    assert resumed.numChunks == 0
+    assert utils.readFile(remoteFile) == newData
+    assert not os.path.exists(remoteFile + partialFileSuffix)
+
+    # the upload/download helpers stream files of at least streamMinSize
+    uploadFilesFromList(dataInterface, [remoteFile], os.path.join(streamDir, 'upload'),
+                        streamMinSize=chunkSize)
+    assert utils.readFile(os.path.join(streamDir, 'upload', 'data.bin')) == newData
+    downloadFilesFromList(dataInterface, [localFile], os.path.join(streamDir, 'download'),
+                          streamMinSize=chunkSize)
+    assert utils.readFile(os.path.join(streamDir, 'download', 'data.bin')) == newData
+    # an empty file
+    emptyFile = os.path.join(streamDir, 'local', 'empty.bin')
+    utils.writeFile(emptyFile, b'')
+    streamPutFile(dataInterface, emptyFile, remoteFile)
+    assert utils.readFile(remoteFile) == b''
+
+
+def runBulkTransferTest(dataInterface):
+    bulkDir = os.path.join(tmpDir, 'bulkTransfer')
+    shutil.rmtree(bulkDir, ignore_errors=True)
+    srcDir = os.path.join(bulkDir, 'remote', 'session1')
+    fileData = {}
+    for i in range(20):
+        filename = os.path.join(srcDir, 'sub' if i % 2 else '', f'file{i}.bin')
+        fileData[filename] = os.urandom(1000 * i)
+        utils.writeFile(filename, fileData[filename])
+    bigFile = os.path.join(srcDir, 'big.bin')
+    fileData[bigFile] = os.urandom(200 * 1024)
+    utils.writeFile(bigFile, fileData[bigFile])
+    fileList = sorted(fileData.keys())
+
+    # the archive holds the files in order up to its max size, large files are omitted
+    archive = dataInterface.getFiles(fileList, maxSize=50000, maxFileSize=100*1024)
+    members = list(iterFileArchive(archive))
+    assert 0 < len(members) < len(fileList)
+    for filename, member in zip(fileList, members):
+        assert member.filename == filename
+        if filename == bigFile:
+            assert member.flags == MemberTooLarge and member.size == len(fileData[bigFile])
+        else:
+            assert member.flags == MemberData and bytes(member.data) == fileData[filename]
+    # a file pattern
+    archive = dataInterface.getFiles(os.path.join(srcDir, 'sub', '*.bin'))
+    assert len(list(iterFileArchive(archive))) == 10
+    # a corrupted archive is rejected
+    archive = bytearray(packFileArchive([(os.path.join(bulkDir, 'bad.bin'), b'data')]))
+    archive[-1] ^= 0xFF
+    with pytest.raises(Exception):
+        dataInterface.putFiles(bytes(archive))
+    assert not os.path.exists(os.path.join(bulkDir, 'bad.bin'))
+
+    # the folder helpers transfer the files in archives, streaming the large file
+    uploadFilesFromList(dataInterface, fileList, os.path.join(bulkDir, 'upload'),
+                        srcDirPrefix=os.path.dirname(srcDir), streamMinSize=100*1024)
+    downloadFilesFromList(dataInterface, fileList, os.path.join(bulkDir, 'download'),
+                          srcDirPrefix=os.path.dirname(srcDir), streamMinSize=100*1024)
+    for filename, data in fileData.items():
+        relName = os.path.relpath(filename, os.path.dirname(srcDir))
+        assert utils.readFile(os.path.join(bulkDir, 'upload', relName)) == data
+        assert utils.readFile(os.path.join(bulkDir, 'download', relName)) == data
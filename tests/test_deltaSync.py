@@ -0,0 +1,71 @@
+import os
+import pytest
+import numpy
+import rtCommon.deltaSync as deltaSync
+from rtCommon.deltaSync import computeSignature, computeDelta, applyDelta, weakChecksums
+from rtCommon.deltaSync import deltaLiteralSize, chooseBlockSize
+from rtCommon.errors import ValidationError
+
+
+def test_weakChecksums():
+    data = os.urandom(10000)
+    blockSize = 512
+    checksums = weakChecksums(data, blockSize)
+    assert len(checksums) == len(data) - blockSize + 1
+    # compare with the direct rsync checksum at some offsets
+    for offset in (0, 1, 777, len(data) - blockSize):
+        block = data[offset:offset + blockSize]
+        a = sum(block) % 2**16
+        b = sum((blockSize - i) * x for i, x in enumerate(block)) % 2**16
+        assert checksums[offset] == a + (b << 16)
+    offsets = numpy.array([5, 100])
+    assert list(weakChecksums(data, blockSize, offsets)) == [checksums[5], checksums[100]]
+
+
+def test_deltaSync():
+    blockSize = 1024
+    baseData = os.urandom(100 * blockSize + 100)
+    # insertion, in place modification, deletion and appended data
+    newData = (baseData[:3000] + b'insert' + baseData[3000:50000] + b'y' * 50 +
+               baseData[50050:80000] + baseData[90000:] + b'appended')
+    signature = computeSignature(baseData, blockSize)
+    delta = computeDelta(newData, signature)
+    assert applyDelta(baseData, delta) == newData
+    # only the blocks around the changes are sent
+    assert deltaLiteralSize(delta) < 8 * blockSize
+    assert len(delta) < len(newData) / 5
+
+    # identical data sends no literal data except the partial last block
+    delta = computeDelta(baseData, signature)
+    assert deltaLiteralSize(delta) == 100
+    assert applyDelta(baseData, delta) == baseData
+
+    # no common data, or an empty base
+    otherData = os.urandom(5000)
+    assert applyDelta(baseData, computeDelta(otherData, signature)) == otherData
+    emptySignature = computeSignature(b'', blockSize)
+    assert applyDelta(b'', computeDelta(newData, emptySignature)) == newData
+    assert applyDelta(baseData, computeDelta(b'', signature)) == b''
+
+    # a base that changed after its signature was taken is detected
+    delta = computeDelta(newData, signature)
+    changedBase = b'z' * blockSize + baseData[blockSize:]
+    with pytest.raises(ValidationError):
+        applyDelta(changedBase, delta)
+
+
+def test_chunkedSignature(monkeypatch):
+    # the signature is the same when its checksums are computed over several chunks
+    blockSize = 1024
+    baseData = os.urandom(20 * blockSize + 10)
+    signature = computeSignature(baseData, blockSize)
+    monkeypatch.setattr(deltaSync, 'checksumChunkSize', 3 * blockSize)
+    assert computeSignature(baseData, blockSize) == signature
+    newData = baseData[:5000] + b'changed' + baseData[6000:]
+    assert applyDelta(baseData, computeDelta(newData, signature)) == newData
+
+
+def test_chooseBlockSize():
+    assert chooseBlockSize(0) == 2048
+    assert chooseBlockSize(2**26) == 8192
+    assert chooseBlockSize(2**40) == 64 * 1024
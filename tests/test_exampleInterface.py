@@ -33,8 +33,22 @@ class TestExampleInterface:
         TestExampleInterface.serversForTests.startServers(exampleRemote=True,
                                                           dataRemote=True, subjectRemote=False)
         clientInterface = ClientInterface()
+        clientInterface.setRpcTracing(True)
         exampleInterface = clientInterface.exampleInterface
         runExampleInterfaceTest(exampleInterface)
+        # The method wrappers are created once and cached
+        assert exampleInterface.testMethod is exampleInterface.testMethod
+        # The calls forwarded to the remote service are traced by the projectServer
+        stats = clientInterface.getRpcLatencyStats('ExampleInterface.testMethod')
+        spans = stats['ExampleInterface.testMethod']
+        assert spans['total']['count'] >= 1
+        assert 'wait' in spans
+        assert 'remote.execute' in spans
+        assert spans['total']['max'] >= spans['remote.execute']['max']
+        # untraced calls aren't added to the stats
+        clientInterface.setRpcTracing(False)
+        runExampleInterfaceTest(exampleInterface)
+        assert clientInterface.getRpcLatencyStats('ExampleInterface.testMethod') == stats
 
     # exampleInterface created locally by the client (no projectServer)
     def test_clientLocalExampleInterface(self):
@@ -56,3 +70,10 @@ def runExampleInterfaceTest(exampleInterface):
     kwargs_py = npToPy(kwargs)
     assert tuple(res[0]) == args_py
     assert res[1] == kwargs_py
+
+    # Test sending several calls as one batch request
+    with exampleInterface.batch():
+        futures = [exampleInterface.testMethod(i, 'batch', required_metadata) for i in range(3)]
+    for i, future in enumerate(futures):
+        res = future.result(timeout=10)
+        assert tuple(res[0]) == (i, 'batch', required_metadata)
@@ -137,3 +137,180 @@ def test_waitForFile_wrongDir():
     finally:
         exitThread = True
         copyThread.join()
+
+
+def test_multipleWatches():
+    """Wait concurrently on watches of different directories and file patterns"""
+    clearWatchDir()
+    dirs = [os.path.join(watchTmpPath, f'echo{i}') for i in range(2)]
+    for dir in dirs:
+        os.makedirs(dir, exist_ok=True)
+        os.system(f'rm -f {dir}/*')
+
+    watcher = fileWatcher.FileWatcher()
+    otherWatcher = fileWatcher.FileWatcher()
+    try:
+        watchIds = [watcher.addWatch(dirs[0], '*.dcm', 0),
+                    watcher.addWatch(dirs[1], '*.txt', 0)]
+        otherWatchId = otherWatcher.addWatch(dirs[0], '*.dcm', 0)
+        if isinstance(watcher, fileWatcher.InotifyFileWatcher):
+            # all watchers share one inotify instance
+            assert fileWatcher.getInotifyRouter() is not None
+
+        def writeFiles():
+            for i in range(3):
+                time.sleep(0.2)
+                for dir, ext in zip(dirs, ['dcm', 'txt']):
+                    with open(os.path.join(dir, f'file{i}.{ext}'), 'w') as fp:
+                        fp.write('data')
+        writeThread = threading.Thread(name='writeThread', target=writeFiles)
+        writeThread.start()
+
+        results = {}
+        def waitFiles(watchId, ext):
+            for i in range(3):
+                results[(watchId, i)] = watcher.waitForFile(f'file{i}.{ext}', timeout=5,
+                                                            timeCheckIncrement=1, watchId=watchId)
+        waitThreads = [threading.Thread(target=waitFiles, args=(watchId, ext))
+                       for watchId, ext in zip(watchIds, ['dcm', 'txt'])]
+        for thread in waitThreads:
+            thread.start()
+        otherResults = [otherWatcher.waitForFile(f'file{i}.dcm', timeout=5, watchId=otherWatchId)
+                        for i in range(3)]
+        for thread in waitThreads + [writeThread]:
+            thread.join()
+
+        for i in range(3):
+            assert results[(watchIds[0], i)] == os.path.join(dirs[0], f'file{i}.dcm')
+            assert results[(watchIds[1], i)] == os.path.join(dirs[1], f'file{i}.txt')
+            assert otherResults[i] == os.path.join(dirs[0], f'file{i}.dcm')
+
+        # a file in another watch's directory isn't found
+        with pytest.raises(StateError):
+            watcher.waitForFile(os.path.join(dirs[1], 'file0.txt'), timeout=1, watchId=watchIds[0])
+
+        watcher.removeWatch(watchIds[1])
+        with pytest.raises(StateError):
+            watcher.waitForFile('file0.txt', timeout=1, watchId=watchIds[1])
+        with pytest.raises(NotADirectoryError):
+            watcher.addWatch(os.path.join(watchTmpPath, 'nodir2'), '*.dcm', 0)
+    finally:
+        watcher.__del__()
+        otherWatcher.__del__()
+
+
+def test_outOfOrderArrivals():
+    """Files arriving before they are waited for are found from the arrival index"""
+    clearWatchDir()
+    os.system(f'rm -f {watchTmpPath}/*.txt')
+    watcher = fileWatcher.FileWatcher()
+    watcher.initFileNotifier(watchTmpPath, '*.txt', 0)
+    try:
+        def writeFiles():
+            time.sleep(0.2)
+            for i in [8, 7, 9]:
+                with open(os.path.join(watchTmpPath, f'file{i}.txt'), 'w') as fp:
+                    fp.write('data' * i)
+        writeThread = threading.Thread(name='writeThread', target=writeFiles)
+        writeThread.start()
+        startTime = time.time()
+        for i in [7, 8, 9]:
+            # a long check increment, so files not found from an event would be slow
+            result = watcher.waitForFile(f'file{i}.txt', timeout=5, timeCheckIncrement=10)
+            assert result == os.path.join(watchTmpPath, f'file{i}.txt')
+            if i == 7 and watcher.notifier is not None:
+                assert watcher.foundWithFileEvent is True
+                assert watcher.fileArrivalTime == watcher.getFileArrival(f'file{i}.txt')[0]
+        writeThread.join()
+        assert time.time() - startTime < 5
+        if watcher.notifier is not None:
+            time.sleep(0.1)
+            for i in [7, 8, 9]:
+                arrivalTime, size = watcher.getFileArrival(f'file{i}.txt')
+                assert startTime < arrivalTime <= time.time()
+                assert size == 4 * i
+        assert watcher.getFileArrival('file0.txt') is None
+    finally:
+        watcher.__del__()
+
+
+def test_pollingWatcher():
+    """The polling watcher records arrivals in the same index as file events"""
+    clearWatchDir()
+    os.system(f'rm -f {watchTmpPath}/*.txt')
+    with open(os.path.join(watchTmpPath, 'existing.txt'), 'w') as fp:
+        fp.write('data')
+    watcher = fileWatcher.FileWatcher(usePolling=True)
+    assert isinstance(watcher, fileWatcher.PollingFileWatcher)
+    watcher.initFileNotifier(watchTmpPath, '*.txt', 0)
+    try:
+        def writeFiles():
+            for i in [2, 1, 3]:
+                time.sleep(0.2)
+                with open(os.path.join(watchTmpPath, f'file{i}.txt'), 'w') as fp:
+                    fp.write('data' * i)
+        writeThread = threading.Thread(name='writeThread', target=writeFiles)
+        writeThread.start()
+        for i in [1, 2, 3]:
+            result = watcher.waitForFile(f'file{i}.txt', timeout=5, timeCheckIncrement=10)
+            assert result == os.path.join(watchTmpPath, f'file{i}.txt')
+            assert watcher.foundWithFileEvent is True
+        writeThread.join()
+        for i in [1, 2, 3]:
+            assert watcher.getFileArrival(f'file{i}.txt')[1] == 4 * i
+        # files already present when the watch started aren't arrivals
+        assert watcher.getFileArrival('existing.txt') is None
+        assert watcher.waitForFile('existing.txt', timeout=1) is not None
+        assert watcher.foundWithFileEvent is False
+    finally:
+        watcher.__del__()
+
+
+def test_pollCompleteFiles():
+    """A polled file is recorded once its size and mtime are unchanged between two polls"""
+    os.makedirs(watchTmpPath, exist_ok=True)
+    os.system(f'rm -f {watchTmpPath}/*.txt')
+    watch = fileWatcher.FileWatch(1, watchTmpPath, '*.txt', 0)
+    snapshot = fileWatcher.DirSnapshot(watch.realDir)
+    snapshot.watches = [watch]
+    router = fileWatcher.getPollingRouter()
+    filename = os.path.join(watchTmpPath, 'growing.txt')
+    with open(filename, 'w') as fp:
+        fp.write('part1')
+    router.pollDir(snapshot)
+    assert watch.getArrival(filename) is None
+    assert snapshot.numPending == 1
+    with open(filename, 'a') as fp:
+        fp.write('part2')
+    router.pollDir(snapshot)
+    assert watch.getArrival(filename) is None
+    router.pollDir(snapshot)
+    assert watch.getArrival(filename)[1] == 10
+    assert snapshot.numPending == 0
+
+
+def test_pollDelay():
+    """Polls are spaced out between expected arrivals and relax between runs"""
+    watch = fileWatcher.FileWatch(1, watchTmpPath, '*.dcm', 0)
+    snapshot = fileWatcher.DirSnapshot(watch.realDir)
+    snapshot.watches = [watch]
+    nextPollDelay = fileWatcher.PollingRouter.nextPollDelay
+    now = time.time()
+    # no expected interval and no waiters, the delay relaxes to the max
+    delays = [nextPollDelay(snapshot, now) for i in range(6)]
+    assert delays[0] == fileWatcher.defaultPollInterval
+    assert delays == sorted(delays) and delays[-1] == fileWatcher.maxPollInterval
+    # waiting for a file
+    watch.numWaiting = 1
+    assert nextPollDelay(snapshot, now) == fileWatcher.defaultPollInterval
+    # TR of 2s, the last image arrived 0.5s ago: wait until just before the next
+    watch.expectedInterval = 2.0
+    snapshot.lastArrivalTime = now - 0.5
+    assert nextPollDelay(snapshot, now) == pytest.approx(1.3)
+    # the next image is due, poll often
+    snapshot.lastArrivalTime = now - 2.1
+    assert nextPollDelay(snapshot, now) == fileWatcher.minPollInterval
+    # no image for many TRs (between runs), relax
+    snapshot.lastArrivalTime = now - 60
+    delays = [nextPollDelay(snapshot, now) for i in range(6)]
+    assert delays == sorted(delays) and delays[-1] == fileWatcher.maxPollInterval
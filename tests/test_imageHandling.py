@@ -2,6 +2,7 @@ import os
 import math
 import time
 import pytest
+import struct
 import tempfile
 import numpy as np
 from datetime import time as dtime
@@ -77,6 +78,29 @@ def test_readDicom():
     assert countUnanonymizedSensitiveAttrs(dicomImg5) == 0
 
 
+def test_checkDicomComplete():
+    dicomImg = imgHandler.readDicomFromFile(test_dicomPath)
+    imgHandler.checkDicomComplete(dicomImg)
+    # native pixel data shorter than the image dimensions
+    dicomImg.PixelData = dicomImg.PixelData[:-100]
+    with pytest.raises(ValidationError):
+        imgHandler.checkDicomComplete(dicomImg)
+    del dicomImg.PixelData
+    with pytest.raises(ValidationError):
+        imgHandler.checkDicomComplete(dicomImg)
+
+    # encapsulated pixel data: basic offset table item and a fragment
+    offsetTable = struct.pack('<HHI', 0xFFFE, 0xE000, 0)
+    fragment = struct.pack('<HHI', 0xFFFE, 0xE000, 6) + b'\x01' * 6
+    delimiter = struct.pack('<HHI', 0xFFFE, 0xE0DD, 0)
+    imgHandler.checkEncapsulatedComplete(offsetTable + fragment)
+    imgHandler.checkEncapsulatedComplete(offsetTable + fragment + delimiter)
+    for badData in [offsetTable, offsetTable + fragment[:-1], offsetTable + fragment[:5],
+                    offsetTable + b'\x00' * 8]:
+        with pytest.raises(ValidationError):
+            imgHandler.checkEncapsulatedComplete(badData)
+
+
 def test_nifti():
     with tempfile.TemporaryDirectory() as tmpDir:
         niftiFilename = os.path.join(tmpDir, 'nifti1.nii')
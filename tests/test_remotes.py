@@ -1,5 +1,14 @@
+import os
 import pytest
+import asyncio
+import threading
 from rtCommon.remoteable import Remoteable, RemoteableExtensible, RemoteHandler
+from rtCommon.remoteable import subscriptionOwner
+from rtCommon.streamSubscription import StreamSubscription
+from rtCommon.dataInterface import DataInterface
+from rtCommon.resultCache import ResultCache, CacheStatic
+from rtCommon.errors import ValidationError
+from rtCommon.clientInterface import AsyncioInterface
 
 
 class TestRemoteable:
@@ -53,6 +62,155 @@ class TestRemoteable:
         assert sampleServerInstance.val2 == sampleClientInstance.val2
         pass
 
+    def test_callAsync(self):
+        sampleServerInstance = SampleClassRemoteExtensible(isRemote=False)
+        mockRPC = MockRPCHandler(sampleServerInstance)
+        sampleClientInstance = SampleClassRemoteExtensible(isRemote=True)
+        sampleClientInstance.registerCommFunction(mockRPC.sendRequest)
+
+        for instance in (sampleServerInstance, sampleClientInstance):
+            # Start several calls before waiting on any of them
+            futures = [instance.callAsync('posargs', i, i+1) for i in range(10)]
+            futures.append(instance.callAsync('poskwargs', 1, 2, c=3, d=4, rpc_timeout=5))
+            results = [future.result(timeout=5) for future in futures]
+            for i in range(10):
+                assert results[i] == sampleServerInstance.posargs(i, i+1)
+            assert results[10] == sampleServerInstance.poskwargs(1, 2, c=3, d=4)
+
+        # The asyncio facade
+        async def runCalls(instance):
+            asyncInstance = AsyncioInterface(instance)
+            return await asyncio.gather(asyncInstance.noargs(),
+                                        asyncInstance.kwargs(a=3, b=4))
+        results = asyncio.run(runCalls(sampleClientInstance))
+        assert results == [sampleServerInstance.noargs(), sampleServerInstance.kwargs(a=3, b=4)]
+
+    def test_batch(self):
+        sampleServerInstance = SampleClassRemoteExtensible(isRemote=False)
+        mockRPC = MockRPCHandler(sampleServerInstance)
+        sampleClientInstance = SampleClassRemoteExtensible(isRemote=True)
+        sampleClientInstance.registerCommFunction(mockRPC.sendRequest)
+
+        for instance in (sampleServerInstance, sampleClientInstance):
+            mockRPC.numRequests = 0
+            with instance.batch():
+                noargsFuture = instance.noargs()
+                posargsFuture = instance.posargs(1, 2)
+                errorFuture = instance.posargs(1)
+                kwargsFuture = instance.kwargs(a=3, b=4, rpc_timeout=5)
+                assert noargsFuture.done() is False
+            assert noargsFuture.result() == sampleServerInstance.noargs()
+            assert posargsFuture.result() == sampleServerInstance.posargs(1, 2)
+            assert kwargsFuture.result() == sampleServerInstance.kwargs(a=3, b=4)
+            # an error in one call doesn't stop the other calls
+            with pytest.raises(Exception) as err:
+                errorFuture.result()
+            assert 'TypeError' in str(err.value)
+            # outside the batch calls are made directly again
+            assert instance.noargs() == sampleServerInstance.noargs()
+            if instance.isRunningRemote():
+                assert mockRPC.numRequests == 2
+
+        # Calls made within the batch window from different threads are sent together
+        mockRPC.numRequests = 0
+        sampleClientInstance.setBatchWindow(0.2)
+        results = [None] * 5
+        def makeCall(i):
+            results[i] = sampleClientInstance.posargs(i, i)
+        threads = [threading.Thread(target=makeCall, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [sampleServerInstance.posargs(i, i) for i in range(5)]
+        assert mockRPC.numRequests == 1
+        sampleClientInstance.setBatchWindow(0)
+
+    def test_resultCache(self, tmp_path):
+        serverInstance = DataInterface(dataRemote=False, allowedDirs=[str(tmp_path)],
+                                       allowedFileTypes=['.txt'])
+        mockRPC = MockRPCHandler(serverInstance)
+        clientInstance = DataInterface(dataRemote=True)
+        clientInstance.registerCommFunction(mockRPC.sendRequest)
+        with pytest.raises(ValidationError):
+            clientInstance.enableResultCache(['putFile'])
+        clientInstance.enableResultCache()
+
+        # static results are returned from the cache
+        assert clientInstance.getAllowedFileTypes() == ['.txt']
+        mockRPC.numRequests = 0
+        assert clientInstance.getAllowedFileTypes() == ['.txt']
+        assert mockRPC.numRequests == 0
+
+        # cached file data is validated by probing the file's mtime and size
+        filename = os.path.join(str(tmp_path), 'test.txt')
+        with open(filename, 'w') as fp:
+            fp.write('version 1')
+        assert clientInstance.getFile(filename) == b'version 1'
+        mockRPC.numRequests = 0
+        assert clientInstance.getFile(filename) == b'version 1'
+        assert mockRPC.numRequests == 1
+        with open(filename, 'w') as fp:
+            fp.write('version 2 longer')
+        assert clientInstance.getFile(filename) == b'version 2 longer'
+        # putFile invalidates the cached file data
+        clientInstance.putFile(filename, b'version 3 longer')
+        mockRPC.numRequests = 0
+        assert clientInstance.getFile(filename) == b'version 3 longer'
+        assert mockRPC.numRequests == 1
+        with pytest.raises(FileNotFoundError):
+            clientInstance.getFile(os.path.join(str(tmp_path), 'missing.txt'))
+        stats = clientInstance.getResultCacheStats()
+        assert stats['hits'] == 2
+        assert stats['entries'] == 2
+
+        # changing a returned result doesn't change the cached one
+        fileTypes = clientInstance.getAllowedFileTypes()
+        fileTypes.append('.bin')
+        assert clientInstance.getAllowedFileTypes() == ['.txt']
+        # batched calls invalidate the cached results they change
+        dirPattern = os.path.join(str(tmp_path), '*')
+        assert clientInstance.listDirs(dirPattern) == []
+        with clientInstance.batch():
+            clientInstance.putFile(os.path.join(str(tmp_path), 'subdir', 'test.txt'), b'data')
+        assert clientInstance.listDirs(dirPattern) == [os.path.join(str(tmp_path), 'subdir')]
+
+        # least recently used results are evicted
+        cache = ResultCache({'get': CacheStatic}, maxEntries=2, maxBytes=100)
+        for i in range(3):
+            cache.put(i, 'get', b'x' * 10)
+        assert cache.get(0) is None
+        assert cache.get(1) is not None
+        cache.put(3, 'get', b'x' * 85)
+        assert cache.get(2) is None
+        assert cache.get(1) is not None
+        assert cache.getStats()['bytes'] == 95
+        cache.put(4, 'get', b'x' * 200)
+        assert cache.get(4) is None
+        cache.invalidate(['get'])
+        assert cache.getStats()['entries'] == 0
+
+    def test_subscriptionOwner(self):
+        # the subscriptions started by a client are closed when it disconnects
+        dataInterface = DataInterface(dataRemote=True)
+        unsubscribed = []
+        def commFunction(callStruct, timeout=None):
+            subscription = StreamSubscription(lambda response, data: data)
+            streamId = callStruct['args'][0]
+            subscription.unsubscribeFunc = lambda: unsubscribed.append(streamId)
+            return subscription
+        dataInterface.registerCommFunction(commFunction)
+        subscriptionOwner.owner = 'client1'
+        dataInterface.subscribeScannerStream(1)
+        subscriptionOwner.owner = 'client2'
+        dataInterface.subscribeScannerStream(2)
+        subscriptionOwner.owner = None
+        dataInterface.closeSubscriptions('client1')
+        assert unsubscribed == [1]
+        dataInterface.closeSubscriptions('client2')
+        assert unsubscribed == [1, 2]
+        assert len(dataInterface.subscriptions) == 0
+
     def test_remoteableHandler(self):
         rh = RemoteHandler()
         # The remote server instantiates a local instance
@@ -100,8 +258,10 @@ class MockRPCHandler:
         self.remoteHandler = RemoteHandler()
         serviceClass = type(serviceInstance)
         self.remoteHandler.registerClassInstance(serviceClass, serviceInstance)
+        self.numRequests = 0
 
     def sendRequest(self, cmd, timeout=5):
+        self.numRequests += 1
         return self.remoteHandler.runRemoteCall(cmd)
 
 
@@ -0,0 +1,353 @@
+import json
+import time
+import threading
+import pytest
+from rtCommon.webSocketHandlers import RequestHandler, websocketState
+from rtCommon.streamSubscription import StreamSubscription
+from rtCommon.serialization import generateDataParts
+from rtCommon.errors import SubscriptionMissError
+from rtCommon.wsRemoteService import RemoteSession, reconnectDelay
+
+
+class FakeConn:
+    def __init__(self):
+        self.sent = []
+
+    def write_message(self, msg):
+        self.sent.append(json.loads(msg))
+
+
+class FakeIOLoop:
+    def __init__(self):
+        self.timers = []
+
+    def add_callback(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def call_later(self, delay, func, *args):
+        self.timers.append((delay, func, args))
+
+
+class FakeWsClient:
+    """The remote service side of a connection"""
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame, opcode=None):
+        self.frames.append(frame)
+
+
+@pytest.fixture
+def handler():
+    conn = FakeConn()
+    websocketState.wsConnectionLists['wsTest'] = [conn]
+    handler = RequestHandler('wsTest', FakeIOLoop())
+    yield handler, conn
+    websocketState.wsConnectionLists.pop('wsTest', None)
+
+
+def reply(handler, callId, partId=1, numParts=1, data='x'):
+    msg = {'cmd': 'rpc', 'status': 200, 'callId': callId, 'data': data,
+           'partId': partId, 'numParts': numParts}
+    handler.callback(None, json.dumps(msg))
+
+
+def test_multipartReply(handler):
+    handler, conn = handler
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        handler.doRequest({'cmd': 'rpc'}, timeout=5)))
+    thread.start()
+    while len(conn.sent) == 0:
+        time.sleep(0.01)
+    callId = conn.sent[0]['callId']
+    reply(handler, callId, 1, 2, 'part1')
+    thread.join()
+    assert results[0]['data'] == 'part1'
+    assert results[0]['incomplete'] is True
+    reply(handler, callId, 2, 2, 'part2')
+    response = handler.doRequest({'cmd': 'rpc', 'callId': callId, 'incomplete': True}, timeout=5)
+    assert response['data'] == 'part2'
+    assert response['incomplete'] is False
+    assert len(handler.dataCallbacks) == 0
+    # replies to unknown calls are ignored
+    reply(handler, callId)
+
+
+def test_expiredCalls(handler):
+    handler, conn = handler
+    handler.maxCallbackSeconds = 0.1
+    with pytest.raises(TimeoutError):
+        handler.doRequest({'cmd': 'rpc'}, timeout=0.01)
+    assert len(handler.dataCallbacks) == 1
+    callId2, _ = handler.prepare_request({'cmd': 'rpc'})
+    time.sleep(0.2)
+    # expired calls are removed when the next reply arrives
+    callId3, _ = handler.prepare_request({'cmd': 'rpc'})
+    reply(handler, callId3)
+    assert list(handler.dataCallbacks.keys()) == [callId3]
+    assert len(handler.expiryHeap) == 1
+    # a thread waiting on a call that expires gets the expiry error
+    callId4, _ = handler.prepare_request({'cmd': 'rpc'})
+    results = []
+    thread = threading.Thread(target=lambda: results.append(handler.get_response(callId4, timeout=5)))
+    thread.start()
+    time.sleep(0.2)
+    reply(handler, callId3)
+    thread.join()
+    assert results[0]['status'] == 400
+    assert callId4 not in handler.dataCallbacks
+
+
+def test_loadBalancing():
+    conn1, conn2 = FakeConn(), FakeConn()
+    websocketState.wsConnectionLists['wsTest'] = [conn1, conn2]
+    try:
+        handler = RequestHandler('wsTest', FakeIOLoop())
+        getFile = {'cmd': 'rpc', 'class': 'DataInterface', 'attribute': 'getFile'}
+        # requests go to the connection with the fewest outstanding requests
+        _, reqConn1 = handler.prepare_request(dict(getFile))
+        _, reqConn2 = handler.prepare_request(dict(getFile))
+        assert {reqConn1, reqConn2} == {conn1, conn2}
+        # stateful requests of a class stay on one connection
+        stream = {'cmd': 'rpc', 'class': 'DataInterface', 'attribute': 'getImageData'}
+        streamConns = {handler.prepare_request(dict(stream))[1] for _ in range(4)}
+        assert len(streamConns) == 1
+        streamConn = streamConns.pop()
+        otherConn = conn2 if streamConn is conn1 else conn1
+        assert handler.connLoad[streamConn] == 5
+        assert handler.prepare_request(dict(getFile))[1] is otherConn
+
+        # idempotent requests waiting on a dropped connection are resent on another one
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            handler.doRequest(dict(getFile), timeout=5)))
+        thread.start()
+        while len(otherConn.sent) == 0:
+            time.sleep(0.01)
+        callId = otherConn.sent[0]['callId']
+        putFileId, _ = handler.prepare_request({'cmd': 'rpc', 'class': 'DataInterface',
+                                                'attribute': 'putFile'})
+        putFileCall = handler.dataCallbacks[putFileId]
+        assert putFileCall.dataConn is otherConn
+        websocketState.wsConnectionLists['wsTest'].remove(otherConn)
+        handler.close_pending_requests(conn=otherConn)
+        assert streamConn.sent[-1]['callId'] == callId
+        reply(handler, callId, data='resent')
+        thread.join()
+        assert results[0]['data'] == 'resent'
+        # non-idempotent requests fail
+        assert putFileId not in handler.dataCallbacks
+        assert putFileCall.responses[0]['status'] == 499
+        assert otherConn not in handler.connLoad
+    finally:
+        websocketState.wsConnectionLists.pop('wsTest', None)
+
+
+def test_subscription(handler):
+    handler, conn = handler
+    subscription = StreamSubscription(lambda response, data: json.loads(data), startIndex=3,
+                                      maxBuffered=2)
+    callId = handler.subscribe({'cmd': 'subscribe', 'attribute': 'streamGenerator'},
+                               subscription.addResponse)
+    subscription.unsubscribeFunc = lambda: handler.unsubscribe(callId)
+    assert conn.sent[0]['cmd'] == 'subscribe'
+
+    def push(index, item):
+        msg = {'cmd': 'subscribe', 'callId': callId, 'subscriptionIndex': index}
+        for part in generateDataParts(json.dumps(item).encode(), msg, compress=False):
+            handler.callback(None, json.dumps(part))
+
+    push(3, 'item3')
+    assert subscription.get(3, timeout=5) == 'item3'
+    # waits for an item to be pushed
+    threading.Timer(0.2, push, args=(4, 'item4')).start()
+    assert subscription.get(timeout=5) == 'item4'
+    with pytest.raises(TimeoutError):
+        subscription.get(5, timeout=0.1)
+    push(5, 'item5')
+    push(6, 'item6')
+    assert subscription.get(6, timeout=5) == 'item6'
+    # item 4 was removed from the buffer and item 2 is before the start
+    for index in (2, 4):
+        with pytest.raises(SubscriptionMissError):
+            subscription.get(index, timeout=5)
+    # replies for subscriptions don't create pending calls
+    assert len(handler.dataCallbacks) == 0
+
+    subscription.close()
+    assert conn.sent[-1] == {'cmd': 'unsubscribe', 'callId': callId}
+    assert callId not in handler.subscriptions
+    with pytest.raises(SubscriptionMissError):
+        subscription.get(7, timeout=5)
+
+
+def test_subscriptionConnectionClosed(handler):
+    handler, conn = handler
+    subscription = StreamSubscription(lambda response, data: data)
+    handler.subscribe({'cmd': 'subscribe'}, subscription.addResponse)
+    handler.close_pending_requests(conn)
+    assert len(handler.subscriptions) == 0
+    with pytest.raises(SubscriptionMissError):
+        subscription.get(0, timeout=5)
+    assert 'closed' in subscription.error
+
+
+def test_sessionResume():
+    session = RemoteSession()
+    conn1 = FakeConn()
+    conn1.sessionId = session.sessionId
+    websocketState.wsConnectionLists['wsTest'] = [conn1]
+    ioLoop = FakeIOLoop()
+    try:
+        handler = RequestHandler('wsTest', ioLoop)
+        results = []
+
+        def request(attribute):
+            results.append(handler.doRequest({'cmd': 'rpc', 'class': 'DataInterface',
+                                              'attribute': attribute}, timeout=5))
+        threads = [threading.Thread(target=request, args=(attr,)) for attr in ('putFile', 'listFiles')]
+        for thread in threads:
+            thread.start()
+        while len(conn1.sent) < 2:
+            time.sleep(0.01)
+        received, notReceived = sorted(conn1.sent, key=lambda msg: msg['attribute'] != 'putFile')
+        # the remote receives one of the requests before the connection drops
+        ws1 = FakeWsClient()
+        session.setClient(ws1)
+        assert session.startCall(received) is None
+        session.clearClient(ws1)
+        websocketState.wsConnectionLists['wsTest'].remove(conn1)
+        handler.close_pending_requests(conn=conn1)
+        assert len(handler.dataCallbacks) == 2
+        assert len(ioLoop.timers) == 1
+        # the request completes while disconnected, the reply is logged
+        replyMsg = {'cmd': 'rpc', 'status': 200, 'callId': received['callId'], 'data': 'put'}
+        session.send(json.dumps(replyMsg), None, callId=received['callId'])
+        session.endCall(received['callId'])
+        assert len(ws1.frames) == 0
+
+        # the session reconnects, the requests are resent
+        conn2 = FakeConn()
+        conn2.sessionId = session.sessionId
+        websocketState.wsConnectionLists['wsTest'].append(conn2)
+        handler.resume_session(conn2)
+        assert all(msg['resend'] is True for msg in conn2.sent)
+        assert {msg['callId'] for msg in conn2.sent} == {received['callId'], notReceived['callId']}
+        ws2 = FakeWsClient()
+        session.setClient(ws2)
+        for msg in conn2.sent:
+            resendFrames = session.startCall(msg)
+            if msg['callId'] == received['callId']:
+                # not run again, the logged reply is resent
+                assert len(resendFrames) == 1
+                for frame in resendFrames:
+                    handler.callback(None, frame[0])
+            else:
+                assert resendFrames is None
+                reply(handler, msg['callId'], data='list')
+        for thread in threads:
+            thread.join()
+        assert sorted(result['data'] for result in results) == ['list', 'put']
+        assert len(handler.dataCallbacks) == 0
+        # the timer of the resumed session does nothing
+        _, func, args = ioLoop.timers.pop()
+        func(*args)
+
+        # requests of a session that doesn't reconnect in time fail
+        callId, _ = handler.prepare_request({'cmd': 'rpc', 'class': 'DataInterface',
+                                             'attribute': 'putFile'})
+        handler.dataCallbacks[callId].sentMsg = json.dumps({'cmd': 'rpc', 'callId': callId})
+        pendingCall = handler.dataCallbacks[callId]
+        websocketState.wsConnectionLists['wsTest'].remove(conn2)
+        handler.close_pending_requests(conn=conn2)
+        assert callId in handler.dataCallbacks
+        _, func, args = ioLoop.timers.pop()
+        func(*args)
+        assert callId not in handler.dataCallbacks
+        assert pendingCall.responses[0]['status'] == 499
+    finally:
+        websocketState.wsConnectionLists.pop('wsTest', None)
+
+
+def runRemoteCall(handler, conn, attribute):
+    """Start a request in a thread, returns the thread and the sent message"""
+    numSent = len(conn.sent)
+    thread = threading.Thread(target=handler.doRequest, kwargs={'timeout': 5, 'msg': {
+        'cmd': 'rpc', 'class': 'DataInterface', 'attribute': attribute}})
+    thread.start()
+    while len(conn.sent) == numSent:
+        time.sleep(0.01)
+    return thread, conn.sent[-1]
+
+
+def test_sentMsgKept(handler):
+    handler, conn = handler
+    # without a session only idempotent requests are kept to resend on failover
+    for attribute, isKept in (('putFile', False), ('getFile', True)):
+        thread, msg = runRemoteCall(handler, conn, attribute)
+        assert (handler.dataCallbacks[msg['callId']].sentMsg is not None) == isKept
+        reply(handler, msg['callId'])
+        thread.join()
+    # with a session all requests are kept
+    conn.sessionId = 'session1'
+    thread, msg = runRemoteCall(handler, conn, 'putFile')
+    assert handler.dataCallbacks[msg['callId']].sentMsg is not None
+    reply(handler, msg['callId'])
+    thread.join()
+
+
+def test_sessionReplyLog(handler):
+    handler, conn = handler
+    session = RemoteSession(maxLogBytes=1000)
+    conn.sessionId = session.sessionId
+    ws = FakeWsClient()
+    session.setClient(ws)
+    replies = {}
+    acks = {}
+    for attribute, data in (('getFile', 'x' * 2000), ('listFiles', 'y')):
+        thread, msg = runRemoteCall(handler, conn, attribute)
+        # as done by WsRemoteService.on_message
+        acks[attribute] = msg.pop('ackCallIds', [])
+        session.ackCalls(acks[attribute])
+        assert session.startCall(msg) is None
+        replyMsg = {'cmd': 'rpc', 'status': 200, 'callId': msg['callId'], 'data': data}
+        session.send(json.dumps(replyMsg), None, callId=msg['callId'])
+        session.endCall(msg['callId'])
+        handler.callback(None, ws.frames[-1])
+        thread.join()
+        replies[attribute] = msg
+    # the reply larger than the log size isn't kept, a resent request gets an error
+    assert session.logBytes < 1000
+    assert list(session.replyLog.keys()) == [replies['listFiles']['callId']]
+    resendFrames = session.startCall(dict(replies['getFile'], resend=True))
+    assert json.loads(resendFrames[0][0])['status'] == 500
+    # completed calls are acknowledged with the next request, which removes their logs
+    assert acks['listFiles'] == [replies['getFile']['callId']]
+    thread, msg = runRemoteCall(handler, conn, 'listFiles')
+    assert msg['ackCallIds'] == [replies['listFiles']['callId']]
+    session.ackCalls(msg['ackCallIds'])
+    assert len(session.replyLog) == 0 and session.logBytes == 0
+    reply(handler, msg['callId'])
+    thread.join()
+
+
+def test_repeatedReplyParts(handler):
+    handler, conn = handler
+    callId, _ = handler.prepare_request({'cmd': 'rpc'})
+    # parts resent after a session resume are dropped
+    for partId in (1, 1, 2):
+        reply(handler, callId, partId, 2, f'part{partId}')
+    assert handler.dataCallbacks[callId].numResponses == 2
+    assert handler.get_response(callId, timeout=1)['data'] == 'part1'
+    response = handler.get_response(callId, timeout=1)
+    assert response['data'] == 'part2'
+    assert response['incomplete'] is False
+
+
+def test_reconnectDelay():
+    assert reconnectDelay(0, 5) == 0
+    for attempt in range(1, 20):
+        delay = reconnectDelay(attempt, 5)
+        maxDelay = min(5, 0.1 * 2 ** (attempt - 1))
+        assert maxDelay / 2 <= delay <= maxDelay
@@ -0,0 +1,70 @@
+import time
+import threading
+import pytest
+from rtCommon.requestWorkerPool import RequestWorkerPool, ControlLane, InteractiveLane, BulkLane
+from rtCommon.wsRemoteService import requestLane
+from rtCommon.errors import ValidationError
+
+
+def test_requestLanes():
+    pool = RequestWorkerPool(numWorkers=3, maxBulkWorkers=2)
+    releaseBulk = threading.Event()
+    bulkStarted = []
+    done = []
+    lock = threading.Lock()
+
+    def bulkRequest(i):
+        with lock:
+            bulkStarted.append(i)
+        releaseBulk.wait(timeout=10)
+        with lock:
+            done.append(('bulk', i))
+
+    def interactiveRequest(i):
+        with lock:
+            done.append(('interactive', i))
+
+    for i in range(5):
+        pool.submit(BulkLane, bulkRequest, i)
+    time.sleep(0.2)
+    # only maxBulkWorkers bulk requests run at once
+    assert len(bulkStarted) == 2
+    metrics = pool.getMetrics()
+    assert metrics[BulkLane]['active'] == 2
+    assert metrics[BulkLane]['queued'] == 3
+    assert metrics[BulkLane]['maxQueued'] >= 3
+
+    # interactive requests still run while the bulk requests are blocked
+    for i in range(3):
+        pool.submit(InteractiveLane, interactiveRequest, i)
+    time.sleep(0.2)
+    assert done == [('interactive', i) for i in range(3)]
+
+    # control requests are run immediately in the calling thread
+    controlThreads = []
+    pool.submit(ControlLane, lambda: controlThreads.append(threading.current_thread()))
+    assert controlThreads == [threading.current_thread()]
+
+    releaseBulk.set()
+    pool.shutdown()
+    assert sorted(done[3:]) == [('bulk', i) for i in range(5)]
+    metrics = pool.getMetrics()
+    assert metrics[BulkLane]['completed'] == 5
+    assert metrics[BulkLane]['queued'] == 0
+    assert metrics[InteractiveLane]['completed'] == 3
+    assert metrics[ControlLane]['completed'] == 1
+    assert metrics[BulkLane]['avgWaitTime'] > 0
+
+    with pytest.raises(ValidationError):
+        RequestWorkerPool(numWorkers=2, maxBulkWorkers=2)
+
+
+def test_requestLaneSelection():
+    assert requestLane({'cmd': 'rpc', 'attribute': 'ping'}) == ControlLane
+    assert requestLane({'cmd': 'rpc', 'attribute': 'getQueueMetrics'}) == ControlLane
+    assert requestLane({'cmd': 'rpc', 'attribute': 'getImageData'}) == InteractiveLane
+    assert requestLane({'cmd': 'rpc', 'attribute': 'getFile'}) == BulkLane
+    batch = {'cmd': 'rpcBatch', 'calls': [{'attribute': 'ping'}, {'attribute': 'getClockSkew'}]}
+    assert requestLane(batch) == ControlLane
+    batch['calls'].append({'attribute': 'putFile'})
+    assert requestLane(batch) == BulkLane
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import tempfile
+from rtCommon.rpcTracing import RpcTrace, RpcTraceStats, LatencyHistogram
+
+
+def test_latencyHistogram():
+    hist = LatencyHistogram()
+    assert hist.percentile(50) == 0.0
+    for i in range(90):
+        hist.add(0.001)
+    for i in range(10):
+        hist.add(1.0)
+    summary = hist.summary()
+    assert summary['count'] == 100
+    assert summary['min'] == 0.001
+    assert summary['max'] == 1.0
+    assert abs(summary['mean'] - 0.1009) < 1e-9
+    # percentiles are the upper bound of the bucket the value falls in
+    assert 0.001 <= summary['p50'] < 0.002
+    assert 0.001 <= summary['p90'] < 0.002
+    assert summary['p99'] == 1.0
+    assert sum(summary['buckets'].values()) == 100
+    # values beyond the largest bucket
+    hist.add(1000)
+    assert hist.percentile(100) == 1000
+
+
+def test_rpcTraceStats():
+    stats = RpcTraceStats(maxRecentTraces=3)
+    for i in range(5):
+        trace = RpcTrace('DataInterface.getFile')
+        trace.addSpan('send', 0.01)
+        trace.addSpan('send', 0.01)
+        trace.addSpans({'remote.execute': 0.05})
+        with trace.span('total'):
+            time.sleep(0.001)
+        stats.record(trace)
+    trace = RpcTrace('DataInterface.putFile', traceId='abc')
+    trace.addSpan('total', 0.5)
+    stats.record(trace)
+
+    allStats = stats.getStats()
+    assert set(allStats.keys()) == {'DataInterface.getFile', 'DataInterface.putFile'}
+    getFileStats = stats.getStats('DataInterface.getFile')
+    assert list(getFileStats.keys()) == ['DataInterface.getFile']
+    spans = getFileStats['DataInterface.getFile']
+    assert spans['send']['count'] == 5
+    assert abs(spans['send']['mean'] - 0.02) < 1e-9
+    assert spans['total']['min'] >= 0.001
+
+    recent = stats.getRecentTraces()
+    assert len(recent) == 3
+    assert recent[-1] == {'traceId': 'abc', 'method': 'DataInterface.putFile',
+                          'spans': {'total': 0.5}}
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        filename = os.path.join(tmpDir, 'rpcTrace.json')
+        stats.dumpToFile(filename)
+        with open(filename) as fp:
+            dumped = json.load(fp)
+        assert dumped['stats']['DataInterface.putFile']['total']['count'] == 1
+        assert len(dumped['recentTraces']) == 3
+
+    stats.clear()
+    assert stats.getStats() == {}
@@ -1,11 +1,16 @@
 import os
 import pytest
 import numpy
-from rtCommon.errors import ValidationError
+from rtCommon.errors import ValidationError, RequestError
+import rtCommon.serialization as serialization
 from rtCommon.serialization import npToPy
 from rtCommon.serialization import encodeByteTypeArgs, decodeByteTypeArgs
 from rtCommon.serialization import encodeMessageData, decodeMessageData
 from rtCommon.serialization import generateDataParts, unpackDataMessage
+from rtCommon.serialization import packBinaryFrame, unpackBinaryFrame
+from rtCommon.serialization import encodePickleOOB, decodePickleOOB
+from rtCommon.serialization import encodeRpcMessage, decodeRpcMessage
+from rtCommon.webSocketHandlers import markResent
 
 def test_encodeByteTypeArgs():
     cmd = {'cmd': 'rpc', 'class': 'list', 'attribute': 'append',
@@ -53,6 +58,54 @@ def test_npToPy():
     assert res == args_py
 
 
+def test_encodeRpcMessage():
+    array = numpy.arange(12, dtype=numpy.float32).reshape(3, 4)
+    kwargs = {'mdata': {'np': numpy.float32(3), 'int': numpy.int64(4), 'flag': numpy.bool_(True),
+                        'set': {'a', (1, 2)}, 'nested': [b'small', {'array': array}]},
+              'data': os.urandom(4096), 'col': array[:, 1]}
+    msg = {'cmd': 'rpc', 'class': 'DataInterface', 'attribute': 'putFile', 'callId': 5,
+           'args': ('name', b'somebytes', numpy.float64(2.5)), 'kwargs': kwargs}
+    for binary in (False, True):
+        encoded = encodeRpcMessage(msg, binary=binary)
+        # only large bytes are sent as raw buffers in a binary frame
+        assert isinstance(encoded, bytes) == binary
+        decoded = decodeRpcMessage(encoded)
+        assert decoded['args'] == ['name', b'somebytes', 2.5]
+        dkwargs = decoded['kwargs']
+        assert dkwargs['data'] == kwargs['data']
+        assert dkwargs['mdata']['np'] == 3.0 and dkwargs['mdata']['int'] == 4
+        assert dkwargs['mdata']['flag'] is True
+        assert dkwargs['mdata']['set'] == {'a', (1, 2)}
+        assert dkwargs['mdata']['nested'][0] == b'small'
+        decodedArray = dkwargs['mdata']['nested'][1]['array']
+        assert decodedArray.dtype == array.dtype
+        assert numpy.array_equal(decodedArray, array)
+        assert numpy.array_equal(dkwargs['col'], array[:, 1])
+        # resent requests are marked without re-encoding
+        resent = decodeRpcMessage(markResent(encoded))
+        assert resent['resend'] is True
+        assert resent['kwargs']['data'] == kwargs['data']
+    # small requests are plain json
+    assert decodeRpcMessage(encodeRpcMessage({'cmd': 'ping'}, binary=True)) == {'cmd': 'ping'}
+    with pytest.raises(TypeError):
+        encodeRpcMessage({'args': (object(),)})
+
+
+def test_rpcMessageUserDicts():
+    # user dicts that look like encoded values are returned unchanged
+    userDicts = [{'__rtbytes__': 'abc'}, {'__rtbuffer__': 7}, {'__rtset__': [1, 2]},
+                 {'__rtndarray__': 'x', 'dtype': '<f4', 'shape': [1]},
+                 {'__rt__': 'buffer', 'index': 0, 'other': 1}, {'__rt__': ['set']},
+                 {'__rt__': 'unknown', 'data': 'abc'}]
+    msg = {'cmd': 'rpc', 'args': (userDicts,), 'kwargs': {'data': os.urandom(4096)}}
+    for binary in (False, True):
+        decoded = decodeRpcMessage(encodeRpcMessage(msg, binary=binary))
+        assert decoded['args'] == [userDicts]
+    # a tagged buffer that isn't in the frame
+    with pytest.raises(RequestError):
+        decodeRpcMessage('{"data": {"__rt__": "buffer", "index": 3}}')
+
+
 def test_encodeMessageData(bigTestFile, mediumTestFile):
     # Test medium sized data
     msg = {'test': 'mediumSize'}
@@ -71,6 +124,10 @@ def test_encodeMessageData(bigTestFile, mediumTestFile):
     assert resMsg['compressed'] == True
     resData = decodeMessageData(resMsg)
     assert resData == largeData
+    # but not when the caller chose not to compress, such as for incompressible data
+    resMsg = encodeMessageData({'test': 'largeSizeNone'}, largeData, compress='none')
+    assert resMsg.get('compressed') == None
+    assert decodeMessageData(resMsg) == largeData
 
     # Test compress flag
     bytesArg = b'1234'
@@ -116,3 +173,84 @@ def test_generateDataParts(bigTestFile, mediumTestFile):
     assert bigParts > 1
     assert resMediumData == mediumData
     assert resBigData == bigData
+
+
+def test_binaryFrames(bigTestFile):
+    # Test sending data parts as binary frames instead of b64 encoded json
+    bigMsg = {'test': 'binaryFrames', 'callId': 3}
+    with open(bigTestFile, 'rb') as fp:
+        bigData = fp.read()
+    numParts = 0
+    for msgPart in generateDataParts(bigData, bigMsg, compress=False, binaryFrame=True):
+        assert msgPart['binaryData'] == True
+        frame = packBinaryFrame(msgPart)
+        assert type(frame) is bytes
+        recvMsg = unpackBinaryFrame(frame)
+        assert recvMsg['callId'] == 3
+        assert recvMsg['partId'] == msgPart['partId']
+        resData = unpackDataMessage(recvMsg)
+        numParts += 1
+    assert numParts > 1
+    assert resData == bigData
+
+    # Compressed single part binary frame
+    data = b'1234' * 1000
+    msgPart = next(generateDataParts(data, {'test': 'compressed'}, compress=True, binaryFrame=True))
+    recvMsg = unpackBinaryFrame(packBinaryFrame(msgPart))
+    assert recvMsg['compressed'] == True
+    assert unpackDataMessage(recvMsg) == data
+
+
+def test_multipartOutOfOrder(bigTestFile):
+    # Parts can arrive in any order and are reassembled into one buffer
+    msg = {'test': 'outOfOrder', 'callId': 5}
+    with open(bigTestFile, 'rb') as fp:
+        bigData = fp.read()
+    parts = list(generateDataParts(bigData, msg, compress=False, binaryFrame=True))
+    assert len(parts) > 2
+    # multipart parts are covered by the fileHash so don't carry their own hash
+    assert 'hash' not in parts[0]
+    parts = parts[1:] + parts[:1]
+    results = [unpackDataMessage(unpackBinaryFrame(packBinaryFrame(part))) for part in parts]
+    assert results[:-1] == [None] * (len(parts) - 1)
+    assert results[-1] == bigData
+
+    # A corrupted part is detected by the fileHash check
+    parts = list(generateDataParts(bigData, msg, compress=False))
+    for part in parts:
+        part['fileHash'] = 'badhash'
+    with pytest.raises(RequestError):
+        for part in parts:
+            unpackDataMessage(part)
+
+    # The sizes in the first part's header are checked before the buffer is allocated
+    part = next(generateDataParts(bigData, msg, compress=False))
+    numParts = part['numParts']
+    for badSizes in ({'fileSize': 2**50}, {'numParts': numParts + 1},
+                     {'partSize': part['partSize'] // 2}, {'fileSize': -1},
+                     {'partSize': 0}, {'fileSize': str(part['fileSize'])}):
+        with pytest.raises(RequestError):
+            unpackDataMessage(dict(part, **badSizes))
+        assert (msg['callId'], part['fileHash']) not in serialization.multiPartDataCache
+
+
+def test_pickleOOB():
+    # numpy arrays are sent as raw buffers outside of the pickle stream
+    arr1 = numpy.arange(1000, dtype=numpy.int16).reshape(10, 100)
+    arr2 = numpy.asfortranarray(numpy.random.rand(4, 5, 6))
+    obj = {'name': 'test', 'arr1': arr1, 'vals': [arr2, 3.5]}
+    data = encodePickleOOB(obj)
+    # The packed data should contain the raw bytes of the arrays
+    assert arr1.tobytes() in data
+    res = decodePickleOOB(bytearray(data))
+    assert res['name'] == 'test'
+    assert numpy.array_equal(res['arr1'], arr1)
+    assert res['arr1'].dtype == arr1.dtype
+    assert numpy.array_equal(res['vals'][0], arr2)
+    assert res['vals'][0].flags['F_CONTIGUOUS']
+    assert res['vals'][1] == 3.5
+    # arrays decoded from read-only bytes are still writeable
+    res = decodePickleOOB(data)
+    res['arr1'][0, 0] = 7
+    # objects with no array data also round trip
+    assert decodePickleOOB(encodePickleOOB({'a': 1})) == {'a': 1}
@@ -0,0 +1,48 @@
+import gc
+import numpy
+import pytest
+from rtCommon import sharedMemoryTransport
+from rtCommon.sharedMemoryTransport import SharedResultExporter, importSharedResult
+from rtCommon.sharedMemoryTransport import canUseSharedMemory, shared_memory
+
+
+@pytest.mark.skipif(not canUseSharedMemory(), reason='shared memory not available')
+def test_sharedMemoryResults():
+    exporter = SharedResultExporter(minSize=10000)
+    data = numpy.random.random((64, 64, 10))
+    result = {'data': data, 'bytes': b'1234' * 1000, 'name': 'test'}
+    handle = exporter.export(result)
+    assert handle[0] == 'shm'
+    name = handle[1]
+    decoded = importSharedResult(handle)
+    assert numpy.array_equal(decoded['data'], data)
+    assert decoded['data'].flags.writeable
+    assert decoded['bytes'] == result['bytes']
+    assert decoded['name'] == 'test'
+    # the client unlinks the segment when it maps it
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+    # the mapping is closed once the decoded objects are released
+    view = decoded['data'][0]
+    del decoded
+    gc.collect()
+    assert len(sharedMemoryTransport.releasedSegments) == 0
+    del view
+    gc.collect()
+    assert len(sharedMemoryTransport.releasedSegments) == 1
+    sharedMemoryTransport._closeReleasedSegments()
+    assert len(sharedMemoryTransport.releasedSegments) == 0
+
+    # small results are returned in the reply
+    handle = exporter.export({'a': 1})
+    assert handle[0] == 'pickle5'
+    assert importSharedResult(handle) == {'a': 1}
+    handle = exporter.export(data, useSharedMemory=False)
+    assert handle[0] == 'pickle5'
+    assert numpy.array_equal(importSharedResult(handle), data)
+
+    # segments never mapped by a client are removed
+    handle = exporter.export(data)
+    exporter.removeAllSegments()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=handle[1])